@@ -0,0 +1,34 @@
+from datetime import datetime
+
+
+def merge_busy_periods(periods, from_datetime: datetime, to_datetime: datetime) -> list[tuple[datetime, datetime]]:
+    """
+    Sweep-line over (begin_datetime, end_datetime) periods sorted by begin_datetime: each period either extends
+    the busy interval being swept or, if it starts after it ends, closes it and opens the next one.
+    Periods are clipped to [from_datetime, to_datetime), touching periods are merged.
+    """
+    busy = []
+    for begin_datetime, end_datetime in periods:
+        begin_datetime = max(begin_datetime, from_datetime)
+        end_datetime = min(end_datetime, to_datetime)
+        if begin_datetime >= end_datetime:
+            continue
+        if busy and begin_datetime <= busy[-1][1]:
+            if end_datetime > busy[-1][1]:
+                busy[-1] = (busy[-1][0], end_datetime)
+        else:
+            busy.append((begin_datetime, end_datetime))
+    return busy
+
+
+def free_gaps(busy, from_datetime: datetime, to_datetime: datetime) -> list[tuple[datetime, datetime]]:
+    # busy is merged and sorted, so the gaps are what lies between consecutive busy intervals
+    free = []
+    free_from = from_datetime
+    for begin_datetime, end_datetime in busy:
+        if begin_datetime > free_from:
+            free.append((free_from, begin_datetime))
+        free_from = end_datetime
+    if free_from < to_datetime:
+        free.append((free_from, to_datetime))
+    return free
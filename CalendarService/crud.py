@@ -1,81 +1,415 @@
-from typing import Callable
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, NamedTuple
 
-from sqlalchemy.orm import Session, with_polymorphic
-from sqlalchemy import or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import or_, and_, tuple_, select, func, not_, cast, Date, String, bindparam
 from sqlalchemy import update
-from CalendarService import models
-from CalendarService.schemas import Reservation, BaseEvent, Cleaning, BaseEventWithId
-from fastapi_mail import FastMail, MessageSchema, MessageType
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert, ARRAY
+from sqlalchemy.orm import with_polymorphic
+from CalendarService import models, occupancy, rollups, recurrence
+from CalendarService.schemas import Reservation, BaseEvent, Cleaning, BaseEventWithId, EventsWindow, \
+    ManagementOccurrence, to_naive_utc
 from CalendarService import email_config
+from CalendarService.email_dispatcher import email_dispatcher, EmailJob
 from fastapi import HTTPException
+from CalendarService.interval_index import IntervalIndex, interval_indexes, OVERLAP_INDEX_ENABLED
+from CalendarService.ownership_cache import ownership_cache
+from CalendarService.outbox import add_outbox_message, outbox_relay
+from CalendarService.messaging_converters import to_management_event_creation_message, \
+    to_management_event_update_message, to_management_event_deletion_message
+from ProjectUtils.MessagingService.queue_definitions import WRAPPER_BROADCAST_ROUTING_KEY
 
+logger = logging.getLogger(__name__)
 
-def get_all_events_by_owner_email_and_filter_reservations_by_status(
-        db: Session, owner_email: str, reservation_status: models.ReservationStatus):
-    # include columns for all mapped subclasses
-    model = with_polymorphic(models.BaseEvent, "*")
-    return db.query(model).filter(and_(
-        models.BaseEvent.owner_email == owner_email,
-        or_(
-            models.BaseEvent.type != "reservation",
-            models.Reservation.reservation_status == reservation_status
-        ))).all()
+# rows fetched per round trip by the streaming queries
+STREAM_BATCH_SIZE = 500
 
+# SQLSTATE of the base_event_no_overlap exclusion constraint being violated
+EXCLUSION_VIOLATION = "23P01"
 
-def get_specific_events_by_owner_email(db: Session, owner_email: str, EventClass):
-    return db.query(EventClass).filter(models.BaseEvent.owner_email == owner_email).all()
 
+# pg_advisory_xact_lock key, so only one process fills the rollups of the existing events
+ROLLUPS_INITIALIZATION_LOCK = 1018
 
-def get_specific_events_by_owner_email_and_property_id(db: Session, owner_email: str, property_id: int, EventClass):
-    return db.query(EventClass).filter(and_(
-        models.BaseEvent.owner_email == owner_email,
-        models.BaseEvent.property_id == property_id
-    )).all()
 
+class OverlappingEventsError(Exception):
+    pass
+
+
+class EventState(NamedTuple):
+    # what the occupancy bitmaps, the rollups and the recurring overlap checks depend on
+    owner_email: str
+    property_id: int
+    type: str
+    begin_datetime: datetime
+    end_datetime: datetime
+    canceled: bool
+    reservation_status: models.ReservationStatus | None
+    cost: float | None
+    # (begin_datetime, end_datetime) of each occurrence of a recurring event
+    occurrences: tuple | None = None
+
+    def periods(self):
+        return self.occurrences if self.occurrences is not None else ((self.begin_datetime, self.end_datetime),)
+
+
+class Occurrence(NamedTuple):
+    # an occurrence of a recurring event, read like a row of base_event
+    id: int | None
+    owner_email: str
+    property_id: int
+    begin_datetime: datetime
+    end_datetime: datetime
+
+
+class OverrideState(NamedTuple):
+    # an occurrence override that isn't stored yet, read like models.OccurrenceOverride
+    occurrence_begin_datetime: datetime
+    canceled: bool
+    begin_datetime: datetime | None
+    end_datetime: datetime | None
+
+
+def shifted_overrides(db_event: models.ManagementEvent, begin_datetime) -> list[OverrideState]:
+    # overrides are keyed by the begin_datetime of their occurrence, which moves with the begin_datetime of the series
+    shift = begin_datetime - db_event.begin_datetime
+    return [OverrideState(override.occurrence_begin_datetime + shift, override.canceled,
+                          override.begin_datetime, override.end_datetime)
+            for override in db_event.overrides]
+
+
+def event_state(db_event: models.BaseEvent) -> EventState:
+    occurrences = None
+    if db_event.recurring:
+        occurrences = tuple((begin_datetime, end_datetime)
+                            for _, begin_datetime, end_datetime in event_occurrences(db_event))
+    return EventState(
+        db_event.owner_email, db_event.property_id, db_event.type, db_event.begin_datetime, db_event.end_datetime,
+        db_event.canceled, getattr(db_event, "reservation_status", None), getattr(db_event, "cost", None), occurrences
+    )
+
+
+def event_occurrences(db_event: models.ManagementEvent, from_datetime=None, to_datetime=None):
+    return recurrence.expand(db_event.begin_datetime, db_event.end_datetime, db_event.recurrence_rule,
+                             db_event.overrides, from_datetime, to_datetime)
+
+
+async def commit_events(db: AsyncSession, outbox_messages: Callable[[], list] = None,
+                        changed_events: Callable[[], list] = None):
+    # outbox_messages builds the (routing_key, message) pairs about the changed events after the flush,
+    # when their ids are known, so they are committed in the same transaction as the events.
+    # changed_events builds the (previous_state, state) pairs of the changed events, None when the event
+    # didn't exist before or doesn't anymore, to update the occupancy bitmaps and rollups in that transaction too
+    try:
+        await db.flush()
+        if changed_events is not None:
+            changes = changed_events()
+            await check_recurring_overlaps(db, changes)
+            await refresh_occupancy_bitmaps(db, [
+                (state.owner_email, state.property_id, begin_datetime, end_datetime)
+                for change in changes for state in change if state is not None
+                for begin_datetime, end_datetime in state.periods()
+            ])
+            await increment_rollups(db, changes)
+            await increment_calendar_revisions(db, {
+                (state.owner_email, state.property_id) for change in changes for state in change if state is not None
+            })
+        if outbox_messages is not None:
+            for routing_key, message in outbox_messages():
+                add_outbox_message(db, routing_key, message)
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        if getattr(e.orig, "pgcode", None) == EXCLUSION_VIOLATION:
+            raise OverlappingEventsError() from e
+        raise
+    except OverlappingEventsError:
+        await db.rollback()
+        raise
+    if outbox_messages is not None:
+        outbox_relay.notify()
+
+
+def filter_events_window(query, events_window: EventsWindow = None):
+    if events_window is None:
+        return query
+    base_event = models.BaseEvent.__table__
+    if events_window.from_datetime is not None or events_window.to_datetime is not None:
+        # a missing bound is an unbounded side of the range
+        query = query.where(base_event.c.period.overlaps(
+            func.tsrange(events_window.from_datetime, events_window.to_datetime, "[)")
+        ))
+    if events_window.after is not None:
+        query = query.where(tuple_(base_event.c.begin_datetime, base_event.c.id) > tuple_(*events_window.after))
+    query = query.order_by(base_event.c.begin_datetime, base_event.c.id)
+    if events_window.limit is not None:
+        # one more than asked, to know if there is a next page
+        query = query.limit(events_window.limit + 1)
+    return query
+
+
+def select_all_events_by_owner_email_and_filter_reservations_by_status(
+        owner_email: str, reservation_status: models.ReservationStatus, events_window: EventsWindow = None):
+    # only the columns of UniformEventWithId, as plain rows: base_event and the reservation table are enough,
+    # there is no need to join the whole inheritance hierarchy and build ORM objects
+    base_event = models.BaseEvent.__table__
+    reservation = models.Reservation.__table__
+    return filter_events_window(
+        select(
+            base_event.c.id,
+            base_event.c.property_id,
+            base_event.c.owner_email,
+            base_event.c.begin_datetime,
+            base_event.c.end_datetime,
+            base_event.c.type,
+            reservation.c.service
+        )
+        .select_from(base_event.outerjoin(reservation, reservation.c.id == base_event.c.id))
+        .where(and_(
+            base_event.c.owner_email == owner_email,
+            or_(
+                base_event.c.type != "reservation",
+                reservation.c.reservation_status == reservation_status
+            ))),
+        events_window
+    )
+
+
+async def get_all_events_by_owner_email_and_filter_reservations_by_status(
+        db: AsyncSession, owner_email: str, reservation_status: models.ReservationStatus,
+        events_window: EventsWindow = None):
+    return (await db.execute(select_all_events_by_owner_email_and_filter_reservations_by_status(
+        owner_email, reservation_status, events_window
+    ))).all()
+
+
+async def stream_all_events_by_owner_email_and_filter_reservations_by_status(
+        db: AsyncSession, owner_email: str, reservation_status: models.ReservationStatus,
+        events_window: EventsWindow = None):
+    # server-side cursor, only STREAM_BATCH_SIZE rows are held in memory at a time
+    result = await db.stream(select_all_events_by_owner_email_and_filter_reservations_by_status(
+        owner_email, reservation_status, events_window
+    ).execution_options(yield_per=STREAM_BATCH_SIZE))
+    async for row in result:
+        yield row
+
+
+def select_specific_events_by_owner_email(owner_email: str, EventClass, property_id: int = None,
+                                          events_window: EventsWindow = None):
+    query = select(EventClass).where(models.BaseEvent.owner_email == owner_email)
+    if property_id is not None:
+        query = query.where(models.BaseEvent.property_id == property_id)
+    return filter_events_window(query, events_window)
+
+
+async def get_specific_events_by_owner_email(db: AsyncSession, owner_email: str, EventClass,
+                                             events_window: EventsWindow = None):
+    return (await db.scalars(select_specific_events_by_owner_email(
+        owner_email, EventClass, events_window=events_window
+    ))).all()
 
-def get_confirmed_reservations_by_property_id(db: Session, property_id: int):
-    return db.query(models.Reservation).filter(and_(
-        models.Reservation.property_id == property_id,
-        models.Reservation.reservation_status == models.ReservationStatus.CONFIRMED
-    )).all()
 
+async def get_specific_events_by_owner_email_and_property_id(db: AsyncSession, owner_email: str, property_id: int,
+                                                             EventClass, events_window: EventsWindow = None):
+    return (await db.scalars(select_specific_events_by_owner_email(
+        owner_email, EventClass, property_id, events_window
+    ))).all()
 
-def update_event(db: Session, event_to_update: models.BaseEvent, update_parameters: dict):
+
+async def stream_specific_events_by_owner_email(db: AsyncSession, owner_email: str, EventClass,
+                                                property_id: int = None, events_window: EventsWindow = None):
+    # server-side cursor, only STREAM_BATCH_SIZE objects are held in memory at a time
+    result = await db.stream_scalars(select_specific_events_by_owner_email(
+        owner_email, EventClass, property_id, events_window
+    ).execution_options(yield_per=STREAM_BATCH_SIZE))
+    async for event in result:
+        yield event
+
+
+async def get_management_occurrences_by_owner_email(db: AsyncSession, owner_email: str, from_datetime, to_datetime,
+                                                    property_id: int = None) -> list[ManagementOccurrence]:
+    query = select(models.ManagementEvent).where(and_(
+        models.ManagementEvent.owner_email == owner_email,
+        or_(
+            and_(not_(models.ManagementEvent.recurring),
+                 models.ManagementEvent.period.overlaps(func.tsrange(from_datetime, to_datetime, "[)"))),
+            and_(models.ManagementEvent.recurring,
+                 models.ManagementEvent.begin_datetime < to_datetime,
+                 models.ManagementEvent.recurrence_end > from_datetime)
+        )
+    ))
+    if property_id is not None:
+        query = query.where(models.ManagementEvent.property_id == property_id)
+    occurrences = []
+    for db_event in await db.scalars(query):
+        if not db_event.recurring:
+            occurrences.append(ManagementOccurrence(
+                id=db_event.id, property_id=db_event.property_id, owner_email=db_event.owner_email,
+                begin_datetime=db_event.begin_datetime, end_datetime=db_event.end_datetime, type=db_event.type
+            ))
+            continue
+        for occurrence_begin_datetime, begin_datetime, end_datetime in event_occurrences(
+                db_event, from_datetime, to_datetime):
+            occurrences.append(ManagementOccurrence(
+                id=db_event.id, property_id=db_event.property_id, owner_email=db_event.owner_email,
+                begin_datetime=begin_datetime, end_datetime=end_datetime, type=db_event.type,
+                occurrence_begin_datetime=occurrence_begin_datetime
+            ))
+    occurrences.sort(key=lambda occurrence: (occurrence.begin_datetime, occurrence.id))
+    return occurrences
+
+
+async def stream_confirmed_reservations_by_property_ids(db: AsyncSession, property_ids):
+    # a single query for all the properties, read through a server-side cursor
+    result = await db.stream(select(
+        models.Reservation.external_id,
+        models.Reservation.property_id,
+        models.Reservation.begin_datetime,
+        models.Reservation.end_datetime
+    ).where(and_(
+        models.Reservation.property_id.in_(property_ids),
+        models.Reservation.reservation_status == models.ReservationStatus.CONFIRMED
+    )).execution_options(yield_per=STREAM_BATCH_SIZE))
+    async for row in result:
+        yield row
+
+
+async def stream_busy_periods_by_owner_email_and_property_ids(db: AsyncSession, owner_email: str, property_ids,
+                                                               begin_datetime, end_datetime):
+    # sorted by the (owner_email, property_id, begin_datetime, id) index, ready for the availability sweep-line,
+    # without the occurrences of recurring events
+    result = await db.stream(select(
+        models.BaseEvent.property_id,
+        models.BaseEvent.begin_datetime,
+        models.BaseEvent.end_datetime
+    ).where(and_(
+        models.BaseEvent.owner_email == owner_email,
+        models.BaseEvent.property_id.in_(list(property_ids)),
+        not_(models.BaseEvent.canceled),
+        not_(models.BaseEvent.recurring),
+        models.BaseEvent.period.overlaps(func.tsrange(begin_datetime, end_datetime, "[)"))
+    )).order_by(
+        models.BaseEvent.property_id, models.BaseEvent.begin_datetime
+    ).execution_options(yield_per=STREAM_BATCH_SIZE))
+    async for row in result:
+        yield row
+
+
+async def update_event(db: AsyncSession, event_to_update: models.BaseEvent, update_parameters: dict):
+    previous_state = event_state(event_to_update)
+    overrides = None
+    if event_to_update.recurring and "begin_datetime" in update_parameters \
+            and update_parameters["begin_datetime"] != event_to_update.begin_datetime:
+        overrides = shifted_overrides(event_to_update, update_parameters["begin_datetime"])
     for field_name, field_value in update_parameters.items():
         setattr(event_to_update, field_name, field_value)
-    db.commit()
-    db.refresh(event_to_update)
+    if overrides:
+        # deleted before the shifted ones are inserted, a shifted key may be the old key of another override
+        event_to_update.overrides.clear()
+        await db.flush()
+        event_to_update.overrides.extend(models.OccurrenceOverride(**override._asdict()) for override in overrides)
+    if "begin_datetime" in update_parameters or "end_datetime" in update_parameters:
+        if event_to_update.recurring:
+            event_to_update.recurrence_end = recurrence_end(event_to_update)
+        # the wrappers only care about the period of the event
+        await commit_events(db, lambda: management_event_messages(
+            event_to_update, to_management_event_update_message
+        ), lambda: [(previous_state, event_state(event_to_update))])
+    else:
+        # the calendar feeds show the other fields too
+        await commit_events(db, changed_events=lambda: [(previous_state, event_state(event_to_update))])
+    await db.refresh(event_to_update)
+    interval_indexes.index_event(event_to_update)
     return event_to_update
 
 
-def get_management_event_by_owner_email_and_event_id(db: Session, ManagementEventClass, owner_email: str,
-                                                     management_event_id: int):
-    return db.query(ManagementEventClass).filter(and_(
+async def get_management_event_by_owner_email_and_event_id(db: AsyncSession, ManagementEventClass, owner_email: str,
+                                                           management_event_id: int):
+    return (await db.scalars(select(ManagementEventClass).where(and_(
         models.ManagementEvent.owner_email == owner_email, models.ManagementEvent.id == management_event_id
-    )).first()
+    )))).first()
+
+
+async def get_management_event_by_id(db: AsyncSession, ManagementEventClass, management_event_id: int):
+    return await db.get(ManagementEventClass, management_event_id)
 
 
-def get_management_event_by_id(db: Session, ManagementEventClass, management_event_id: int):
-    return db.query(ManagementEventClass).get(management_event_id)
+def build_management_event(management_event, ManagementEventClass) -> models.ManagementEvent:
+    db_event = ManagementEventClass(
+        **management_event.model_dump(), recurring=management_event.recurrence_rule is not None, overrides=[]
+    )
+    if db_event.recurring:
+        db_event.recurrence_end = recurrence_end(db_event)
+    return db_event
+
+
+def recurrence_end(db_event: models.ManagementEvent):
+    return max(end_datetime for _, _, end_datetime in event_occurrences(db_event))
+
 
+def management_event_messages(db_event: models.ManagementEvent, to_message):
+    # the wrappers only know single events, the occurrences of recurring ones aren't propagated
+    if db_event.recurring:
+        return []
+    return [(WRAPPER_BROADCAST_ROUTING_KEY, to_message(db_event))]
 
-def create_management_event(db: Session, management_event, ManagementEventClass):
-    db_event = ManagementEventClass(**management_event.model_dump())
+
+async def create_management_event(db: AsyncSession, management_event, ManagementEventClass):
+    db_event = build_management_event(management_event, ManagementEventClass)
     db.add(db_event)
-    db.commit()
-    db.refresh(db_event)
+    await commit_events(db, lambda: management_event_messages(
+        db_event, to_management_event_creation_message
+    ), lambda: [(None, event_state(db_event))])
+    await db.refresh(db_event)
+    interval_indexes.index_event(db_event)
     return db_event
 
 
-def delete_management_event(db: Session, management_event: models.ManagementEvent):
-    db.delete(management_event)
-    db.commit()
+async def create_management_events(db: AsyncSession, management_events, ManagementEventClass):
+    # a single transaction, and the creation messages of all of them are relayed together
+    db_events = [build_management_event(management_event, ManagementEventClass)
+                 for management_event in management_events]
+    db.add_all(db_events)
+    await commit_events(db, lambda: [
+        message for db_event in db_events
+        for message in management_event_messages(db_event, to_management_event_creation_message)
+    ], lambda: [(None, event_state(db_event)) for db_event in db_events])
+    for db_event in db_events:
+        interval_indexes.index_event(db_event)
+    return db_events
+
+
+async def delete_management_event(db: AsyncSession, management_event: models.ManagementEvent):
+    previous_state = event_state(management_event)
+    await db.delete(management_event)
+    await commit_events(db, lambda: management_event_messages(
+        management_event, to_management_event_deletion_message
+    ), lambda: [(previous_state, None)])
+    interval_indexes.remove_event(management_event)
     return management_event
 
 
-def create_reservation(db: Session, reservation: Reservation):
-    print(reservation.__dict__)
-    db_reservation = models.Reservation(
+async def set_occurrence_override(db: AsyncSession, db_event: models.ManagementEvent, occurrence_override):
+    # the series is written once, whatever the number of occurrences it has
+    previous_state = event_state(db_event)
+    override = next((override for override in db_event.overrides
+                     if override.occurrence_begin_datetime == occurrence_override.occurrence_begin_datetime), None)
+    if override is None:
+        override = models.OccurrenceOverride(occurrence_begin_datetime=occurrence_override.occurrence_begin_datetime)
+        db_event.overrides.append(override)
+    override.canceled = occurrence_override.canceled
+    override.begin_datetime = occurrence_override.begin_datetime
+    override.end_datetime = occurrence_override.end_datetime
+    db_event.recurrence_end = recurrence_end(db_event)
+    await commit_events(db, changed_events=lambda: [(previous_state, event_state(db_event))])
+    return db_event
+
+
+def build_reservation(reservation: Reservation) -> models.Reservation:
+    return models.Reservation(
         external_id=reservation.external_id,
         property_id=reservation.property_id,
         owner_email=reservation.owner_email,
@@ -86,141 +420,598 @@ def create_reservation(db: Session, reservation: Reservation):
         client_phone=reservation.client_phone,
         cost=reservation.cost,
         reservation_status=models.ReservationStatus(reservation.reservation_status),
+        canceled=models.ReservationStatus(reservation.reservation_status) == models.ReservationStatus.CANCELED,
         service=models.Service(reservation.service.value),
     )
+
+
+async def create_reservation(db: AsyncSession, reservation: Reservation):
+    logger.debug("Creating reservation %s", reservation.external_id, extra={"property_id": reservation.property_id})
+    db_reservation = build_reservation(reservation)
     db.add(db_reservation)
-    db.commit()
-    db.refresh(db_reservation)
+    await commit_events(db, changed_events=lambda: [(None, event_state(db_reservation))])
+    await db.refresh(db_reservation)
+    interval_indexes.index_event(db_reservation)
     return db_reservation
 
 
-def get_reservation_by_internal_id(db: Session, reservation_internal_id: int):
-    return db.query(models.Reservation).get(reservation_internal_id)
+async def get_reservation_by_internal_id(db: AsyncSession, reservation_internal_id: int):
+    return await db.get(models.Reservation, reservation_internal_id)
 
 
-def get_reservation_by_external_id(db: Session, reservation_external_id: int):
-    return db.query(models.Reservation).filter(models.Reservation.external_id == reservation_external_id).first()
+async def get_reservation_by_external_id(db: AsyncSession, reservation_external_id: int):
+    return (await db.scalars(
+        select(models.Reservation).where(models.Reservation.external_id == reservation_external_id)
+    )).first()
 
 
-def update_reservation_status(db: Session, reservation: models.Reservation,
-                              reservation_status: models.ReservationStatus):
-    db.query(models.Reservation).filter(models.Reservation.id == reservation.id).update(
-        {models.Reservation.reservation_status: reservation_status}
-    )
-    db.commit()
-    db.refresh(reservation)
+async def get_reservations_by_external_ids(db: AsyncSession,
+                                           reservation_external_ids) -> dict[int, models.Reservation]:
+    if not reservation_external_ids:
+        return {}
+    return {
+        reservation.external_id: reservation
+        for reservation in await db.scalars(select(models.Reservation).where(
+            models.Reservation.external_id.in_(reservation_external_ids)
+        ))
+    }
+
+
+async def import_reservations(db: AsyncSession, new_reservations: list[models.Reservation], canceled_reservation_ids,
+                              messages: list = ()):
+    # everything in a single transaction: one multi-row insert and the cancellations
+    db.add_all(new_reservations)
+    changed_events = []
+    if canceled_reservation_ids:
+        # their state before the cancellation, locked until the end of the transaction
+        for row in await db.execute(select(
+            models.Reservation.owner_email, models.Reservation.property_id, models.Reservation.type,
+            models.Reservation.begin_datetime, models.Reservation.end_datetime, models.Reservation.canceled,
+            models.Reservation.reservation_status, models.Reservation.cost
+        ).where(models.Reservation.id.in_(canceled_reservation_ids)).with_for_update()):
+            previous_state = EventState(*row)
+            changed_events.append((previous_state, previous_state._replace(
+                canceled=True, reservation_status=models.ReservationStatus.CANCELED)))
+        await db.execute(
+            update(models.Reservation)
+            .where(models.Reservation.id.in_(canceled_reservation_ids))
+            .values(reservation_status=models.ReservationStatus.CANCELED)
+            .execution_options(synchronize_session=False)
+        )
+        await db.execute(
+            update(models.BaseEvent)
+            .where(models.BaseEvent.id.in_(canceled_reservation_ids))
+            .values(canceled=True)
+            .execution_options(synchronize_session=False)
+        )
+    # an event committed concurrently may still conflict, the exclusion constraint has the final word
+    await commit_events(db, lambda: messages, lambda: changed_events + [
+        (None, event_state(db_reservation)) for db_reservation in new_reservations
+    ])
+    for db_reservation in new_reservations:
+        interval_indexes.index_event(db_reservation)
+    for canceled_reservation_id in canceled_reservation_ids:
+        interval_indexes.remove_event_id(canceled_reservation_id)
+
+
+async def update_reservation_status(db: AsyncSession, reservation: models.Reservation,
+                                    reservation_status: models.ReservationStatus):
+    previous_state = event_state(reservation)
+    reservation.reservation_status = reservation_status
+    reservation.canceled = reservation_status == models.ReservationStatus.CANCELED
+    await commit_events(db, changed_events=lambda: [(previous_state, event_state(reservation))])
+    await db.refresh(reservation)
+    interval_indexes.index_event(reservation)
     return reservation
 
 
-def there_are_overlapping_events(db: Session, new_event: BaseEvent):
-    # reservations = [reservation for reservation in db.query(models.BaseEvent).all()]
-    # print(reservations)
-    # print("new_event", new_event)
-    # for reservation in reservations:
-    #     print("reservation", reservation.__dict__)
-    #     print("reservation.owner_email == new_event.owner_email", reservation.owner_email == new_event.owner_email )
-    #     print("reservation.property_id == new_event.property_id", reservation.property_id == new_event.property_id)
-    #     print("new_event.begin_datetime > reservation.begin_datetime", new_event.begin_datetime > reservation.begin_datetime )
-    #     print("new_event.end_datetime < reservation.end_datetime", new_event.end_datetime < reservation.end_datetime )
-    #     print("new_event.begin_datetime < reservation.begin_datetime", new_event.begin_datetime < reservation.begin_datetime)
-    #     print("new_event.end_datetime > reservation.begin_datetime", new_event.end_datetime > reservation.begin_datetime)
-    #     print("new_event.begin_datetime < reservation.end_datetime", new_event.begin_datetime < reservation.end_datetime)
-    #     print("new_event.end_datetime > reservation.end_datetime", new_event.end_datetime > reservation.end_datetime)
-    #     print()
-    return db.query(models.BaseEvent).filter(
-        and_(
-            models.BaseEvent.owner_email == new_event.owner_email,
-            models.BaseEvent.property_id == new_event.property_id,
-            or_(
-                and_(
-                    # fully inside
-                    new_event.begin_datetime >= models.BaseEvent.begin_datetime,
-                    new_event.end_datetime <= models.BaseEvent.end_datetime
-                ),
-                and_(
-                    # inside to the left
-                    new_event.begin_datetime < models.BaseEvent.begin_datetime,
-                    new_event.end_datetime > models.BaseEvent.begin_datetime
-                ),
-                and_(
-                    # inside to the right
-                    new_event.begin_datetime < models.BaseEvent.end_datetime,
-                    new_event.end_datetime > models.BaseEvent.end_datetime
-                )
-            )
-        )).count() > 0
-
-
-def there_are_overlapping_events_excluding_updating_event(db: Session, updating_event: BaseEventWithId):
-    # reservations = [reservation for reservation in db.query(models.BaseEventWithId).all()]
-    # print(reservations)
-    # print("new_event", new_event)
-    # for reservation in reservations:
-    #     print("reservation", reservation.__dict__)
-    #     print("reservation.owner_email == new_event.owner_email", reservation.owner_email == new_event.owner_email )
-    #     print("reservation.property_id == new_event.property_id", reservation.property_id == new_event.property_id)
-    #     print("new_event.begin_datetime > reservation.begin_datetime", new_event.begin_datetime > reservation.begin_datetime )
-    #     print("new_event.end_datetime < reservation.end_datetime", new_event.end_datetime < reservation.end_datetime )
-    #     print("new_event.begin_datetime < reservation.begin_datetime", new_event.begin_datetime < reservation.begin_datetime)
-    #     print("new_event.end_datetime > reservation.begin_datetime", new_event.end_datetime > reservation.begin_datetime)
-    #     print("new_event.begin_datetime < reservation.end_datetime", new_event.begin_datetime < reservation.end_datetime)
-    #     print("new_event.end_datetime > reservation.end_datetime", new_event.end_datetime > reservation.end_datetime)
-    #     print()
-    return db.query(models.BaseEvent).filter(
-        and_(
-            models.BaseEvent.id != updating_event.id,
-            models.BaseEvent.owner_email == updating_event.owner_email,
-            models.BaseEvent.property_id == updating_event.property_id,
-            or_(
-                and_(
-                    # fully inside
-                    updating_event.begin_datetime >= models.BaseEvent.begin_datetime,
-                    updating_event.end_datetime <= models.BaseEvent.end_datetime
-                ),
-                and_(
-                    # inside to the left
-                    updating_event.begin_datetime < models.BaseEvent.begin_datetime,
-                    updating_event.end_datetime > models.BaseEvent.begin_datetime
-                ),
-                and_(
-                    # inside to the right
-                    updating_event.begin_datetime < models.BaseEvent.end_datetime,
-                    updating_event.end_datetime > models.BaseEvent.end_datetime
-                )
-            )
-        )).count() > 0
-
-
-def add_to_email_property_id_mapping(db: Session, email: str, property_id: int):
-    db_email_property_id_mapping = db.query(models.EmailPropertyIdMapping).get(email)
-    if db_email_property_id_mapping is None:
-        db_email_property_id_mapping = models.EmailPropertyIdMapping(email=email, properties_ids=[property_id])
-        db.add(db_email_property_id_mapping)
-    else:
-        db_email_property_id_mapping.properties_ids.append(property_id)
-    db.commit()
+async def get_interval_index(db: AsyncSession, owner_email: str, property_id: int) -> IntervalIndex:
+    # warmed lazily from the database the first time a property is checked for overlaps
+    index = interval_indexes.get(owner_email, property_id)
+    if index is None:
+        index = IntervalIndex(await db.execute(select(
+            models.BaseEvent.id,
+            models.BaseEvent.begin_datetime,
+            models.BaseEvent.end_datetime
+        ).where(and_(
+            models.BaseEvent.owner_email == owner_email,
+            models.BaseEvent.property_id == property_id,
+            not_(models.BaseEvent.canceled),
+            not_(models.BaseEvent.recurring)
+        ))))
+        interval_indexes.set(owner_email, property_id, index)
+    return index
+
+
+async def count_overlapping_events(db: AsyncSession, owner_email: str, property_id: int, begin_datetime,
+                                   end_datetime, excluding_event_id: int = None) -> int:
+    # "&&" on the period is answered by the GiST index of the base_event_no_overlap constraint
+    query = select(func.count(models.BaseEvent.id)).where(and_(
+        models.BaseEvent.owner_email == owner_email,
+        models.BaseEvent.property_id == property_id,
+        not_(models.BaseEvent.canceled),
+        not_(models.BaseEvent.recurring),
+        models.BaseEvent.period.overlaps(func.tsrange(begin_datetime, end_datetime, "[)"))
+    ))
+    if excluding_event_id is not None:
+        query = query.where(models.BaseEvent.id != excluding_event_id)
+    return await db.scalar(query)
+
+
+async def there_are_overlapping_events_in_period(db: AsyncSession, owner_email: str, property_id: int,
+                                                 begin_datetime, end_datetime, excluding_event_id: int = None) -> bool:
+    # the indexed and stored datetimes are naive UTC, aware ones can't be compared with them
+    begin_datetime, end_datetime = to_naive_utc(begin_datetime), to_naive_utc(end_datetime)
+    if await there_are_overlapping_single_events_in_period(
+            db, owner_email, property_id, begin_datetime, end_datetime, excluding_event_id):
+        return True
+    return len(await get_occurrences_by_owner_email_and_property_ids_in_period(
+        db, {(owner_email, property_id)}, begin_datetime, end_datetime, excluding_event_id)) > 0
+
+
+async def there_are_overlapping_single_events_in_period(db: AsyncSession, owner_email: str, property_id: int,
+                                                        begin_datetime, end_datetime,
+                                                        excluding_event_id: int = None) -> bool:
+    begin_datetime, end_datetime = to_naive_utc(begin_datetime), to_naive_utc(end_datetime)
+    if not OVERLAP_INDEX_ENABLED:
+        return await count_overlapping_events(
+            db, owner_email, property_id, begin_datetime, end_datetime, excluding_event_id) > 0
+
+    index = await get_interval_index(db, owner_email, property_id)
+    if not index.overlaps(begin_datetime, end_datetime, excluding_event_id):
+        # not asking the database is only safe because the base_event_no_overlap exclusion constraint still
+        # rejects, on commit, a conflicting event the index missed
+        return False
+    # the database has the final word on conflicts, in case the index went stale
+    if await count_overlapping_events(
+            db, owner_email, property_id, begin_datetime, end_datetime, excluding_event_id) > 0:
+        return True
+    interval_indexes.invalidate(owner_email, property_id)
+    return False
+
+
+async def there_are_overlapping_periods(db: AsyncSession, owner_email: str, property_id: int, periods,
+                                        excluding_event_id: int = None) -> bool:
+    # the occurrences of a recurring event, checked with a single read of the events around them
+    if not periods:
+        return False
+    periods = [(to_naive_utc(begin_datetime), to_naive_utc(end_datetime)) for begin_datetime, end_datetime in periods]
+    index = IntervalIndex(
+        (None, event.begin_datetime, event.end_datetime)
+        for event in await get_events_by_owner_email_and_property_ids_in_period(
+            db, {(owner_email, property_id)},
+            min(begin_datetime for begin_datetime, _ in periods), max(end_datetime for _, end_datetime in periods),
+            excluding_event_id
+        )
+    )
+    return any(index.overlaps(begin_datetime, end_datetime) for begin_datetime, end_datetime in periods)
+
+
+def new_event_periods(new_event: BaseEvent) -> list:
+    if getattr(new_event, "recurrence_rule", None) is None:
+        return [(new_event.begin_datetime, new_event.end_datetime)]
+    return [(begin_datetime, end_datetime) for _, begin_datetime, end_datetime
+            in recurrence.expand(new_event.begin_datetime, new_event.end_datetime, new_event.recurrence_rule)]
 
 
-def get_property_ids_by_email(db: Session, email: str) -> list[int]:
-    db_email_property_id_mapping = db.query(models.EmailPropertyIdMapping).get(email)
-    return db_email_property_id_mapping.properties_ids if db_email_property_id_mapping is not None else []
+async def there_are_overlapping_events(db: AsyncSession, new_event: BaseEvent):
+    if getattr(new_event, "recurrence_rule", None) is not None:
+        return await there_are_overlapping_periods(
+            db, new_event.owner_email, new_event.property_id, new_event_periods(new_event))
+    return await there_are_overlapping_events_in_period(
+        db, new_event.owner_email, new_event.property_id, new_event.begin_datetime, new_event.end_datetime
+    )
+
+
+async def there_are_overlapping_events_excluding_updating_event(db: AsyncSession, updating_event: BaseEventWithId):
+    return await there_are_overlapping_events_in_period(
+        db, updating_event.owner_email, updating_event.property_id,
+        updating_event.begin_datetime, updating_event.end_datetime, excluding_event_id=updating_event.id
+    )
+
+
+async def there_are_overlapping_occurrences(db: AsyncSession, db_event: models.ManagementEvent, begin_datetime,
+                                            end_datetime, overrides) -> bool:
+    # the occurrences a recurring event would have, against each other and against the other events
+    periods = [(occurrence_begin_datetime, occurrence_end_datetime)
+               for _, occurrence_begin_datetime, occurrence_end_datetime
+               in recurrence.expand(begin_datetime, end_datetime, db_event.recurrence_rule, overrides)]
+    return recurrence.periods_overlap(periods) or await there_are_overlapping_periods(
+        db, db_event.owner_email, db_event.property_id, periods, excluding_event_id=db_event.id)
+
+
+async def check_recurring_overlaps(db: AsyncSession, changes):
+    # the exclusion constraint doesn't see the occurrences of the recurring events, so the properties changed by
+    # the transaction are locked until it ends, and their periods are checked again after the flush
+    # a constant number of round trips whatever the number of properties, e.g. of an import batch
+    periods = [(state.owner_email, state.property_id, begin_datetime, end_datetime)
+               for _, state in changes if state is not None and not state.canceled
+               for begin_datetime, end_datetime in state.periods()]
+    if not periods:
+        return
+    owner_email_property_ids = {(owner_email, property_id) for owner_email, property_id, _, _ in periods}
+    begin_datetime = min(begin_datetime for _, _, begin_datetime, _ in periods)
+    end_datetime = max(end_datetime for _, _, _, end_datetime in periods)
+
+    # all the locks in one statement, always in the same order so concurrent transactions can't deadlock on them
+    lock_keys = func.unnest(bindparam("lock_keys", sorted(
+        f"{owner_email}/{property_id}" for owner_email, property_id in owner_email_property_ids
+    ), type_=ARRAY(String))).table_valued("key")
+    await db.execute(select(func.pg_advisory_xact_lock(func.hashtext(lock_keys.c.key))).select_from(lock_keys))
+
+    # the properties with only single events are covered by the exclusion constraint
+    recurring_owner_email_property_ids = set((await db.execute(
+        select(models.ManagementEvent.owner_email, models.ManagementEvent.property_id).distinct().where(and_(
+            tuple_(models.ManagementEvent.owner_email, models.ManagementEvent.property_id)
+            .in_(list(owner_email_property_ids)),
+            models.ManagementEvent.recurring,
+            not_(models.ManagementEvent.canceled),
+            models.ManagementEvent.begin_datetime < end_datetime,
+            models.ManagementEvent.recurrence_end > begin_datetime
+        ))
+    )).all())
+    if not recurring_owner_email_property_ids:
+        return
+    periods_by_property = defaultdict(list)
+    for event in await get_events_by_owner_email_and_property_ids_in_period(
+            db, recurring_owner_email_property_ids, begin_datetime, end_datetime):
+        periods_by_property[(event.owner_email, event.property_id)].append((event.begin_datetime, event.end_datetime))
+    if any(recurrence.periods_overlap(property_periods) for property_periods in periods_by_property.values()):
+        raise OverlappingEventsError()
+
+
+async def get_events_by_owner_email_and_property_ids_in_period(db: AsyncSession, owner_email_property_ids,
+                                                              begin_datetime, end_datetime,
+                                                              excluding_event_id: int = None):
+    # only the base_event columns, no need to load the subclasses to check for overlaps,
+    # followed by the occurrences of the recurring events in the period
+    if not owner_email_property_ids:
+        return []
+    query = select(
+        models.BaseEvent.id,
+        models.BaseEvent.owner_email,
+        models.BaseEvent.property_id,
+        models.BaseEvent.begin_datetime,
+        models.BaseEvent.end_datetime
+    ).where(and_(
+        tuple_(models.BaseEvent.owner_email, models.BaseEvent.property_id).in_(list(owner_email_property_ids)),
+        not_(models.BaseEvent.canceled),
+        not_(models.BaseEvent.recurring),
+        models.BaseEvent.period.overlaps(func.tsrange(begin_datetime, end_datetime, "[)"))
+    ))
+    if excluding_event_id is not None:
+        query = query.where(models.BaseEvent.id != excluding_event_id)
+    return (await db.execute(query)).all() + await get_occurrences_by_owner_email_and_property_ids_in_period(
+        db, owner_email_property_ids, begin_datetime, end_datetime, excluding_event_id)
+
+
+async def get_recurring_events_by_owner_email_and_property_ids_in_period(db: AsyncSession, owner_email_property_ids,
+                                                                        begin_datetime, end_datetime,
+                                                                        excluding_event_id: int = None):
+    # the series with occurrences that may overlap the period, without the columns of their subclasses
+    query = select(models.ManagementEvent).where(and_(
+        tuple_(models.ManagementEvent.owner_email, models.ManagementEvent.property_id)
+        .in_(list(owner_email_property_ids)),
+        models.ManagementEvent.recurring,
+        not_(models.ManagementEvent.canceled),
+        models.ManagementEvent.begin_datetime < end_datetime,
+        models.ManagementEvent.recurrence_end > begin_datetime
+    ))
+    if excluding_event_id is not None:
+        query = query.where(models.ManagementEvent.id != excluding_event_id)
+    return (await db.scalars(query)).all()
+
+
+async def get_occurrences_by_owner_email_and_property_ids_in_period(db: AsyncSession, owner_email_property_ids,
+                                                                   begin_datetime, end_datetime,
+                                                                   excluding_event_id: int = None) -> list[Occurrence]:
+    # expanded only inside the period
+    return [
+        Occurrence(None, db_event.owner_email, db_event.property_id, occurrence_begin_datetime,
+                   occurrence_end_datetime)
+        for db_event in await get_recurring_events_by_owner_email_and_property_ids_in_period(
+            db, owner_email_property_ids, begin_datetime, end_datetime, excluding_event_id)
+        for _, occurrence_begin_datetime, occurrence_end_datetime
+        in event_occurrences(db_event, begin_datetime, end_datetime)
+    ]
+
+
+async def get_occupancy_bitmaps(db: AsyncSession, owner_email: str, property_id_years,
+                                for_update: bool = False) -> dict[tuple[int, int], int]:
+    # bitmaps by (property_id, year), the missing ones are built from the events the first time they're needed
+    property_id_years = set(property_id_years)
+    if not property_id_years:
+        return {}
+    query = select(
+        models.OccupancyBitmap.property_id, models.OccupancyBitmap.year, models.OccupancyBitmap.bits
+    ).where(and_(
+        models.OccupancyBitmap.owner_email == owner_email,
+        tuple_(models.OccupancyBitmap.property_id, models.OccupancyBitmap.year).in_(list(property_id_years))
+    ))
+    if for_update:
+        # always locked in the same order, so concurrent transactions can't deadlock on them
+        query = query.order_by(models.OccupancyBitmap.property_id, models.OccupancyBitmap.year).with_for_update()
+    bitmaps = {(row.property_id, row.year): occupancy.bitmap_from_bytes(row.bits) for row in await db.execute(query)}
+
+    missing = property_id_years - bitmaps.keys()
+    if missing:
+        missing_years = {year for _, year in missing}
+        built_bitmaps = dict.fromkeys(missing, 0)
+        for event in await get_events_by_owner_email_and_property_ids_in_period(
+                db, {(owner_email, property_id) for property_id, _ in missing},
+                datetime(min(missing_years), 1, 1), datetime(max(missing_years) + 1, 1, 1)):
+            for year in occupancy.years_of_period(event.begin_datetime, event.end_datetime):
+                if (event.property_id, year) in built_bitmaps:
+                    built_bitmaps[(event.property_id, year)] |= occupancy.period_mask(
+                        year, event.begin_datetime, event.end_datetime)
+        # another transaction may have built them in the meantime, theirs are kept
+        await db.execute(insert(models.OccupancyBitmap).values([
+            {"owner_email": owner_email, "property_id": property_id, "year": year,
+             "bits": occupancy.bitmap_to_bytes(bitmap)}
+            for (property_id, year), bitmap in built_bitmaps.items()
+        ]).on_conflict_do_nothing())
+        bitmaps.update({
+            (row.property_id, row.year): occupancy.bitmap_from_bytes(row.bits)
+            for row in await db.execute(query.where(
+                tuple_(models.OccupancyBitmap.property_id, models.OccupancyBitmap.year).in_(list(missing))
+            ))
+        })
+    return bitmaps
+
+
+async def refresh_occupancy_bitmaps(db: AsyncSession, changed_periods):
+    # the hours of the changed (owner_email, property_id, begin_datetime, end_datetime) periods are recomputed
+    # from the events, under a lock of their bitmaps, so removing an event doesn't clear an hour that a
+    # neighbouring event still occupies
+    masks_by_owner_email = defaultdict(lambda: defaultdict(int))
+    for owner_email, property_id, begin_datetime, end_datetime in changed_periods:
+        for year in occupancy.years_of_period(begin_datetime, end_datetime):
+            masks_by_owner_email[owner_email][(property_id, year)] |= occupancy.period_mask(
+                year, begin_datetime, end_datetime)
+
+    for owner_email, masks in masks_by_owner_email.items():
+        bitmaps = await get_occupancy_bitmaps(db, owner_email, masks.keys(), for_update=True)
+        occupied = defaultdict(int)
+        periods = [period for period in changed_periods if period[0] == owner_email]
+        for event in await get_events_by_owner_email_and_property_ids_in_period(
+                db, {(owner_email, property_id) for _, property_id, _, _ in periods},
+                min(begin_datetime for _, _, begin_datetime, _ in periods) - occupancy.HOUR,
+                max(end_datetime for _, _, _, end_datetime in periods) + occupancy.HOUR):
+            for year in occupancy.years_of_period(event.begin_datetime, event.end_datetime):
+                occupied[(event.property_id, year)] |= occupancy.period_mask(
+                    year, event.begin_datetime, event.end_datetime)
+        for (property_id, year), mask in masks.items():
+            bitmap = (bitmaps[(property_id, year)] & ~mask) | (occupied[(property_id, year)] & mask)
+            if bitmap != bitmaps[(property_id, year)]:
+                await db.execute(update(models.OccupancyBitmap).where(and_(
+                    models.OccupancyBitmap.owner_email == owner_email,
+                    models.OccupancyBitmap.property_id == property_id,
+                    models.OccupancyBitmap.year == year
+                )).values(bits=occupancy.bitmap_to_bytes(bitmap)))
+
+
+async def get_free_property_ids(db: AsyncSession, owner_email: str, property_ids, from_datetime,
+                                to_datetime) -> list[int]:
+    years = occupancy.years_of_period(from_datetime, to_datetime)
+    bitmaps = await get_occupancy_bitmaps(
+        db, owner_email, {(property_id, year) for property_id in property_ids for year in years})
+    await db.commit()
+    return [
+        property_id for property_id in property_ids
+        if occupancy.is_free({year: bitmaps[(property_id, year)] for year in years}, from_datetime, to_datetime)
+    ]
+
+
+async def increment_rollups(db: AsyncSession, changes):
+    # the previous contributions of the changed events are subtracted and the new ones added, with a single
+    # upsert whose increments are atomic, so concurrent transactions never lose each other's changes
+    deltas = defaultdict(lambda: [0, 0.0, 0, 0])
+    for previous_state, state in changes:
+        for sign, changed_state in ((-1, previous_state), (1, state)):
+            for day, contribution in rollups.event_contributions(changed_state).items():
+                delta = deltas[(changed_state.owner_email, changed_state.property_id, day)]
+                for position, value in enumerate(contribution):
+                    delta[position] += sign * value
+    rows = [
+        {"owner_email": owner_email, "property_id": property_id, "day": day, "occupied_nights": occupied_nights,
+         "revenue": revenue, "cleanings": cleanings, "maintenances": maintenances}
+        for (owner_email, property_id, day), (occupied_nights, revenue, cleanings, maintenances) in deltas.items()
+        if any(value != 0 for value in (occupied_nights, revenue, cleanings, maintenances))
+    ]
+    if not rows:
+        return
+    statement = insert(models.PropertyDailyRollup).values(rows)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[models.PropertyDailyRollup.owner_email, models.PropertyDailyRollup.property_id,
+                        models.PropertyDailyRollup.day],
+        set_={
+            column: getattr(models.PropertyDailyRollup, column) + getattr(statement.excluded, column)
+            for column in ("occupied_nights", "revenue", "cleanings", "maintenances")
+        }
+    ))
+
+
+async def initialize_rollups(db: AsyncSession):
+    # the rollups of the events that existed before them, only while the table is empty
+    await db.execute(select(func.pg_advisory_xact_lock(ROLLUPS_INITIALIZATION_LOCK)))
+    if await db.scalar(select(models.PropertyDailyRollup.day).limit(1)) is not None:
+        await db.commit()
+        return
+    result = await db.stream(select(
+        models.BaseEvent.owner_email, models.BaseEvent.property_id, models.BaseEvent.type,
+        models.BaseEvent.begin_datetime, models.BaseEvent.end_datetime, models.BaseEvent.canceled,
+        models.Reservation.reservation_status, models.Reservation.cost
+    ).outerjoin(models.Reservation, models.Reservation.id == models.BaseEvent.id)
+        .where(and_(not_(models.BaseEvent.canceled), not_(models.BaseEvent.recurring)))
+        .execution_options(yield_per=STREAM_BATCH_SIZE))
+    changes = [(None, event_state(db_event)) for db_event in await db.scalars(select(models.ManagementEvent).where(
+        and_(models.ManagementEvent.recurring, not_(models.ManagementEvent.canceled))
+    ))]
+    async for row in result:
+        changes.append((None, EventState(*row)))
+        if len(changes) >= STREAM_BATCH_SIZE:
+            await increment_rollups(db, changes)
+            changes = []
+    await increment_rollups(db, changes)
+    await db.commit()
+
+
+async def get_rollups(db: AsyncSession, owner_email: str, from_date, to_date, granularity: str, property_id: int = None):
+    # summed in the database, only the rollups of the days in [from_date, to_date) are read
+    period = cast(func.date_trunc(granularity, models.PropertyDailyRollup.day), Date).label("period")
+    query = select(
+        models.PropertyDailyRollup.property_id,
+        period,
+        func.sum(models.PropertyDailyRollup.occupied_nights).label("occupied_nights"),
+        func.sum(models.PropertyDailyRollup.revenue).label("revenue"),
+        func.sum(models.PropertyDailyRollup.cleanings).label("cleanings"),
+        func.sum(models.PropertyDailyRollup.maintenances).label("maintenances"),
+    ).where(and_(
+        models.PropertyDailyRollup.owner_email == owner_email,
+        models.PropertyDailyRollup.day >= from_date,
+        models.PropertyDailyRollup.day < to_date
+    ))
+    if property_id is not None:
+        query = query.where(models.PropertyDailyRollup.property_id == property_id)
+    return (await db.execute(
+        query.group_by(models.PropertyDailyRollup.property_id, period)
+        .order_by(models.PropertyDailyRollup.property_id, period)
+    )).all()
+
+
+async def increment_calendar_revisions(db: AsyncSession, owner_email_property_ids):
+    if not owner_email_property_ids:
+        return
+    statement = insert(models.CalendarRevision).values([
+        {"owner_email": owner_email, "property_id": property_id, "revision": 1}
+        for owner_email, property_id in sorted(owner_email_property_ids)
+    ])
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=[models.CalendarRevision.owner_email, models.CalendarRevision.property_id],
+        set_={"revision": models.CalendarRevision.revision + 1}
+    ))
+
+
+async def get_calendar_revisions(db: AsyncSession, owner_email: str, property_id: int = None) -> dict[int, int]:
+    query = select(models.CalendarRevision.property_id, models.CalendarRevision.revision) \
+        .where(models.CalendarRevision.owner_email == owner_email)
+    if property_id is not None:
+        query = query.where(models.CalendarRevision.property_id == property_id)
+    return {row.property_id: row.revision for row in await db.execute(query)}
+
+
+async def stream_feed_events(db: AsyncSession, owner_email: str, since, property_id: int = None):
+    # every kind of event with the columns of its subclass, in a single query; recurrence_end is a column of
+    # management_event, shared by cleanings and maintenances
+    event = with_polymorphic(models.BaseEvent, [models.Reservation, models.Cleaning, models.Maintenance])
+    query = select(event).where(and_(
+        event.owner_email == owner_email,
+        not_(event.canceled),
+        or_(event.end_datetime > since, event.Cleaning.recurrence_end > since)
+    ))
+    if property_id is not None:
+        query = query.where(event.property_id == property_id)
+    result = await db.stream_scalars(query.order_by(event.begin_datetime, event.id)
+                                     .execution_options(yield_per=STREAM_BATCH_SIZE))
+    async for db_event in result:
+        yield db_event
+
+
+async def find_overlapping_events(db: AsyncSession, new_events) -> list[bool]:
+    # whether each new event overlaps an existing event or one of the new events before it that doesn't overlap,
+    # with a single query for all of them
+    if not new_events:
+        return []
+    periods = [new_event_periods(new_event) for new_event in new_events]
+    property_indexes = defaultdict(IntervalIndex)
+    for event in await get_events_by_owner_email_and_property_ids_in_period(
+            db,
+            {(new_event.owner_email, new_event.property_id) for new_event in new_events},
+            min(begin_datetime for event_periods in periods for begin_datetime, _ in event_periods),
+            max(end_datetime for event_periods in periods for _, end_datetime in event_periods)
+    ):
+        property_indexes[(event.owner_email, event.property_id)].add(
+            event.id, event.begin_datetime, event.end_datetime)
+
+    overlapping = []
+    for new_event, event_periods in zip(new_events, periods):
+        index = property_indexes[(new_event.owner_email, new_event.property_id)]
+        overlapping.append(any(index.overlaps(begin_datetime, end_datetime)
+                               for begin_datetime, end_datetime in event_periods))
+        if not overlapping[-1]:
+            # new events don't have an id yet, they are indexed without one
+            for begin_datetime, end_datetime in event_periods:
+                index.add(None, begin_datetime, end_datetime)
+    return overlapping
+
+
+async def add_to_email_property_id_mapping(db: AsyncSession, email: str, property_id: int):
+    await add_properties_to_email_property_id_mapping(db, email, [property_id])
+
+
+async def add_properties_to_email_property_id_mapping(db: AsyncSession, email: str, property_ids):
+    # idempotent, replayed or concurrent messages for the same owner can't duplicate or lose a property
+    if not property_ids:
+        return
+    await db.execute(
+        insert(models.EmailPropertyIdMapping)
+        .values([{"email": email, "property_id": property_id} for property_id in property_ids])
+        .on_conflict_do_nothing()
+    )
+    await db.commit()
 
 
-async def send_email_to_reservation_client(db: Session, key: str, reservation: Reservation):
-    print(f"Sending email to reservation {reservation.id}'s client: {reservation.client_email}")
+async def get_property_ids_by_email(db: AsyncSession, email: str) -> list[int]:
+    return (await db.scalars(
+        select(models.EmailPropertyIdMapping.property_id).where(models.EmailPropertyIdMapping.email == email)
+    )).all()
+
+
+async def get_owner_email_by_property_id(db: AsyncSession, property_id: int) -> str | None:
+    # the reverse lookup, by the index on property_id
+    return await db.scalar(
+        select(models.EmailPropertyIdMapping.email).where(models.EmailPropertyIdMapping.property_id == property_id)
+        .limit(1)
+    )
+
 
-    message = MessageSchema(
+async def is_property_owned_by_email(db: AsyncSession, email: str, property_id: int) -> bool:
+    return property_id in await get_owned_property_ids(db, email, [property_id])
+
+
+async def get_owned_property_ids(db: AsyncSession, email: str, property_ids) -> set[int]:
+    # which of property_ids are owned by email, with at most one query
+    property_ids = set(property_ids)
+    owned_property_ids = ownership_cache.get(email)
+    if owned_property_ids is None:
+        owned_property_ids = await get_property_ids_by_email(db, email)
+        ownership_cache.set(email, owned_property_ids)
+        return property_ids & set(owned_property_ids)
+    missing_property_ids = property_ids - owned_property_ids
+    if not missing_property_ids:
+        return property_ids
+    # added by a message this process hasn't seen, or not owned at all
+    found_property_ids = set(await db.scalars(select(models.EmailPropertyIdMapping.property_id).where(and_(
+        models.EmailPropertyIdMapping.email == email,
+        models.EmailPropertyIdMapping.property_id.in_(missing_property_ids)
+    ))))
+    for property_id in found_property_ids:
+        ownership_cache.add(email, property_id)
+    return (property_ids & owned_property_ids) | found_property_ids
+
+
+def send_email_to_reservation_client(key: str, reservation: models.Reservation) -> EmailJob:
+    # only enqueued, the email dispatcher sends it in the background
+    logger.info("Queueing the key email of reservation %s", reservation.id)
+
+    return email_dispatcher.enqueue(
+        owner_email=reservation.owner_email,
+        recipient=reservation.client_email,
         subject=f"Key to open the door for your reservation from {reservation.begin_datetime} to {reservation.end_datetime}.",
-        recipients=[reservation.client_email],
-        body=email_config.template.substitute({
+        html_body=email_config.template.substitute({
             "client_name": reservation.client_name,
             "key": key,
             "begin_time": reservation.begin_datetime,
             "end_time": reservation.end_datetime
-        }),
-        subtype=MessageType.html)
-
-    fm = FastMail(email_config.conf)
-    await fm.send_message(message)
-
-
+        })
+    )
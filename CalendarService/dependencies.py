@@ -1,25 +1,32 @@
-from fastapi import Depends, HTTPException, status, Response, Request
+from datetime import datetime
+from typing import Optional
+from fastapi import Depends, HTTPException, status, Response, Request, Query
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from ProjectUtils.DecoderService.decode_token import decode_token
 from CalendarService.database import SessionLocal
-from CalendarService.schemas import UserBase, Cleaning
+from CalendarService.token_cache import token_verification_cache
+from CalendarService.schemas import UserBase, Cleaning, to_naive_utc
 from pydantic import EmailStr
 from CalendarService.schemas import Base
 from pydantic_core._pydantic_core import ValidationError
 from CalendarService import models
 from CalendarService import schemas
+from CalendarService.pagination import decode_cursor, MAX_PAGE_SIZE
+from CalendarService.ics import FEED_TOKEN_SECRET, verify_feed_token
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 def get_user(res: Response, cred: HTTPAuthorizationCredentials = Depends(HTTPBearer(auto_error=False))):
-    decoded_token = decode_token(res, cred)
+    # the same token is sent many times a minute, only verify its signature once
+    decoded_token = token_verification_cache.get(cred.credentials) if cred is not None else None
+    if decoded_token is None:
+        decoded_token = decode_token(res, cred)
+        if cred is not None:
+            token_verification_cache.put(cred.credentials, decoded_token)
     return UserBase(**decoded_token)
 
 
@@ -31,15 +38,48 @@ def get_request_url_path(request: Request):
     return request.url.path
 
 
+def get_events_window(
+        from_datetime: Optional[datetime] = Query(None, alias="from",
+                                                  description="Only events that end after this datetime."),
+        to_datetime: Optional[datetime] = Query(None, alias="to",
+                                                description="Only events that begin before this datetime."),
+        cursor: Optional[str] = Query(None, description="X-Next-Cursor header of the previous page."),
+        limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of events.")
+):
+    # aware and naive datetimes can't be compared, nor the aware ones with the stored datetimes
+    from_datetime, to_datetime = to_naive_utc(from_datetime), to_naive_utc(to_datetime)
+    if from_datetime is not None and to_datetime is not None and from_datetime >= to_datetime:
+        raise HTTPException(422, detail="from cannot be greater or equal to to")
+    try:
+        after = decode_cursor(cursor) if cursor is not None else None
+    except ValueError:
+        raise HTTPException(422, detail=f"Invalid cursor {cursor}")
+    return schemas.EventsWindow(from_datetime=from_datetime, to_datetime=to_datetime, after=after, limit=limit)
+
+
+def get_period(from_datetime: datetime = Query(..., alias="from"), to_datetime: datetime = Query(..., alias="to")):
+    from_datetime, to_datetime = to_naive_utc(from_datetime), to_naive_utc(to_datetime)
+    if from_datetime >= to_datetime:
+        raise HTTPException(422, detail="from cannot be greater or equal to to")
+    return from_datetime, to_datetime
+
+
+def get_feed_owner_email(feed_token: str):
+    if FEED_TOKEN_SECRET is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail="Calendar feeds are not configured")
+    owner_email = verify_feed_token(feed_token)
+    if owner_email is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Calendar feed not found")
+    return owner_email
+
+
 def get_event_model(request_url_path: str = Depends(get_request_url_path)):
-    print("running get_event_model")
     if request_url_path.split("/")[2] == "reservation":
         return models.Reservation
     return get_management_event_model(request_url_path)
 
 
 def get_management_event_model(request_url_path: str = Depends(get_request_url_path)):
-    print("running get_management_event_model")
     match request_url_path.split("/")[3]:
         case "cleaning":
             return models.Cleaning
@@ -48,7 +88,6 @@ def get_management_event_model(request_url_path: str = Depends(get_request_url_p
 
 
 def get_management_event_schema(request_url_path: str = Depends(get_request_url_path)):
-    print("running get_management_event_schema")
     match request_url_path.split("/")[3]:
         case "cleaning":
             return schemas.Cleaning
@@ -57,7 +96,6 @@ def get_management_event_schema(request_url_path: str = Depends(get_request_url_
 
 
 def get_update_management_event_schema(request_url_path: str = Depends(get_request_url_path)):
-    print("running get_update_management_event_schema")
     match request_url_path.split("/")[3]:
         case "cleaning":
             return schemas.UpdateCleaning
@@ -69,12 +107,9 @@ class InitializeEventWithOwnerEmail:
 
     def __call__(self, base: Base, EventSchema=Depends(get_management_event_schema),
                  email: EmailStr = Depends(get_user_email)):
-        print("EventSchema", EventSchema)
         try:
             event = EventSchema(owner_email=email, **base.model_dump(exclude={"owner_email"}))
             event.owner_email = email
-            print("EventSchema", EventSchema)
-            print("event", event)
         except ValidationError as e:
             raise HTTPException(422, detail=e.errors())
         return event
@@ -85,7 +120,6 @@ class InitializeUpdateEventAccordingToEndpoint:
     def __call__(self, base: Base, UpdateEventSchema=Depends(get_update_management_event_schema)):
         try:
             event = UpdateEventSchema(**base.model_dump())
-            print("event", event)
         except ValidationError as e:
             raise HTTPException(422, detail=e.errors())
         return event
@@ -9,12 +9,13 @@ conf = ConnectionConfig(
     MAIL_USERNAME =os.getenv("MAIL_USERNAME"),
     MAIL_PASSWORD = os.getenv("MAIL_PASSWORD"),
     MAIL_FROM = os.getenv("MAIL_USERNAME"),
-    MAIL_PORT = 587,
-    MAIL_SERVER = "smtp-mail.outlook.com",
-    MAIL_STARTTLS = True,
-    MAIL_SSL_TLS = False,
-    USE_CREDENTIALS = True,
-    VALIDATE_CERTS = True
+    # overridable to point at a local SMTP server, e.g. in tests
+    MAIL_PORT = int(os.getenv("MAIL_PORT", "587")),
+    MAIL_SERVER = os.getenv("MAIL_SERVER", "smtp-mail.outlook.com"),
+    MAIL_STARTTLS = os.getenv("MAIL_STARTTLS", "true").lower() == "true",
+    MAIL_SSL_TLS = os.getenv("MAIL_SSL_TLS", "false").lower() == "true",
+    USE_CREDENTIALS = os.getenv("MAIL_USE_CREDENTIALS", "true").lower() == "true",
+    VALIDATE_CERTS = os.getenv("MAIL_VALIDATE_CERTS", "true").lower() == "true"
 )
 
 template = Template(
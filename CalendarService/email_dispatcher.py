@@ -0,0 +1,241 @@
+import asyncio
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from email.message import EmailMessage
+
+import aiosmtplib
+from dotenv import load_dotenv
+from fastapi_mail import ConnectionConfig
+
+from CalendarService import email_config
+from CalendarService.schemas import EmailJobStatus, EmailStatus
+
+load_dotenv()
+
+EMAIL_QUEUE_MAX_SIZE = int(os.getenv("EMAIL_QUEUE_MAX_SIZE", "1000"))
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "20"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "5"))
+EMAIL_RETRY_BACKOFF_SECONDS = float(os.getenv("EMAIL_RETRY_BACKOFF_SECONDS", "2"))
+EMAIL_IDLE_TIMEOUT_SECONDS = float(os.getenv("EMAIL_IDLE_TIMEOUT_SECONDS", "60"))
+# the queued emails were already accepted, stopping waits this long for them to be sent
+EMAIL_DRAIN_TIMEOUT_SECONDS = float(os.getenv("EMAIL_DRAIN_TIMEOUT_SECONDS", "10"))
+EMAIL_JOBS_KEPT = int(os.getenv("EMAIL_JOBS_KEPT", "10000"))
+
+logger = logging.getLogger(__name__)
+
+
+class EmailQueueFullError(Exception):
+    pass
+
+
+class EmailJob:
+
+    def __init__(self, owner_email: str, message: EmailMessage):
+        self.id = uuid.uuid4().hex
+        self.owner_email = owner_email
+        self.message = message
+        self.status = EmailStatus.QUEUED
+        self.attempts = 0
+        self.error = None
+
+    def to_status(self) -> EmailJobStatus:
+        return EmailJobStatus(id=self.id, status=self.status, attempts=self.attempts, error=self.error)
+
+
+class EmailDispatcher:
+    """
+    Sends emails in the background over a single SMTP connection that is kept open between emails and
+    closed after idle_timeout_seconds without any. Jobs wait in a bounded queue, are sent in batches of
+    up to batch_size over the same connection, and failed ones are retried with exponential backoff.
+    Stopping sends what is queued for up to drain_timeout_seconds, the emails left are marked FAILED.
+    The jobs are kept in memory, so their status is only known by the process that queued them.
+    """
+
+    def __init__(self, conf: ConnectionConfig, max_queue_size: int, batch_size: int, max_attempts: int,
+                 retry_backoff_seconds: float, idle_timeout_seconds: float, jobs_kept: int,
+                 drain_timeout_seconds: float):
+        self.conf = conf
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_backoff_seconds = retry_backoff_seconds
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.jobs_kept = jobs_kept
+        self.drain_timeout_seconds = drain_timeout_seconds
+        self._queue = asyncio.Queue(max_queue_size)
+        self._jobs = OrderedDict()  # id -> EmailJob, the most recent ones, for the status endpoint
+        self._batch = []  # jobs taken from the queue and not done yet
+        self._retries = {}  # id -> (TimerHandle, EmailJob), the jobs waiting for their backoff
+        self._smtp = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._task.add_done_callback(self._task_done)
+
+    async def stop(self):
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._drain(), timeout=self.drain_timeout_seconds)
+            except asyncio.TimeoutError:
+                logger.warning("Emails still waiting to be sent after %s seconds, stopping anyway",
+                               self.drain_timeout_seconds)
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self._fail_unsent("The service stopped before the email was sent")
+        await self._disconnect()
+
+    async def _drain(self):
+        # there is no time left for the backoff, the retries are sent right away
+        while True:
+            for handle, job in list(self._retries.values()):
+                handle.cancel()
+                self._retry(job)
+            await self._queue.join()
+            if not self._retries:
+                return
+
+    def _fail_unsent(self, error: str):
+        unsent = self._batch + [job for _, job in self._retries.values()]
+        self._queue_done(len(self._batch))
+        self._batch = []
+        for handle, _ in self._retries.values():
+            handle.cancel()
+        self._retries.clear()
+        while not self._queue.empty():
+            unsent.append(self._queue.get_nowait())
+            self._queue_done(1)
+        for job in unsent:
+            if job.status in (EmailStatus.SENT, EmailStatus.FAILED):
+                continue
+            logger.error("Email %s was not sent, after %d attempts", job.id, job.attempts)
+            job.status = EmailStatus.FAILED
+            job.error = error
+
+    def _queue_done(self, jobs: int):
+        for _ in range(jobs):
+            self._queue.task_done()
+
+    def _task_done(self, task: asyncio.Task):
+        # the queued emails would never be sent otherwise
+        if task.cancelled() or task is not self._task:
+            return
+        logger.error("The email dispatcher stopped unexpectedly, restarting it", exc_info=task.exception())
+        # the batch it was sending isn't retried, whatever broke may break it again
+        unsent, self._batch = self._batch, []
+        self._queue_done(len(unsent))
+        for job in unsent:
+            if job.status not in (EmailStatus.SENT, EmailStatus.FAILED):
+                job.status = EmailStatus.FAILED
+                job.error = str(task.exception())
+        self._task = None
+        self.start()
+
+    def enqueue(self, owner_email: str, recipient: str, subject: str, html_body: str) -> EmailJob:
+        message = EmailMessage()
+        message["From"] = self.conf.MAIL_FROM
+        message["To"] = recipient
+        message["Subject"] = subject
+        message.set_content(html_body, subtype="html")
+
+        job = EmailJob(owner_email, message)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise EmailQueueFullError()
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.jobs_kept:
+            self._jobs.popitem(last=False)
+        return job
+
+    def get_job(self, job_id: str) -> EmailJob | None:
+        return self._jobs.get(job_id)
+
+    def queue_size(self) -> int:
+        return self._queue.qsize()
+
+    async def _connect(self):
+        if self._smtp is not None and self._smtp.is_connected:
+            return
+        self._smtp = aiosmtplib.SMTP(
+            hostname=self.conf.MAIL_SERVER,
+            port=self.conf.MAIL_PORT,
+            use_tls=self.conf.MAIL_SSL_TLS,
+            start_tls=self.conf.MAIL_STARTTLS,
+            validate_certs=self.conf.VALIDATE_CERTS,
+            timeout=self.conf.TIMEOUT
+        )
+        await self._smtp.connect()
+        if self.conf.USE_CREDENTIALS:
+            await self._smtp.login(self.conf.MAIL_USERNAME, self.conf.MAIL_PASSWORD)
+
+    async def _disconnect(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None and smtp.is_connected:
+            try:
+                await smtp.quit()
+            except (aiosmtplib.SMTPException, OSError):
+                smtp.close()
+
+    async def _run(self):
+        while True:
+            try:
+                job = await asyncio.wait_for(self._queue.get(), timeout=self.idle_timeout_seconds)
+            except asyncio.TimeoutError:
+                try:
+                    await self._disconnect()
+                except Exception:
+                    logger.exception("Closing the idle SMTP connection failed")
+                continue
+            self._batch = [job]
+            while len(self._batch) < self.batch_size and not self._queue.empty():
+                self._batch.append(self._queue.get_nowait())
+            while self._batch:
+                # left in the batch when cancelled while sending, for stop to mark it FAILED
+                job = self._batch[0]
+                try:
+                    await self._send(job)
+                except Exception as e:
+                    # not an SMTP or connection error, retrying wouldn't help
+                    logger.exception("Sending email %s failed unexpectedly", job.id)
+                    job.status = EmailStatus.FAILED
+                    job.error = str(e)
+                self._batch.pop(0)
+                self._queue.task_done()
+
+    async def _send(self, job: EmailJob):
+        job.status = EmailStatus.SENDING
+        job.attempts += 1
+        try:
+            await self._connect()
+            await self._smtp.send_message(job.message)
+        except (aiosmtplib.SMTPException, OSError) as e:
+            logger.warning("Sending email %s failed, attempt %d", job.id, job.attempts, exc_info=True)
+            # the connection may be broken, a new one is opened for the next email
+            await self._disconnect()
+            job.error = str(e)
+            if job.attempts >= self.max_attempts:
+                job.status = EmailStatus.FAILED
+                return
+            job.status = EmailStatus.QUEUED
+            delay = self.retry_backoff_seconds * 2 ** (job.attempts - 1)
+            self._retries[job.id] = (asyncio.get_running_loop().call_later(delay, self._retry, job), job)
+            return
+        job.status = EmailStatus.SENT
+        job.error = None
+
+    def _retry(self, job: EmailJob):
+        self._retries.pop(job.id, None)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            job.status = EmailStatus.FAILED
+
+
+email_dispatcher = EmailDispatcher(
+    email_config.conf, EMAIL_QUEUE_MAX_SIZE, EMAIL_BATCH_SIZE, EMAIL_MAX_ATTEMPTS,
+    EMAIL_RETRY_BACKOFF_SECONDS, EMAIL_IDLE_TIMEOUT_SECONDS, EMAIL_JOBS_KEPT, EMAIL_DRAIN_TIMEOUT_SECONDS
+)
@@ -0,0 +1,158 @@
+import base64
+import hashlib
+import hmac
+import os
+from collections import OrderedDict
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+
+from CalendarService import models, recurrence
+
+load_dotenv()
+
+# signs the feed tokens, the subscription links of every owner change if it changes
+FEED_TOKEN_SECRET = os.getenv("FEED_TOKEN_SECRET")
+FEED_PAST_DAYS = int(os.getenv("FEED_PAST_DAYS", "90"))
+FEED_CACHE_MAX_FEEDS = int(os.getenv("FEED_CACHE_MAX_FEEDS", "1024"))
+
+ICS_MEDIA_TYPE = "text/calendar; charset=utf-8"
+
+
+def create_feed_token(owner_email: str) -> str:
+    # <owner email>.<signature>, both base64url, so calendar apps can poll without a bearer token
+    encoded_email = base64.urlsafe_b64encode(owner_email.encode()).decode().rstrip("=")
+    return f"{encoded_email}.{_sign(encoded_email)}"
+
+
+def verify_feed_token(feed_token: str) -> str | None:
+    # the owner email of a valid token, None otherwise
+    # valid tokens are urlsafe base64, compare_digest only takes ASCII strings
+    if not feed_token.isascii():
+        return None
+    encoded_email, _, signature = feed_token.partition(".")
+    if not hmac.compare_digest(signature.encode(), _sign(encoded_email).encode()):
+        return None
+    try:
+        return base64.urlsafe_b64decode(encoded_email + "=" * (-len(encoded_email) % 4)).decode()
+    except ValueError:
+        return None
+
+
+def _sign(value: str) -> str:
+    digest = hmac.new(FEED_TOKEN_SECRET.encode(), value.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def feed_etag(revisions: dict[int, int], since: datetime) -> str:
+    # changes when an event of any property of the feed changes, or when old events leave the feed
+    revisions_key = ",".join(f"{property_id}:{revision}" for property_id, revision in sorted(revisions.items()))
+    digest = hashlib.sha1(f"{since.date()}|{revisions_key}".encode()).hexdigest()
+    return f'"{digest}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    return any(value.strip() in (etag, f"W/{etag}", "*") for value in if_none_match.split(","))
+
+
+def render_feed(name: str, events, since: datetime) -> str:
+    dtstamp = _format_datetime(datetime.now(timezone.utc).replace(tzinfo=None))
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//PropertEase//CalendarService//EN",
+        "CALSCALE:GREGORIAN",
+        f"X-WR-CALNAME:{_escape(name)}",
+    ]
+    for event in events:
+        for uid, begin_datetime, end_datetime in _occurrences(event, since):
+            lines.extend([
+                "BEGIN:VEVENT",
+                f"UID:{uid}@calendarservice.propertease",
+                f"DTSTAMP:{dtstamp}",
+                f"DTSTART:{_format_datetime(begin_datetime)}",
+                f"DTEND:{_format_datetime(end_datetime)}",
+                f"SUMMARY:{_escape(_summary(event))}",
+                f"STATUS:{_status(event)}",
+                "END:VEVENT",
+            ])
+    lines.append("END:VCALENDAR")
+    return "".join(_fold(line) + "\r\n" for line in lines)
+
+
+def _occurrences(event, since: datetime):
+    if not event.recurring:
+        return [(event.id, event.begin_datetime, event.end_datetime)]
+    # series are bounded, each occurrence is a VEVENT of its own
+    return [
+        (f"{event.id}-{_format_datetime(occurrence_begin_datetime)}", begin_datetime, end_datetime)
+        for occurrence_begin_datetime, begin_datetime, end_datetime in recurrence.expand(
+            event.begin_datetime, event.end_datetime, event.recurrence_rule, event.overrides, from_datetime=since)
+    ]
+
+
+def _summary(event) -> str:
+    match event.type:
+        case "reservation":
+            return f"Reservation {event.client_name} (property {event.property_id})"
+        case "cleaning":
+            return f"Cleaning {event.worker_name} (property {event.property_id})"
+        case "maintenance":
+            return f"Maintenance {event.company_name} (property {event.property_id})"
+    return f"Event (property {event.property_id})"
+
+
+def _status(event) -> str:
+    if event.type == "reservation" and event.reservation_status == models.ReservationStatus.PENDING:
+        return "TENTATIVE"
+    return "CONFIRMED"
+
+
+def _format_datetime(value: datetime) -> str:
+    # event datetimes are stored in UTC without timezone
+    return value.strftime("%Y%m%dT%H%M%SZ")
+
+
+def _escape(text) -> str:
+    return str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def _fold(line: str) -> str:
+    # lines longer than 75 octets continue on the next line after a space (RFC 5545 3.1)
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while len(encoded) > 0:
+        size = 75 if not parts else 74
+        # don't split a UTF-8 character
+        while size < len(encoded) and (encoded[size] & 0xC0) == 0x80:
+            size -= 1
+        parts.append(encoded[:size].decode())
+        encoded = encoded[size:]
+    return "\r\n ".join(parts)
+
+
+class FeedCache:
+    """Bounded LRU of the rendered feeds by (owner_email, property_id), each valid for the ETag it was rendered for."""
+
+    def __init__(self, max_feeds: int):
+        self.max_feeds = max_feeds
+        self._feeds = OrderedDict()  # (owner_email, property_id) -> (etag, body)
+
+    def get(self, owner_email: str, property_id: int | None, etag: str) -> str | None:
+        feed = self._feeds.get((owner_email, property_id))
+        if feed is None or feed[0] != etag:
+            return None
+        self._feeds.move_to_end((owner_email, property_id))
+        return feed[1]
+
+    def put(self, owner_email: str, property_id: int | None, etag: str, body: str):
+        self._feeds[(owner_email, property_id)] = (etag, body)
+        self._feeds.move_to_end((owner_email, property_id))
+        while len(self._feeds) > self.max_feeds:
+            self._feeds.popitem(last=False)
+
+
+feed_cache = FeedCache(FEED_CACHE_MAX_FEEDS)
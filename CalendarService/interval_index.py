@@ -0,0 +1,105 @@
+import os
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from datetime import timedelta
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OVERLAP_INDEX_ENABLED = os.getenv("OVERLAP_INDEX_ENABLED", "true").lower() == "true"
+OVERLAP_INDEX_MAX_PROPERTIES = int(os.getenv("OVERLAP_INDEX_MAX_PROPERTIES", "1024"))
+
+
+class IntervalIndex:
+    """
+    Sorted array of the [begin_datetime, end_datetime) periods of the events of a single property.
+    Overlap checks only look at the events that begin less than the longest event duration before the
+    checked period, so they take O(log n) plus the few candidates around it.
+    """
+
+    def __init__(self, events=()):
+        self._events = []  # (begin_datetime, event_id, end_datetime), sorted
+        self._begin_datetimes = []  # begin_datetime of self._events, for bisecting
+        self._periods_by_event_id = {}
+        self._max_duration = timedelta(0)
+        for event_id, begin_datetime, end_datetime in events:
+            self.add(event_id, begin_datetime, end_datetime)
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, event_id, begin_datetime, end_datetime):
+        if event_id is not None and event_id in self._periods_by_event_id:
+            self.remove(event_id)
+        entry = (begin_datetime, event_id if event_id is not None else -1, end_datetime)
+        position = bisect_left(self._events, entry)
+        self._events.insert(position, entry)
+        self._begin_datetimes.insert(position, begin_datetime)
+        if event_id is not None:
+            self._periods_by_event_id[event_id] = (begin_datetime, end_datetime)
+        self._max_duration = max(self._max_duration, end_datetime - begin_datetime)
+
+    def remove(self, event_id):
+        period = self._periods_by_event_id.pop(event_id, None)
+        if period is None:
+            return
+        begin_datetime, end_datetime = period
+        position = bisect_left(self._events, (begin_datetime, event_id, end_datetime))
+        del self._events[position]
+        del self._begin_datetimes[position]
+
+    def overlaps(self, begin_datetime, end_datetime, excluding_event_id=None) -> bool:
+        first = bisect_right(self._begin_datetimes, begin_datetime - self._max_duration)
+        last = bisect_left(self._begin_datetimes, end_datetime)
+        for event_begin_datetime, event_id, event_end_datetime in self._events[first:last]:
+            if event_end_datetime > begin_datetime and event_id != excluding_event_id:
+                return True
+        return False
+
+
+class IntervalIndexCache:
+    """Bounded LRU of IntervalIndex by (owner_email, property_id), warmed lazily by crud."""
+
+    def __init__(self, max_properties: int):
+        self.max_properties = max_properties
+        self._indexes = OrderedDict()
+
+    def get(self, owner_email: str, property_id: int) -> IntervalIndex | None:
+        index = self._indexes.get((owner_email, property_id))
+        if index is not None:
+            self._indexes.move_to_end((owner_email, property_id))
+        return index
+
+    def set(self, owner_email: str, property_id: int, index: IntervalIndex):
+        self._indexes[(owner_email, property_id)] = index
+        self._indexes.move_to_end((owner_email, property_id))
+        while len(self._indexes) > self.max_properties:
+            self._indexes.popitem(last=False)
+
+    def invalidate(self, owner_email: str, property_id: int):
+        self._indexes.pop((owner_email, property_id), None)
+
+    def clear(self):
+        self._indexes.clear()
+
+    def index_event(self, db_event):
+        # canceled events never block the period they were in, recurring ones aren't indexed
+        index = self.get(db_event.owner_email, db_event.property_id)
+        if index is None:
+            return
+        if db_event.canceled or db_event.recurring:
+            index.remove(db_event.id)
+        else:
+            index.add(db_event.id, db_event.begin_datetime, db_event.end_datetime)
+
+    def remove_event(self, db_event):
+        index = self.get(db_event.owner_email, db_event.property_id)
+        if index is not None:
+            index.remove(db_event.id)
+
+    def remove_event_id(self, event_id: int):
+        for index in self._indexes.values():
+            index.remove(event_id)
+
+
+interval_indexes = IntervalIndexCache(OVERLAP_INDEX_MAX_PROPERTIES)
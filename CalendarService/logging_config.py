@@ -0,0 +1,124 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# per subsystem, by logger name prefix, e.g. CalendarService.messaging_operations=DEBUG,CalendarService.crud=WARNING
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# fraction of the records below WARNING kept per subsystem, e.g. CalendarService.messaging_operations=0.01
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+# json, one object per line, or text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+
+# attributes every LogRecord has, the others were given with extra= and are logged as fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def parse_settings(settings: str, parse_value) -> dict:
+    parsed = {}
+    for setting in settings.split(","):
+        if "=" not in setting:
+            continue
+        name, value = setting.split("=", 1)
+        parsed[name.strip()] = parse_value(value.strip())
+    return parsed
+
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update({name: value for name, value in vars(record).items() if name not in RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = " ".join(f"{name}={value}" for name, value in vars(record).items() if name not in RECORD_ATTRIBUTES)
+        formatted = super().format(record)
+        return f"{formatted} {fields}" if fields else formatted
+
+
+class SamplingFilter(logging.Filter):
+    # keeps a fraction of the records below WARNING of the subsystems with a rate, the most specific name wins
+
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = sorted(rates.items(), key=lambda rate: len(rate[0]), reverse=True)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        for name, rate in self.rates:
+            if record.name == name or record.name.startswith(name + "."):
+                return random.random() < rate
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    """
+    Only puts the records in a queue, a QueueListener thread formats and writes them, so the event loop
+    never blocks on stdout. The message is merged with its args here, once the record passed the levels
+    and sampling, because the args may change or stop being usable after the call; the extra fields and
+    the exception are left for the listener's formatter.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = logging.makeLogRecord(vars(record))
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+listener = None
+
+
+def configure_logging():
+    # idempotent, called by the API and the worker before anything is logged
+    global listener
+    if listener is not None:
+        return
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(log_queue)
+    sampling = parse_settings(LOG_SAMPLING, float)
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [queue_handler]
+    root_logger.setLevel(LOG_LEVEL)
+    for name, level in parse_settings(LOG_LEVELS, str.upper).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    # writes what is still queued when the process exits
+    atexit.register(listener.stop)
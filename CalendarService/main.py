@@ -1,27 +1,57 @@
+import os
+
 import firebase_admin
-from fastapi import FastAPI, status
+from dotenv import load_dotenv
+from fastapi import FastAPI, status, Response
 from contextlib import asynccontextmanager
 
 from firebase_admin import credentials
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 
 from CalendarService import models
-from CalendarService.database import engine
-from CalendarService.messaging_operations import consume
+from CalendarService.logging_config import configure_logging
+from CalendarService.database import engine, SessionLocal
+from CalendarService.crud import initialize_rollups
+from CalendarService.migrations import migrate
+from CalendarService.messaging_operations import consume, publish_only, stop_messaging
+from CalendarService.email_dispatcher import email_dispatcher
 import asyncio
 from fastapi.middleware.cors import CORSMiddleware
 from CalendarService.routers.apirouter import api_router
+from CalendarService.routers.feedrouter import feed_router
+from CalendarService.routers.debugrouter import debug_router
+from CalendarService.profiler import ProfilingMiddleware, PROFILE_ID_HEADER
+from CalendarService.pagination import NEXT_CURSOR_HEADER
+
+load_dotenv()
+
+API_MESSAGING_MODE = os.getenv("API_MESSAGING_MODE", "consume")
+
+# before anything is logged
+configure_logging()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    async with engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+        await migrate(connection)
+    async with SessionLocal() as db:
+        await initialize_rollups(db)
     loop = asyncio.get_event_loop()
-    asyncio.ensure_future(consume(loop))
+    # with API_MESSAGING_MODE=publish the messages are consumed by CalendarService.worker processes instead
+    messaging = asyncio.ensure_future(publish_only(loop) if API_MESSAGING_MODE == "publish" else consume(loop))
+    email_dispatcher.start()
     yield
+    await email_dispatcher.stop()
+    if messaging.done() and messaging.exception() is None:
+        await stop_messaging(messaging.result())
+    else:
+        messaging.cancel()
 
 
 cred = credentials.Certificate(".secret.json")
 firebase_admin.initialize_app(cred)
-models.Base.metadata.create_all(bind=engine)
 app = FastAPI(
     lifespan=lifespan, 
     root_path="/api/CalendarService",
@@ -39,7 +69,10 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag", PROFILE_ID_HEADER],
 )
+# only does something with PROFILING_ENABLED
+app.add_middleware(ProfilingMiddleware)
 
 
 @app.get("/health", tags=["healthcheck"], summary="Perform a Health Check",
@@ -48,5 +81,13 @@ def get_health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", tags=["healthcheck"], summary="Prometheus metrics",
+         description="Request, database, consumer and publisher metrics of this process, in the Prometheus text format.")
+def get_metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 app.include_router(api_router)
+app.include_router(feed_router)
+app.include_router(debug_router)
 
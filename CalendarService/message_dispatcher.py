@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import zlib
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedMessageDispatcher:
+    """
+    Processes incoming messages on worker_count workers. Messages with the same shard key always go to the
+    same worker, so they are processed in the order they arrived, while unrelated keys run in parallel.
+    The amount of messages waiting in the workers' queues is bounded by the channel prefetch count.
+    """
+
+    def __init__(self, worker_count: int):
+        self.worker_count = worker_count
+        self._queues = []
+        self._workers = []
+
+    def start(self):
+        if self._workers:
+            return
+        self._queues = [asyncio.Queue() for _ in range(self.worker_count)]
+        self._workers = [asyncio.create_task(self._work(queue)) for queue in self._queues]
+
+    async def dispatch(self, shard_key, incoming_message, handler, message):
+        # crc32 instead of hash(), to shard the same way in every process
+        queue = self._queues[zlib.crc32(str(shard_key).encode()) % self.worker_count]
+        await queue.put((incoming_message, handler, message))
+
+    def backlog(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    async def join(self):
+        # wait for every dispatched message to be processed
+        await asyncio.gather(*(queue.join() for queue in self._queues))
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queues = []
+
+    @staticmethod
+    async def _work(queue: asyncio.Queue):
+        while True:
+            incoming_message, handler, message = await queue.get()
+            try:
+                # acked when the handler succeeds, rejected when it raises
+                async with incoming_message.process():
+                    await handler(message)
+            except Exception:
+                logger.exception("Processing message %s failed, rejected", message.message_type)
+            finally:
+                queue.task_done()
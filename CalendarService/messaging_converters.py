@@ -1,4 +1,5 @@
 from CalendarService.schemas import Reservation, Service
+from ProjectUtils.MessagingService.schemas import MessageFactory, MessageType
 
 
 def from_reservation_create(service_value: str, reservation_dict: dict):
@@ -15,3 +16,21 @@ def from_reservation_create(service_value: str, reservation_dict: dict):
         cost=reservation_dict["cost"],
         reservation_status=reservation_dict["reservation_status"]
     )
+
+
+def to_management_event_creation_message(db_event):
+    return MessageFactory.create_management_event_creation_update_message(
+        MessageType.MANAGEMENT_EVENT_CREATE,
+        db_event.property_id, db_event.id, db_event.begin_datetime, db_event.end_datetime
+    )
+
+
+def to_management_event_update_message(db_event):
+    return MessageFactory.create_management_event_creation_update_message(
+        MessageType.MANAGEMENT_EVENT_UPDATE,
+        db_event.property_id, db_event.id, db_event.begin_datetime, db_event.end_datetime
+    )
+
+
+def to_management_event_deletion_message(db_event):
+    return MessageFactory.create_management_event_deletion_message(db_event.property_id, db_event.id)
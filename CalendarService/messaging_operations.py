@@ -1,9 +1,20 @@
+import asyncio
+import logging
+import os
+from collections import defaultdict
+
 from aio_pika import connect_robust, ExchangeType
 
-from CalendarService.crud import create_reservation, there_are_overlapping_events, get_reservation_by_external_id, \
-    update_reservation_status
+from CalendarService.crud import build_reservation
 from CalendarService.database import SessionLocal
+from CalendarService.interval_index import IntervalIndex
+from CalendarService.metrics import CONSUMER_BACKLOG, consumed_message
+from CalendarService.profiler import consumer_profiling
+from CalendarService.message_dispatcher import ShardedMessageDispatcher
 from CalendarService.messaging_converters import from_reservation_create
+from CalendarService.ownership_cache import ownership_cache
+from CalendarService.outbox import outbox_relay
+from CalendarService.publishing import publish_in_order
 from ProjectUtils.MessagingService.queue_definitions import (
     channel,
     EXCHANGE_NAME,
@@ -11,139 +22,268 @@ from ProjectUtils.MessagingService.queue_definitions import (
     PROPERTY_TO_CALENDAR_ROUTING_KEY, PROPERTY_TO_CALENDAR_QUEUE
 )
 from ProjectUtils.MessagingService.schemas import from_json, MessageType, MessageFactory, to_json_aoi_bytes
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from . import crud
+from dotenv import load_dotenv
 from CalendarService import models
 
+load_dotenv()
+
+IMPORT_RESERVATIONS_ATTEMPTS = 3
+CONSUMER_PREFETCH_COUNT = int(os.getenv("CONSUMER_PREFETCH_COUNT", "32"))
+CONSUMER_WORKERS = int(os.getenv("CONSUMER_WORKERS", "8"))
+PUBLISH_BATCH_SIZE = int(os.getenv("PUBLISH_BATCH_SIZE", "100"))
+CONSUMER_DRAIN_TIMEOUT_SECONDS = float(os.getenv("CONSUMER_DRAIN_TIMEOUT_SECONDS", "30"))
+
+logger = logging.getLogger(__name__)
+
+message_dispatcher = ShardedMessageDispatcher(CONSUMER_WORKERS)
+# (queue, consumer_tag) of the running consumers
+consumers = []
+
 # TODO: fix this in the future
 channel.close()  # don't use the channel from this file, we need to use an async channel
 
 
-async def consume(loop):
+async def connect(loop):
+    # enough to publish, the outbox relay publishes what the transactions of this process commit
     global async_exchange
 
     connection = await connect_robust(host="rabbit_mq", loop=loop)
     async_channel = await connection.channel()
 
-    wrappers_queue = await async_channel.declare_queue(WRAPPER_TO_CALENDAR_QUEUE, durable=True)
-    email_property_id_mapping_queue = await async_channel.declare_queue(PROPERTY_TO_CALENDAR_QUEUE, durable=True)
-
     async_exchange = await async_channel.declare_exchange(
         name=EXCHANGE_NAME, type=ExchangeType.TOPIC, durable=True
     )
 
+    outbox_relay.start(async_exchange)
+
+    return connection, async_channel
+
+
+async def publish_only(loop):
+    connection, _ = await connect(loop)
+    return connection
+
+
+async def consume(loop, prefetch_count: int = CONSUMER_PREFETCH_COUNT):
+    connection, async_channel = await connect(loop)
+
+    wrappers_queue = await async_channel.declare_queue(WRAPPER_TO_CALENDAR_QUEUE, durable=True)
+    email_property_id_mapping_queue = await async_channel.declare_queue(PROPERTY_TO_CALENDAR_QUEUE, durable=True)
+
     await wrappers_queue.bind(exchange=EXCHANGE_NAME, routing_key=WRAPPER_TO_CALENDAR_ROUTING_KEY)
     await email_property_id_mapping_queue.bind(exchange=EXCHANGE_NAME, routing_key=PROPERTY_TO_CALENDAR_ROUTING_KEY)
 
-    await wrappers_queue.consume(callback=consume_wrappers_message)
-    await email_property_id_mapping_queue.consume(callback=consume_properties_message)
+    # unacked messages the broker hands us at once, which also bounds the dispatcher queues
+    await async_channel.set_qos(prefetch_count=prefetch_count)
+    message_dispatcher.start()
+
+    consumers.append((wrappers_queue, await wrappers_queue.consume(callback=on_wrappers_message)))
+    consumers.append((email_property_id_mapping_queue,
+                      await email_property_id_mapping_queue.consume(callback=on_properties_message)))
 
     return connection
 
 
-async def consume_wrappers_message(incoming_message):
-    async with incoming_message.process():
+async def stop_messaging(connection, drain_timeout_seconds: float = CONSUMER_DRAIN_TIMEOUT_SECONDS):
+    # stop receiving, then let the workers finish the messages they already have, they need the channel to ack
+    while consumers:
+        queue, consumer_tag = consumers.pop()
+        await queue.cancel(consumer_tag)
+    try:
+        await asyncio.wait_for(message_dispatcher.join(), timeout=drain_timeout_seconds)
+    except asyncio.TimeoutError:
+        # the unacked messages are redelivered by the broker once the connection is closed
+        logger.warning("Messages still being processed after %ss, stopping anyway", drain_timeout_seconds)
+    await message_dispatcher.stop()
+    await outbox_relay.stop()
+    try:
+        # publish what the drained messages committed, whatever is left is relayed by another process
+        while await outbox_relay.relay_batch() == outbox_relay.batch_size:
+            pass
+    except Exception:
+        logger.exception("Relaying the outbox while stopping failed, left for another process")
+    await connection.close()
+
+
+async def on_wrappers_message(incoming_message):
+    try:
+        message = from_json(incoming_message.body)
+    except Exception:
+        # it would stay unacked forever otherwise
+        await incoming_message.reject()
+        raise
+    CONSUMER_BACKLOG.labels("wrappers").inc()
+    await message_dispatcher.dispatch(
+        wrappers_message_shard_key(message), incoming_message, consume_wrappers_message, message
+    )
+
+
+async def on_properties_message(incoming_message):
+    try:
         message = from_json(incoming_message.body)
-        print("\nconsume_wrappers_message", message.__dict__)
-        with SessionLocal() as db:
+    except Exception:
+        await incoming_message.reject()
+        raise
+    CONSUMER_BACKLOG.labels("properties").inc()
+    await message_dispatcher.dispatch(
+        properties_message_shard_key(message), incoming_message, consume_properties_message, message
+    )
+
+
+def wrappers_message_shard_key(message):
+    # the events of a property all belong to its owner, so ordering by owner keeps the overlap decisions in order
+    body = message.body
+    if message.message_type == MessageType.RESERVATION_IMPORT and len(body["reservations"]) > 0:
+        return body["reservations"][0]["owner_email"]
+    return body.get("service")
+
+
+def properties_message_shard_key(message):
+    return message.body.get("email")
+
+
+async def consume_wrappers_message(message):
+    logger.debug("Consuming wrappers message %s", message.message_type, extra={"body": message.body})
+    with consumed_message("wrappers", message.message_type), \
+            consumer_profiling(f"consume_wrappers_message {message.message_type}"):
+        async with SessionLocal() as db:
             body = message.body
             match message.message_type:
                 case MessageType.RESERVATION_IMPORT:
                     await import_reservations(db, body["service"], body["reservations"])
                 case MessageType.RESERVATION_IMPORT_REQUEST_OTHER_SERVICES_CONFIRMED_RESERVATIONS:
-                    for property_id in body["properties_ids"]:
-                        for reservation in crud.get_confirmed_reservations_by_property_id(db, property_id):
-                            await async_exchange.publish(
-                                routing_key=routing_key_by_service[body["service"]],
-                                message=to_json_aoi_bytes(MessageFactory.create_confirm_reservation_message({
-                                    "_id": reservation.external_id,
-                                    "property_id": reservation.property_id,
-                                    "begin_datetime": reservation.begin_datetime.strftime("%Y-%m-%dT%H:%M:%S"),
-                                    "end_datetime": reservation.end_datetime.strftime("%Y-%m-%dT%H:%M:%S"),
-                                }))
-                            )
-
-
-async def import_reservations(db: Session, service_value: str, reservations):
-    for reservation in reservations:
-        print("reservation", reservation)
-        reservation_schema = from_reservation_create(service_value, reservation)
+                    await publish_confirmed_reservations(db, body["service"], body["properties_ids"])
+
+
+async def publish_confirmed_reservations(db: AsyncSession, service_value: str, properties_ids):
+    routing_key = routing_key_by_service[service_value]
+    messages = []
+    async for reservation in crud.stream_confirmed_reservations_by_property_ids(db, properties_ids):
+        messages.append((routing_key, MessageFactory.create_confirm_reservation_message({
+            "_id": reservation.external_id,
+            "property_id": reservation.property_id,
+            "begin_datetime": reservation.begin_datetime.strftime("%Y-%m-%dT%H:%M:%S"),
+            "end_datetime": reservation.end_datetime.strftime("%Y-%m-%dT%H:%M:%S"),
+        })))
+        if len(messages) >= PUBLISH_BATCH_SIZE:
+            await publish_batch(messages)
+            messages = []
+    await publish_batch(messages)
+
+
+async def publish_batch(messages):
+    # in order, like the outbox relay, with the publisher confirms of each chunk awaited together
+    for first in range(0, len(messages), PUBLISH_BATCH_SIZE):
+        await publish_in_order(async_exchange, [
+            (routing_key, to_json_aoi_bytes(message))
+            for routing_key, message in messages[first:first + PUBLISH_BATCH_SIZE]
+        ])
+
+
+async def import_reservations(db: AsyncSession, service_value: str, reservations):
+    for attempt in range(IMPORT_RESERVATIONS_ATTEMPTS):
+        try:
+            return await import_reservations_batch(db, service_value, reservations)
+        except crud.OverlappingEventsError:
+            # an event was committed concurrently, redo the batch against the new state of the database
+            if attempt == IMPORT_RESERVATIONS_ATTEMPTS - 1:
+                raise
+
+
+async def import_reservations_batch(db: AsyncSession, service_value: str, reservations):
+    reservation_schemas = [from_reservation_create(service_value, reservation) for reservation in reservations]
+
+    # one lookup for the reservations that may have to be canceled
+    reservations_by_external_id = await crud.get_reservations_by_external_ids(
+        db, {reservation_schema.external_id for reservation_schema in reservation_schemas
+             if reservation_schema.reservation_status == "canceled"}
+    )
+
+    # one lookup for every event that may overlap the imported reservations
+    property_indexes = defaultdict(IntervalIndex)
+    reservations_to_check = [reservation_schema for reservation_schema in reservation_schemas
+                             if reservation_schema.reservation_status != "canceled"]
+    if len(reservations_to_check) > 0:
+        for event in await crud.get_events_by_owner_email_and_property_ids_in_period(
+                db,
+                {(reservation_schema.owner_email, reservation_schema.property_id)
+                 for reservation_schema in reservations_to_check},
+                min(reservation_schema.begin_datetime for reservation_schema in reservations_to_check),
+                max(reservation_schema.end_datetime for reservation_schema in reservations_to_check)
+        ):
+            property_indexes[(event.owner_email, event.property_id)].add(
+                event.id, event.begin_datetime, event.end_datetime)
+
+    new_reservations = []
+    # reservations of this batch don't have an id yet, they are indexed with negative ones
+    index_ids = {}
+    canceled_reservation_ids = set()
+    messages = []
+    for reservation, reservation_schema in zip(reservations, reservation_schemas):
+        logger.debug("Importing reservation %s", reservation["_id"], extra={"reservation": reservation})
+        event_key = (reservation_schema.owner_email, reservation_schema.property_id)
         if reservation_schema.reservation_status == "canceled":
             # canceled -> either cancelling existing reservation or importing canceled reservation
-            reservation_with_same_id = get_reservation_by_external_id(db, reservation_schema.external_id)
+            reservation_with_same_id = reservations_by_external_id.get(reservation_schema.external_id)
             if reservation_with_same_id is not None:
                 # if the reservation already exists
                 # there is the chance that is already propagated to other services
-                print("before_update", reservation_with_same_id.__dict__)
-                print("after_cancelled",
-                      update_reservation_status(db, reservation_with_same_id, models.ReservationStatus.CANCELED))
-                await async_exchange.publish(
-                    routing_key=WRAPPER_BROADCAST_ROUTING_KEY,
-                    message=to_json_aoi_bytes(MessageFactory.create_cancel_reservation_message(reservation))
-                )
-            else:
-                reservation_schema.reservation_status = "canceled"
-                create_reservation(db, reservation_schema)
+                if reservation_with_same_id.id is not None:
+                    canceled_reservation_ids.add(reservation_with_same_id.id)
+                    property_indexes[(reservation_with_same_id.owner_email, reservation_with_same_id.property_id)] \
+                        .remove(reservation_with_same_id.id)
+                else:
+                    reservation_with_same_id.reservation_status = models.ReservationStatus.CANCELED
+                    reservation_with_same_id.canceled = True
+                    property_indexes[(reservation_with_same_id.owner_email, reservation_with_same_id.property_id)] \
+                        .remove(index_ids.get(reservation_with_same_id.external_id))
+                messages.append((WRAPPER_BROADCAST_ROUTING_KEY,
+                                 MessageFactory.create_cancel_reservation_message(reservation)))
+                continue
         else:
             # confirmed -> already confirmed on external service and are now just importing it
             # pending   -> external service awaiting CalendarService confirmation
-            if there_are_overlapping_events(db, reservation_schema):
-                print("overlapping event", reservation_schema.__dict__)
-                await async_exchange.publish(
-                    routing_key=routing_key_by_service[service_value],
-                    message=to_json_aoi_bytes(MessageFactory.create_overlap_import_reservation_message(reservation))
-                )
+            if property_indexes[event_key].overlaps(reservation_schema.begin_datetime, reservation_schema.end_datetime):
+                # overlaps an existing event or one imported earlier in this batch
+                logger.info("Imported reservation %s overlaps another event", reservation_schema.external_id,
+                            extra={"property_id": reservation_schema.property_id})
+                messages.append((routing_key_by_service[service_value],
+                                 MessageFactory.create_overlap_import_reservation_message(reservation)))
                 reservation_schema.reservation_status = "canceled"
-                create_reservation(db, reservation_schema)
-            else:
-                if reservation_schema.reservation_status == "pending":
-                    reservation_schema.reservation_status = "confirmed"
-                    await async_exchange.publish(
-                        routing_key=WRAPPER_BROADCAST_ROUTING_KEY,
-                        message=to_json_aoi_bytes(MessageFactory.create_confirm_reservation_message(reservation))
-                    )
-                create_reservation(db, reservation_schema)
-
-
-async def propagate_event_creation_to_wrappers(db_event):
-    await async_exchange.publish(
-        routing_key=WRAPPER_BROADCAST_ROUTING_KEY,
-        message=to_json_aoi_bytes(
-            MessageFactory.create_management_event_creation_update_message(
-                MessageType.MANAGEMENT_EVENT_CREATE,
-                db_event.property_id, db_event.id, db_event.begin_datetime, db_event.end_datetime
-            )
-        )
-    )
-
-
-async def propagate_event_update_to_wrappers(db_event):
-    await async_exchange.publish(
-        routing_key=WRAPPER_BROADCAST_ROUTING_KEY,
-        message=to_json_aoi_bytes(
-            MessageFactory.create_management_event_creation_update_message(
-                MessageType.MANAGEMENT_EVENT_UPDATE,
-                db_event.property_id, db_event.id, db_event.begin_datetime, db_event.end_datetime
-            )
-        )
-    )
+            elif reservation_schema.reservation_status == "pending":
+                reservation_schema.reservation_status = "confirmed"
+                messages.append((WRAPPER_BROADCAST_ROUTING_KEY,
+                                 MessageFactory.create_confirm_reservation_message(reservation)))
 
+        db_reservation = build_reservation(reservation_schema)
+        new_reservations.append(db_reservation)
+        reservations_by_external_id[db_reservation.external_id] = db_reservation
+        if not db_reservation.canceled:
+            # blocks the period for the following reservations of the batch
+            index_ids[db_reservation.external_id] = -len(new_reservations)
+            property_indexes[event_key].add(
+                index_ids[db_reservation.external_id], db_reservation.begin_datetime, db_reservation.end_datetime)
 
-async def propagate_event_deletion_to_wrappers(db_event):
-    await async_exchange.publish(
-        routing_key=WRAPPER_BROADCAST_ROUTING_KEY,
-        message=to_json_aoi_bytes(
-            MessageFactory.create_management_event_deletion_message(db_event.property_id, db_event.id)
-        )
-    )
+    # the confirm/cancel/overlap messages are committed with the batch, and published by the outbox relay
+    await crud.import_reservations(db, new_reservations, canceled_reservation_ids, messages)
 
 
-async def consume_properties_message(incoming_message):
-    async with incoming_message.process():
-        message = from_json(incoming_message.body)
-        print("\nconsume_properties_message", message.__dict__)
-        with SessionLocal() as db:
+async def consume_properties_message(message):
+    logger.debug("Consuming properties message %s", message.message_type, extra={"body": message.body})
+    with consumed_message("properties", message.message_type), \
+            consumer_profiling(f"consume_properties_message {message.message_type}"):
+        async with SessionLocal() as db:
             body = message.body
             match message.message_type:
                 case MessageType.EMAIL_PROPERTY_ID_MAPPING:
-                    crud.add_to_email_property_id_mapping(db, body["email"], body["property_id"])
+                    owner_email = await crud.get_owner_email_by_property_id(db, body["property_id"])
+                    if owner_email is not None and owner_email != body["email"]:
+                        # a property has a single owner, its events would be split between both otherwise
+                        logger.warning("Property %s is already owned by another email, ignoring its mapping",
+                                       body["property_id"], extra={"email": body["email"]})
+                        return
+                    if owner_email is None:
+                        await crud.add_to_email_property_id_mapping(db, body["email"], body["property_id"])
+                    ownership_cache.add(body["email"], body["property_id"])
@@ -0,0 +1,157 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from fastapi.routing import APIRoute
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+HTTP_REQUEST_DURATION = Histogram(
+    "calendar_http_request_duration_seconds", "Time spent handling a request, by route.",
+    ["method", "route", "status"]
+)
+DB_QUERIES_PER_REQUEST = Histogram(
+    "calendar_db_queries_per_request", "Queries sent to the database while handling a request.",
+    ["method", "route"], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, float("inf"))
+)
+DB_QUERY_TIME_PER_REQUEST = Histogram(
+    "calendar_db_query_time_per_request_seconds", "Time spent in database queries while handling a request.",
+    ["method", "route"]
+)
+DB_QUERY_DURATION = Histogram("calendar_db_query_duration_seconds", "Time spent in each database query.")
+DB_QUERY_ERRORS = Counter("calendar_db_query_errors_total", "Database queries that raised.")
+DB_POOL_CHECKOUT_WAIT = Histogram(
+    "calendar_db_pool_checkout_wait_seconds", "Time waited for a connection of the pool, including connecting.",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+)
+DB_POOL_CHECKED_OUT = Gauge("calendar_db_pool_checked_out_connections", "Connections of the pool in use.")
+CONSUMER_PROCESSING_DURATION = Histogram(
+    "calendar_consumer_processing_duration_seconds", "Time spent processing a consumed message.",
+    ["consumer", "message_type", "outcome"]
+)
+CONSUMER_BACKLOG = Gauge(
+    "calendar_consumer_backlog_messages", "Messages received from the broker and not processed yet.", ["consumer"]
+)
+PUBLISH_DURATION = Histogram(
+    "calendar_publish_duration_seconds", "Time until a published message is confirmed by the broker.",
+    ["routing_key", "outcome"]
+)
+TOKEN_CACHE_HITS = Counter("calendar_token_cache_hits_total", "Tokens found verified in the token cache.")
+TOKEN_CACHE_MISSES = Counter("calendar_token_cache_misses_total", "Tokens not in the token cache, or expired.")
+
+
+class RequestQueries:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+# queries of the request being handled, SQLAlchemy runs the queries in the context of the awaiting task
+request_queries: ContextVar[RequestQueries | None] = ContextVar("request_queries", default=None)
+
+
+class TimedRoute(APIRoute):
+    """
+    Observes the latency and the database queries of every request of the routes of a router.
+    The body of a streamed response is sent after the handler returned, so it isn't included.
+    """
+
+    def get_route_handler(self):
+        route_handler = super().get_route_handler()
+
+        async def timed_route_handler(request):
+            queries = RequestQueries()
+            token = request_queries.set(queries)
+            status_code = 500
+            started = time.perf_counter()
+            try:
+                response = await route_handler(request)
+                status_code = response.status_code
+                return response
+            except HTTPException as e:
+                status_code = e.status_code
+                raise
+            except RequestValidationError:
+                status_code = 422
+                raise
+            finally:
+                HTTP_REQUEST_DURATION.labels(request.method, self.path_format, status_code).observe(
+                    time.perf_counter() - started)
+                DB_QUERIES_PER_REQUEST.labels(request.method, self.path_format).observe(queries.count)
+                DB_QUERY_TIME_PER_REQUEST.labels(request.method, self.path_format).observe(queries.seconds)
+                request_queries.reset(token)
+
+        return timed_route_handler
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    # the checkout event only fires once a connection was obtained, so the wait is timed here
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine):
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        observe_query(connection)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        DB_QUERY_ERRORS.inc()
+        if exception_context.connection is not None:
+            observe_query(exception_context.connection)
+
+    # the pool is replaced when the engine is disposed
+    DB_POOL_CHECKED_OUT.set_function(lambda: engine.pool.checkedout())
+
+
+def observe_query(connection):
+    query_started = connection.info.get("query_started")
+    if not query_started:
+        return
+    seconds = time.perf_counter() - query_started.pop()
+    DB_QUERY_DURATION.observe(seconds)
+    queries = request_queries.get()
+    if queries is not None:
+        queries.count += 1
+        queries.seconds += seconds
+
+
+@contextmanager
+def consumed_message(consumer: str, message_type):
+    # the message was counted in the backlog when it was received
+    outcome = "error"
+    started = time.perf_counter()
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        CONSUMER_PROCESSING_DURATION.labels(consumer, str(message_type), outcome).observe(
+            time.perf_counter() - started)
+        CONSUMER_BACKLOG.labels(consumer).dec()
+
+
+async def timed_publish(exchange, message, routing_key: str):
+    outcome = "error"
+    started = time.perf_counter()
+    try:
+        result = await exchange.publish(message, routing_key=routing_key)
+        outcome = "ok"
+        return result
+    finally:
+        PUBLISH_DURATION.labels(routing_key, outcome).observe(time.perf_counter() - started)
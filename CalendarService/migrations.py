@@ -0,0 +1,79 @@
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.schema import AddConstraint, CreateIndex
+
+from CalendarService import models
+
+logger = logging.getLogger(__name__)
+
+# same key whatever the process, so the API and worker processes starting together migrate one after another
+MIGRATION_LOCK_KEY = "calendar_service_migrations"
+
+
+async def migrate(connection: AsyncConnection):
+    """
+    Brings the tables of a database created by an older version up to date. create_all only creates the
+    missing tables, never the columns, indexes or constraints of the existing ones. Every step is skipped
+    when already applied, so it runs after create_all on every startup.
+    """
+    await connection.execute(text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": MIGRATION_LOCK_KEY})
+    await connection.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gist"))
+
+    if not await column_exists(connection, "base_event", "canceled"):
+        logger.info("Adding base_event.canceled")
+        await connection.execute(text("ALTER TABLE base_event ADD COLUMN canceled boolean NOT NULL DEFAULT false"))
+        # the canceled reservations stop blocking their period
+        await connection.execute(text("""
+            UPDATE base_event SET canceled = true FROM reservation
+            WHERE reservation.id = base_event.id AND reservation.reservation_status = 'CANCELED'
+        """))
+    await connection.execute(text(
+        "ALTER TABLE base_event ADD COLUMN IF NOT EXISTS recurring boolean NOT NULL DEFAULT false"
+    ))
+    await connection.execute(text(
+        "ALTER TABLE base_event ADD COLUMN IF NOT EXISTS period tsrange "
+        "GENERATED ALWAYS AS (tsrange(begin_datetime, end_datetime, '[)')) STORED"
+    ))
+    await connection.execute(text("ALTER TABLE management_event ADD COLUMN IF NOT EXISTS recurrence_rule varchar"))
+    await connection.execute(text("ALTER TABLE management_event ADD COLUMN IF NOT EXISTS recurrence_end timestamp"))
+
+    for index in models.BaseEvent.__table__.indexes:
+        await connection.execute(CreateIndex(index, if_not_exists=True))
+    if not await constraint_exists(connection, "base_event_no_overlap"):
+        # fails while the table still has overlapping events, they have to be canceled or moved by hand first
+        logger.info("Adding the base_event_no_overlap exclusion constraint")
+        no_overlap = next(constraint for constraint in models.BaseEvent.__table__.constraints
+                          if constraint.name == "base_event_no_overlap")
+        await connection.execute(AddConstraint(no_overlap))
+
+    if await table_exists(connection, "email_property_id_mapping"):
+        # one ARRAY of property ids per email before, kept under another name once copied
+        logger.info("Copying email_property_id_mapping into email_property_id")
+        await connection.execute(text("""
+            INSERT INTO email_property_id (email, property_id)
+            SELECT email, unnest(properties_ids) FROM email_property_id_mapping
+            ON CONFLICT DO NOTHING
+        """))
+        await connection.execute(text(
+            "ALTER TABLE email_property_id_mapping RENAME TO email_property_id_mapping_migrated"
+        ))
+
+
+async def column_exists(connection: AsyncConnection, table_name: str, column_name: str) -> bool:
+    return await connection.scalar(text("""
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = :table_name AND column_name = :column_name
+        )
+    """), {"table_name": table_name, "column_name": column_name})
+
+
+async def constraint_exists(connection: AsyncConnection, constraint_name: str) -> bool:
+    return await connection.scalar(text("SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = :name)"),
+                                   {"name": constraint_name})
+
+
+async def table_exists(connection: AsyncConnection, table_name: str) -> bool:
+    return await connection.scalar(text("SELECT to_regclass(:table_name) IS NOT NULL"), {"table_name": table_name})
@@ -1,8 +1,9 @@
-from sqlalchemy import Column, Integer, String, DateTime, Enum, Float, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Date, DateTime, Enum, Float, ForeignKey, Boolean, Computed, DDL, event, \
+    false, text, Index, LargeBinary, func
 from enum import Enum as EnumType
 from .database import Base
-from sqlalchemy.dialects.postgresql import ARRAY
-from sqlalchemy.ext.mutable import MutableList
+from sqlalchemy.dialects.postgresql import TSRANGE, ExcludeConstraint
+from sqlalchemy.orm import deferred, relationship
 
 class Service(EnumType):
     ZOOKING = "zooking"
@@ -11,9 +12,10 @@ class Service(EnumType):
 
 
 class EmailPropertyIdMapping(Base):
-    __tablename__ = "email_property_id_mapping"
+    # one row per owned property, the primary key keeps (email, property_id) unique
+    __tablename__ = "email_property_id"
     email = Column(String, primary_key=True)
-    properties_ids = Column(MutableList.as_mutable(ARRAY(Integer)))
+    property_id = Column(Integer, primary_key=True, index=True)
 
 
 class BaseEvent(Base):
@@ -22,12 +24,35 @@ class BaseEvent(Base):
         "polymorphic_on": "type",
         "polymorphic_identity": "base_event",
     }
+    __table_args__ = (
+        # two events that aren't canceled can never overlap on the same property,
+        # the occurrences of the recurring ones are checked by crud instead
+        ExcludeConstraint(
+            ("owner_email", "="), ("property_id", "="), ("period", "&&"),
+            name="base_event_no_overlap", using="gist", where=text("NOT canceled AND NOT recurring")
+        ),
+        # time windows and keyset pagination of the event listings
+        Index("ix_base_event_owner_email_begin_datetime_id", "owner_email", "begin_datetime", "id"),
+        Index("ix_base_event_owner_email_property_id_begin_datetime_id",
+              "owner_email", "property_id", "begin_datetime", "id"),
+        Index("ix_base_event_owner_email_period", "owner_email", "period", postgresql_using="gist"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     property_id = Column(Integer, index=True)
     owner_email = Column(String)
     begin_datetime = Column(DateTime)
     end_datetime = Column(DateTime)
     type = Column(String)
+    # only reservations get canceled, kept here so the exclusion constraint can use it
+    canceled = Column(Boolean, nullable=False, default=False, server_default=false())
+    # only management events are recurring, kept here so the exclusion constraint can use it
+    recurring = Column(Boolean, nullable=False, default=False, server_default=false())
+    # only used by queries, never loaded into the objects
+    period = deferred(Column(TSRANGE, Computed("tsrange(begin_datetime, end_datetime, '[)')", persisted=True)))
+
+
+# btree_gist is needed for the "=" operators of the exclusion constraint
+event.listen(BaseEvent.__table__, "before_create", DDL("CREATE EXTENSION IF NOT EXISTS btree_gist"))
 
 
 class InternalEvent(BaseEvent):
@@ -56,6 +81,22 @@ class ManagementEvent(InternalEvent):
         # polymorphic_identity will be overwritten by the subclasses
     }
     id = Column(Integer, ForeignKey("internal_event.id"), primary_key=True)
+    # for recurring events, begin_datetime and end_datetime are those of the first occurrence, see recurrence.py
+    recurrence_rule = Column(String, nullable=True)
+    # end of the last occurrence, to find the series that may have occurrences in a period
+    recurrence_end = Column(DateTime, nullable=True)
+    overrides = relationship("OccurrenceOverride", lazy="selectin", cascade="all, delete-orphan",
+                             passive_deletes=True)
+
+
+class OccurrenceOverride(Base):
+    # an occurrence of a recurring management event that was canceled or moved to another period
+    __tablename__ = "occurrence_override"
+    event_id = Column(Integer, ForeignKey("management_event.id", ondelete="CASCADE"), primary_key=True)
+    occurrence_begin_datetime = Column(DateTime, primary_key=True)
+    canceled = Column(Boolean, nullable=False, default=False)
+    begin_datetime = Column(DateTime)
+    end_datetime = Column(DateTime)
 
 
 class Maintenance(ManagementEvent):
@@ -98,3 +139,43 @@ class Reservation(ExternalEvent):
 
 
 management_event_types = [management_event.__tablename__ for management_event in ManagementEvent.__subclasses__()]
+
+
+class OccupancyBitmap(Base):
+    # one bit per hour of the year of a property, set when an event that isn't canceled occupies part of it
+    __tablename__ = "occupancy_bitmap"
+    owner_email = Column(String, primary_key=True)
+    property_id = Column(Integer, primary_key=True)
+    year = Column(Integer, primary_key=True)
+    bits = Column(LargeBinary, nullable=False)
+
+
+class PropertyDailyRollup(Base):
+    # incremented and decremented in the transactions that change the events, see rollups.event_contributions
+    __tablename__ = "property_daily_rollup"
+    owner_email = Column(String, primary_key=True)
+    property_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)
+    occupied_nights = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+    cleanings = Column(Integer, nullable=False, default=0)
+    maintenances = Column(Integer, nullable=False, default=0)
+
+
+class CalendarRevision(Base):
+    # incremented in every transaction that changes an event of the property, versions its calendar feeds
+    __tablename__ = "calendar_revision"
+    owner_email = Column(String, primary_key=True)
+    property_id = Column(Integer, primary_key=True)
+    revision = Column(BigInteger, nullable=False, default=0)
+
+
+class OutboxMessage(Base):
+    # messages written in the same transaction as the events they are about, published later by the OutboxRelay
+    __tablename__ = "outbox_message"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    routing_key = Column(String, nullable=False)
+    body = Column(LargeBinary, nullable=False)
+    content_type = Column(String)
+    delivery_mode = Column(Integer)
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
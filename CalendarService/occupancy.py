@@ -0,0 +1,42 @@
+from datetime import datetime, timedelta
+
+HOUR = timedelta(hours=1)
+# leap years have 366 * 24 hours, the last day of the others is never set
+HOURS_PER_YEAR = 366 * 24
+BITMAP_SIZE = HOURS_PER_YEAR // 8
+# bounds the bitmaps read by a search
+MAX_SEARCH_PERIOD = timedelta(days=366)
+
+
+def years_of_period(begin_datetime: datetime, end_datetime: datetime) -> range:
+    # the period is [begin_datetime, end_datetime), an event ending at midnight of January 1st doesn't touch that year
+    return range(begin_datetime.year, (end_datetime - timedelta(microseconds=1)).year + 1)
+
+
+def period_mask(year: int, begin_datetime: datetime, end_datetime: datetime) -> int:
+    """Bits of the hours of year that [begin_datetime, end_datetime) occupies, even partially."""
+    year_begin = datetime(year, 1, 1)
+    year_end = datetime(year + 1, 1, 1)
+    begin_datetime = max(begin_datetime, year_begin)
+    end_datetime = min(end_datetime, year_end)
+    if begin_datetime >= end_datetime:
+        return 0
+    first_hour = (begin_datetime - year_begin) // HOUR
+    last_hour = -((year_begin - end_datetime) // HOUR)
+    return ((1 << (last_hour - first_hour)) - 1) << first_hour
+
+
+def bitmap_from_bytes(bits: bytes) -> int:
+    # bit n of the int is hour n of the year, so a whole period is checked with a single AND
+    return int.from_bytes(bits, "little")
+
+
+def bitmap_to_bytes(bitmap: int) -> bytes:
+    return bitmap.to_bytes(BITMAP_SIZE, "little")
+
+
+def is_free(bitmaps_by_year: dict[int, int], from_datetime: datetime, to_datetime: datetime) -> bool:
+    return all(
+        bitmaps_by_year.get(year, 0) & period_mask(year, from_datetime, to_datetime) == 0
+        for year in years_of_period(from_datetime, to_datetime)
+    )
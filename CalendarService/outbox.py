@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import os
+
+from aio_pika import Message
+from dotenv import load_dotenv
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from CalendarService import models
+from CalendarService.database import engine
+from CalendarService.publishing import publish_in_order, PublishError
+from ProjectUtils.MessagingService.schemas import to_json_aoi_bytes
+
+load_dotenv()
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+OUTBOX_POLL_INTERVAL_SECONDS = float(os.getenv("OUTBOX_POLL_INTERVAL_SECONDS", "5"))
+# session advisory lock held by the relay publishing, across every process
+OUTBOX_RELAY_LOCK_KEY = "outbox_relay"
+
+logger = logging.getLogger(__name__)
+
+
+def add_outbox_message(db: AsyncSession, routing_key: str, message):
+    # not committed here, it's part of the transaction of the caller
+    aio_message = to_json_aoi_bytes(message)
+    db.add(models.OutboxMessage(
+        routing_key=routing_key,
+        body=aio_message.body,
+        content_type=aio_message.content_type,
+        delivery_mode=int(aio_message.delivery_mode) if aio_message.delivery_mode is not None else None
+    ))
+
+
+class OutboxRelay:
+    """
+    Publishes the committed outbox messages in batches, in id order, which keeps the messages of each event
+    in the order of its changes, and deletes them once the broker confirmed them. Woken up right after
+    commits in this process, and every poll_interval_seconds for messages left behind by other processes
+    or by a crash. Only one relay of all the processes publishes at a time, so the batches never overtake
+    each other.
+    """
+
+    def __init__(self, batch_size: int, poll_interval_seconds: float):
+        self.batch_size = batch_size
+        self.poll_interval_seconds = poll_interval_seconds
+        self._exchange = None
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def start(self, exchange):
+        self._exchange = exchange
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def notify(self):
+        self._wakeup.set()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def relay_batch(self) -> int:
+        # a session lock, held by the connection across the short transactions of the batch, never while a
+        # transaction waits for the broker
+        async with engine.connect() as connection:
+            # the relay holding the lock drains the outbox, the messages it misses are relayed on the next poll
+            locked = await connection.scalar(
+                select(func.pg_try_advisory_lock(func.hashtext(OUTBOX_RELAY_LOCK_KEY))))
+            await connection.commit()
+            if not locked:
+                return 0
+            try:
+                return await self._relay_locked_batch(connection)
+            finally:
+                # a failed statement leaves the transaction unusable for the unlock
+                await connection.rollback()
+                await connection.execute(select(func.pg_advisory_unlock(func.hashtext(OUTBOX_RELAY_LOCK_KEY))))
+                await connection.commit()
+
+    async def _relay_locked_batch(self, connection) -> int:
+        outbox_messages = (await connection.execute(
+            select(models.OutboxMessage.id, models.OutboxMessage.routing_key, models.OutboxMessage.body,
+                   models.OutboxMessage.content_type, models.OutboxMessage.delivery_mode)
+            .order_by(models.OutboxMessage.id)
+            .limit(self.batch_size)
+        )).all()
+        await connection.commit()
+        if len(outbox_messages) == 0:
+            return 0
+        try:
+            await publish_in_order(self._exchange, [
+                (outbox_message.routing_key,
+                 Message(outbox_message.body, content_type=outbox_message.content_type,
+                         delivery_mode=outbox_message.delivery_mode))
+                for outbox_message in outbox_messages
+            ])
+        except PublishError as e:
+            # the confirmed ones aren't published again, the others are retried from the first that failed
+            await self._delete(connection, outbox_messages[:e.confirmed])
+            raise
+        await self._delete(connection, outbox_messages)
+        return len(outbox_messages)
+
+    @staticmethod
+    async def _delete(connection, outbox_messages):
+        if outbox_messages:
+            await connection.execute(delete(models.OutboxMessage).where(
+                models.OutboxMessage.id.in_([outbox_message.id for outbox_message in outbox_messages])
+            ))
+            await connection.commit()
+
+    async def _run(self):
+        while True:
+            try:
+                while await self.relay_batch() == self.batch_size:
+                    pass
+            except Exception:
+                # left in the outbox, retried on the next wake up
+                logger.exception("Relaying the outbox failed, retrying on the next wake up")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+
+outbox_relay = OutboxRelay(OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL_SECONDS)
@@ -0,0 +1,46 @@
+import os
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+OWNERSHIP_CACHE_MAX_OWNERS = int(os.getenv("OWNERSHIP_CACHE_MAX_OWNERS", "10000"))
+
+
+class OwnershipCache:
+    """
+    Bounded LRU of the property ids of each owner email, warmed by crud and kept up to date by the
+    EMAIL_PROPERTY_ID_MAPPING messages. Properties are never removed from an owner, so a cached
+    property id is always right; a missing one is confirmed with the database.
+    """
+
+    def __init__(self, max_owners: int):
+        self.max_owners = max_owners
+        self._property_ids_by_email = OrderedDict()
+
+    def get(self, email: str) -> set[int] | None:
+        property_ids = self._property_ids_by_email.get(email)
+        if property_ids is not None:
+            self._property_ids_by_email.move_to_end(email)
+        return property_ids
+
+    def set(self, email: str, property_ids):
+        self._property_ids_by_email[email] = set(property_ids)
+        self._property_ids_by_email.move_to_end(email)
+        while len(self._property_ids_by_email) > self.max_owners:
+            self._property_ids_by_email.popitem(last=False)
+
+    def add(self, email: str, property_id: int):
+        # owners that aren't cached will be warmed with the new property from the database
+        property_ids = self._property_ids_by_email.get(email)
+        if property_ids is not None:
+            property_ids.add(property_id)
+
+    def invalidate(self, email: str = None):
+        if email is None:
+            self._property_ids_by_email.clear()
+        else:
+            self._property_ids_by_email.pop(email, None)
+
+
+ownership_cache = OwnershipCache(OWNERSHIP_CACHE_MAX_OWNERS)
@@ -0,0 +1,29 @@
+import base64
+from datetime import datetime
+
+from CalendarService.schemas import EventsWindow, to_naive_utc
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_PAGE_SIZE = 1000
+
+
+def encode_cursor(begin_datetime: datetime, event_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{begin_datetime.isoformat()},{event_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    # raises ValueError when the cursor wasn't made by encode_cursor
+    begin_datetime, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(",")
+    # issued naive, an edited cursor with an offset is compared like the stored datetimes
+    return to_naive_utc(datetime.fromisoformat(begin_datetime)), int(event_id)
+
+
+def paginate(events, events_window: EventsWindow):
+    """
+    Crud queries fetch one event more than the limit, to know if there is a next page.
+    Returns the events of the page and the cursor of the next page (None if it's the last one).
+    """
+    if events_window.limit is None or len(events) <= events_window.limit:
+        return events, None
+    events = events[:events_window.limit]
+    return events, encode_cursor(events[-1].begin_datetime, events[-1].id)
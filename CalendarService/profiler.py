@@ -0,0 +1,254 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from datetime import datetime
+
+from dotenv import load_dotenv
+from sqlalchemy import event
+
+from CalendarService.schemas import ProfileReport, ProfileSummary, ProfiledStatement, RepeatedStatement, \
+    ProfiledStack
+
+load_dotenv()
+
+# off by default, the reports show the statements, and so the data, of the requests of every user
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+# comma separated emails of the users allowed to read the reports, nobody when empty
+PROFILING_ALLOWED_EMAILS = {email.strip().lower() for email in os.getenv("PROFILING_ALLOWED_EMAILS", "").split(",")
+                            if email.strip()}
+# "queries" profiles the statements of the request, "cpu" also samples its stacks
+PROFILING_HEADER = os.getenv("PROFILING_HEADER", "X-Profile")
+PROFILING_CONSUMER_MESSAGES = os.getenv("PROFILING_CONSUMER_MESSAGES", "false").lower() == "true"
+PROFILING_CONSUMER_CPU = os.getenv("PROFILING_CONSUMER_CPU", "false").lower() == "true"
+# statement shapes executed at least this many times by one request are reported as repeated
+PROFILING_REPEATED_STATEMENTS = int(os.getenv("PROFILING_REPEATED_STATEMENTS", "3"))
+PROFILING_MAX_STATEMENTS = int(os.getenv("PROFILING_MAX_STATEMENTS", "1000"))
+PROFILING_REPORTS_KEPT = int(os.getenv("PROFILING_REPORTS_KEPT", "100"))
+PROFILING_SAMPLE_INTERVAL_SECONDS = float(os.getenv("PROFILING_SAMPLE_INTERVAL_SECONDS", "0.005"))
+PROFILING_TOP_STACKS = 50
+
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+logger = logging.getLogger(__name__)
+
+# bind parameters of expanded IN lists and literals vary between executions of the same statement
+PARAMETER_LIST = re.compile(r"\$\d+(?:::\w+)?(?:\s*,\s*\$\d+(?:::\w+)?)*")
+NUMBER = re.compile(r"\b\d+\b")
+STRING = re.compile(r"'(?:[^']|'')*'")
+
+
+def statement_shape(statement: str) -> str:
+    shape = STRING.sub("?", statement)
+    shape = PARAMETER_LIST.sub("?", shape)
+    shape = NUMBER.sub("?", shape)
+    return " ".join(shape.split())
+
+
+class StackSampler:
+    """
+    Samples the stack of a thread every interval_seconds from another thread. The event loop runs other
+    requests while the profiled one awaits, so their stacks are part of the samples too.
+    """
+
+    def __init__(self, thread_id: int, interval_seconds: float):
+        self.thread_id = thread_id
+        self.interval_seconds = interval_seconds
+        self.samples = 0
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler-stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval_seconds):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(f"{frame.f_globals.get('__name__', '?')}.{frame.f_code.co_name}")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(frames))] += 1
+            self.samples += 1
+
+
+class Profile:
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = datetime.now()
+        self.statements = []  # (statement, seconds), the first PROFILING_MAX_STATEMENTS
+        self.statement_count = 0
+        self.statement_seconds = 0.0
+        self.seconds_by_shape = {}
+        self.count_by_shape = Counter()
+        self.sampler = None
+        self._started = time.perf_counter()
+        self.seconds = None
+
+    def record(self, statement: str, seconds: float):
+        self.statement_count += 1
+        self.statement_seconds += seconds
+        if len(self.statements) < PROFILING_MAX_STATEMENTS:
+            self.statements.append((statement, seconds))
+        shape = statement_shape(statement)
+        self.count_by_shape[shape] += 1
+        self.seconds_by_shape[shape] = self.seconds_by_shape.get(shape, 0) + seconds
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self._started
+
+    def repeated_statements(self) -> list[RepeatedStatement]:
+        return [
+            RepeatedStatement(shape=shape, count=count, seconds=self.seconds_by_shape[shape])
+            for shape, count in self.count_by_shape.most_common() if count >= PROFILING_REPEATED_STATEMENTS
+        ]
+
+    def to_summary(self) -> ProfileSummary:
+        return ProfileSummary(
+            id=self.id, name=self.name, started_at=self.started_at, seconds=self.seconds,
+            statement_count=self.statement_count, statement_seconds=self.statement_seconds,
+            repeated_statement_count=len(self.repeated_statements())
+        )
+
+    def to_report(self) -> ProfileReport:
+        return ProfileReport(
+            **self.to_summary().model_dump(),
+            statements=[ProfiledStatement(statement=statement, seconds=seconds)
+                        for statement, seconds in self.statements],
+            repeated_statements=self.repeated_statements(),
+            cpu_samples=self.sampler.samples if self.sampler is not None else None,
+            cpu_stacks=[ProfiledStack(stack=stack, samples=samples)
+                        for stack, samples in self.sampler.stacks.most_common(PROFILING_TOP_STACKS)]
+            if self.sampler is not None else []
+        )
+
+
+class ProfileStore:
+    # the most recent profiles, for the debug endpoints
+
+    def __init__(self, max_profiles: int):
+        self.max_profiles = max_profiles
+        self._profiles = OrderedDict()
+
+    def add(self, profile: Profile):
+        self._profiles[profile.id] = profile
+        while len(self._profiles) > self.max_profiles:
+            self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Profile | None:
+        return self._profiles.get(profile_id)
+
+    def recent(self) -> list[Profile]:
+        return list(reversed(self._profiles.values()))
+
+
+profile_store = ProfileStore(PROFILING_REPORTS_KEPT)
+# profile of the request or message being handled, SQLAlchemy runs the queries in the context of the awaiting task
+current_profile: ContextVar[Profile | None] = ContextVar("current_profile", default=None)
+# a single sampler at a time, the samples of concurrent ones would be the same stacks anyway
+sampler_lock = threading.Lock()
+
+
+@contextmanager
+def profiling(name: str, cpu: bool = False):
+    profile = Profile(name)
+    token = current_profile.set(profile)
+    sampling = cpu and sampler_lock.acquire(blocking=False)
+    if sampling:
+        profile.sampler = StackSampler(threading.get_ident(), PROFILING_SAMPLE_INTERVAL_SECONDS)
+        profile.sampler.start()
+    try:
+        yield profile
+    finally:
+        if sampling:
+            profile.sampler.stop()
+            sampler_lock.release()
+        current_profile.reset(token)
+        profile.finish()
+        profile_store.add(profile)
+        log_profile(profile)
+
+
+def consumer_profiling(name: str):
+    # every consumed message is profiled when configured, there is no header to ask for it
+    if not PROFILING_CONSUMER_MESSAGES:
+        return nullcontext()
+    return profiling(name, PROFILING_CONSUMER_CPU)
+
+
+def log_profile(profile: Profile):
+    logger.info("Profile %s of %s: %.3fs, %d statements in %.3fs", profile.id, profile.name, profile.seconds,
+                profile.statement_count, profile.statement_seconds)
+    for repeated_statement in profile.repeated_statements():
+        logger.warning("Repeated statement in profile %s, %d times in %.3fs: %s", profile.id,
+                       repeated_statement.count, repeated_statement.seconds, repeated_statement.shape)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the requests that send the PROFILING_HEADER header and returns the id of their report in the
+    X-Profile-Id header. A plain ASGI middleware, so the context variable reaches the route handlers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.header = PROFILING_HEADER.lower().encode()
+
+    async def __call__(self, scope, receive, send):
+        if not PROFILING_ENABLED or scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        mode = dict(scope["headers"]).get(self.header)
+        if mode is None:
+            return await self.app(scope, receive, send)
+
+        with profiling(f"{scope['method']} {scope['path']}", cpu=mode.strip().lower() == b"cpu") as profile:
+            async def send_with_profile_id(message):
+                if message["type"] == "http.response.start":
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (PROFILE_ID_HEADER.lower().encode(), profile.id.encode())
+                    ]
+                await send(message)
+
+            await self.app(scope, receive, send_with_profile_id)
+
+
+def instrument_engine(engine):
+    # only the statements of profiled requests and messages are timed
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if current_profile.get() is not None:
+            connection.info.setdefault("profiled_query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        record_statement(connection, statement)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(exception_context):
+        if exception_context.connection is not None:
+            record_statement(exception_context.connection, exception_context.statement)
+
+
+def record_statement(connection, statement: str):
+    profile = current_profile.get()
+    query_started = connection.info.get("profiled_query_started")
+    if profile is None or not query_started:
+        return
+    profile.record(statement or "", time.perf_counter() - query_started.pop())
@@ -0,0 +1,28 @@
+import asyncio
+
+from CalendarService.metrics import timed_publish
+
+
+class PublishError(Exception):
+    # the first messages were confirmed, the one after them wasn't
+
+    def __init__(self, confirmed: int, error: BaseException):
+        super().__init__(f"Publishing failed after {confirmed} confirmed messages: {error!r}")
+        self.confirmed = confirmed
+
+
+async def publish_in_order(exchange, messages):
+    """
+    Publishes the (routing_key, message) pairs on the channel of the exchange in their order, and awaits
+    their publisher confirms together instead of one round trip per message. aiormq writes each message
+    under a FIFO channel lock, which publish reaches without suspending, so the publishes started in order
+    are written, and delivered to each queue, in that order. Only their confirms may come back in any
+    order, which is why they are awaited together.
+    """
+    results = await asyncio.gather(
+        *(timed_publish(exchange, message, routing_key) for routing_key, message in messages),
+        return_exceptions=True
+    )
+    for confirmed, result in enumerate(results):
+        if isinstance(result, BaseException):
+            raise PublishError(confirmed, result) from result
@@ -0,0 +1,158 @@
+import os
+from calendar import monthrange
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# series are always bounded by COUNT or UNTIL, so their overlaps can be checked when they're written
+RECURRENCE_MAX_OCCURRENCES = int(os.getenv("RECURRENCE_MAX_OCCURRENCES", "1000"))
+
+# shortest time between two occurrences of each frequency, with INTERVAL=1
+MIN_STEPS = {
+    "DAILY": timedelta(days=1),
+    "WEEKLY": timedelta(weeks=1),
+    "MONTHLY": timedelta(days=28),
+}
+
+
+class RecurrenceRule(NamedTuple):
+    frequency: str
+    interval: int
+    count: int | None
+    until: datetime | None
+
+
+def parse_rule(rule: str) -> RecurrenceRule:
+    """
+    Parses the subset of the RFC 5545 RRULE that the service supports, e.g. FREQ=WEEKLY;INTERVAL=2;COUNT=10 or
+    FREQ=MONTHLY;UNTIL=20241231T000000. Raises ValueError when it isn't valid.
+    """
+    parts = {}
+    for part in rule.removeprefix("RRULE:").split(";"):
+        name, separator, value = part.partition("=")
+        # the names are case-insensitive, FREQ=DAILY;freq=WEEKLY repeats FREQ
+        name = name.upper()
+        if separator == "" or name in parts:
+            raise ValueError(f"Invalid recurrence rule {rule}")
+        parts[name] = value
+    unknown_parts = parts.keys() - {"FREQ", "INTERVAL", "COUNT", "UNTIL"}
+    if unknown_parts:
+        raise ValueError(f"Unsupported recurrence rule parts {', '.join(sorted(unknown_parts))}")
+    if parts.get("FREQ") not in MIN_STEPS:
+        raise ValueError(f"FREQ must be one of {', '.join(MIN_STEPS)}")
+    interval = int(parts.get("INTERVAL", "1"))
+    count = int(parts["COUNT"]) if "COUNT" in parts else None
+    until = datetime.strptime(parts["UNTIL"].removesuffix("Z"), "%Y%m%dT%H%M%S") if "UNTIL" in parts else None
+    if interval < 1 or (count is not None and count < 1):
+        raise ValueError("INTERVAL and COUNT must be positive")
+    if (count is None) == (until is None):
+        raise ValueError("Exactly one of COUNT or UNTIL is required")
+    return RecurrenceRule(parts["FREQ"], interval, count, until)
+
+
+def validate_series(begin_datetime: datetime, end_datetime: datetime, rule: str):
+    # raises ValueError when the occurrences of the series would overlap each other, be too many or out of range
+    recurrence_rule = parse_rule(rule)
+    # UNTIL and the stored datetimes are naive UTC
+    begin_datetime, end_datetime = (
+        value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo is not None else value
+        for value in (begin_datetime, end_datetime)
+    )
+    try:
+        if end_datetime - begin_datetime > MIN_STEPS[recurrence_rule.frequency] * recurrence_rule.interval:
+            raise ValueError("The occurrences of the series would overlap each other")
+        occurrences = 0
+        for _ in occurrence_begins(begin_datetime, recurrence_rule):
+            occurrences += 1
+            if occurrences > RECURRENCE_MAX_OCCURRENCES:
+                raise ValueError(f"A series can't have more than {RECURRENCE_MAX_OCCURRENCES} occurrences")
+    except OverflowError:
+        raise ValueError("The occurrences of the series would be out of the supported dates")
+
+
+def occurrence_begins(begin_datetime: datetime, recurrence_rule: RecurrenceRule, first: int = 0):
+    """Begin datetimes of the occurrences, in order, from the first-th one for DAILY and WEEKLY."""
+    if recurrence_rule.frequency != "MONTHLY":
+        step = MIN_STEPS[recurrence_rule.frequency] * recurrence_rule.interval
+        position = first
+        while recurrence_rule.count is None or position < recurrence_rule.count:
+            occurrence_begin = begin_datetime + step * position
+            if recurrence_rule.until is not None and occurrence_begin > recurrence_rule.until:
+                return
+            yield occurrence_begin
+            position += 1
+        return
+
+    # months without the day of the month of begin_datetime are skipped, and not counted (RFC 5545)
+    occurrences = 0
+    months = 0
+    while recurrence_rule.count is None or occurrences < recurrence_rule.count:
+        year, month = divmod(begin_datetime.month - 1 + months, 12)
+        months += recurrence_rule.interval
+        if begin_datetime.day > monthrange(begin_datetime.year + year, month + 1)[1]:
+            continue
+        occurrence_begin = begin_datetime.replace(year=begin_datetime.year + year, month=month + 1)
+        if recurrence_rule.until is not None and occurrence_begin > recurrence_rule.until:
+            return
+        yield occurrence_begin
+        occurrences += 1
+
+
+def is_occurrence(begin_datetime: datetime, rule: str, occurrence_begin_datetime: datetime) -> bool:
+    for occurrence_begin in occurrence_begins(begin_datetime, parse_rule(rule)):
+        if occurrence_begin >= occurrence_begin_datetime:
+            return occurrence_begin == occurrence_begin_datetime
+    return False
+
+
+def expand(begin_datetime: datetime, end_datetime: datetime, rule: str, overrides=(),
+           from_datetime: datetime = None, to_datetime: datetime = None) -> list[tuple[datetime, datetime, datetime]]:
+    """
+    (occurrence_begin_datetime, begin_datetime, end_datetime) of the occurrences of a series that overlap
+    [from_datetime, to_datetime), sorted by begin_datetime. Only the occurrences around the window are generated.
+    overrides have the occurrence_begin_datetime they replace, and are either canceled or have a new period.
+    """
+    recurrence_rule = parse_rule(rule)
+    duration = end_datetime - begin_datetime
+    overrides_by_occurrence = {}
+    if overrides:
+        # overrides of occurrences the series doesn't have anymore are ignored
+        all_occurrence_begins = set(occurrence_begins(begin_datetime, recurrence_rule))
+        overrides_by_occurrence = {override.occurrence_begin_datetime: override for override in overrides
+                                   if override.occurrence_begin_datetime in all_occurrence_begins}
+
+    first = 0
+    if from_datetime is not None and recurrence_rule.frequency != "MONTHLY":
+        # skip straight to the occurrences that can end after from_datetime
+        step = MIN_STEPS[recurrence_rule.frequency] * recurrence_rule.interval
+        first = max(0, (from_datetime - duration - begin_datetime) // step)
+
+    occurrences = []
+    for occurrence_begin in occurrence_begins(begin_datetime, recurrence_rule, first):
+        if to_datetime is not None and occurrence_begin >= to_datetime:
+            break
+        if occurrence_begin in overrides_by_occurrence:
+            continue
+        if from_datetime is None or occurrence_begin + duration > from_datetime:
+            occurrences.append((occurrence_begin, occurrence_begin, occurrence_begin + duration))
+
+    for override in overrides_by_occurrence.values():
+        if override.canceled:
+            continue
+        if (from_datetime is None or override.end_datetime > from_datetime) and \
+                (to_datetime is None or override.begin_datetime < to_datetime):
+            occurrences.append((override.occurrence_begin_datetime, override.begin_datetime, override.end_datetime))
+    occurrences.sort(key=lambda occurrence: occurrence[1])
+    return occurrences
+
+
+def periods_overlap(periods) -> bool:
+    # whether any two of the (begin_datetime, end_datetime) periods overlap
+    latest_end_datetime = None
+    for begin_datetime, end_datetime in sorted(periods):
+        if latest_end_datetime is not None and begin_datetime < latest_end_datetime:
+            return True
+        latest_end_datetime = max(latest_end_datetime or end_datetime, end_datetime)
+    return False
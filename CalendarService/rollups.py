@@ -0,0 +1,34 @@
+from collections import defaultdict
+from datetime import date, timedelta
+
+from CalendarService import models
+
+
+def event_contributions(event_state) -> dict[date, tuple[int, float, int, int]]:
+    """
+    (occupied_nights, revenue, cleanings, maintenances) that an event adds to the daily rollups of its property.
+    Confirmed reservations occupy the nights from the day they begin until the day they end, with their cost
+    spread evenly over them; cleanings and maintenances are counted on the day they begin,
+    once per occurrence.
+    """
+    if event_state is None or event_state.canceled:
+        return {}
+    begin_date = event_state.begin_datetime.date()
+    match event_state.type:
+        case "reservation":
+            if event_state.reservation_status != models.ReservationStatus.CONFIRMED:
+                return {}
+            nights = (event_state.end_datetime.date() - begin_date).days
+            cost = event_state.cost or 0
+            if nights <= 0:
+                return {begin_date: (0, cost, 0, 0)}
+            return {begin_date + timedelta(days=night): (1, cost / nights, 0, 0) for night in range(nights)}
+        case "cleaning" | "maintenance":
+            # every occurrence of recurring ones
+            contribution = (0, 0, 1, 0) if event_state.type == "cleaning" else (0, 0, 0, 1)
+            contributions = defaultdict(lambda: (0, 0, 0, 0))
+            for begin_datetime, _ in event_state.periods():
+                contributions[begin_datetime.date()] = tuple(
+                    total + value for total, value in zip(contributions[begin_datetime.date()], contribution))
+            return dict(contributions)
+    return {}
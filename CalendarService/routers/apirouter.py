@@ -1,22 +1,55 @@
-from fastapi import APIRouter, Depends, status, HTTPException, Request
+from collections import defaultdict
+from datetime import datetime, date
+from typing import Optional
+
+from fastapi import APIRouter, Depends, status, HTTPException, Request, Response, Query, Body
 
 from CalendarService.dependencies import get_user, get_db, get_user_email, get_update_management_event_schema, \
     get_management_event_model, \
-    InitializeUpdateEventAccordingToEndpoint, get_event_model
-from CalendarService import crud
-from CalendarService.messaging_operations import propagate_event_creation_to_wrappers, \
-    propagate_event_update_to_wrappers, propagate_event_deletion_to_wrappers
+    InitializeUpdateEventAccordingToEndpoint, get_event_model, get_events_window, get_period, \
+    get_management_event_schema
+from CalendarService import crud, recurrence
 from CalendarService.schemas import Cleaning, Maintenance, UniformEventWithId, UserBase, UpdateCleaning, \
-    BaseEvent, CleaningWithId, MaintenanceWithId, BaseEventWithId, UpdateMaintenance, ReservationWithId, KeyInput
-from sqlalchemy.orm import Session
+    BaseEvent, CleaningWithId, MaintenanceWithId, BaseEventWithId, UpdateMaintenance, ReservationWithId, KeyInput, \
+    EventsWindow, EmailJobStatus, Interval, PropertyAvailability, PropertyRollup, RollupGranularity, \
+    CalendarFeeds, Base, BulkEventResult, BulkEventStatus, OccurrenceOverride, ManagementOccurrence
+from CalendarService.ics import FEED_TOKEN_SECRET, create_feed_token
+from CalendarService.metrics import TimedRoute
+from CalendarService.availability import merge_busy_periods, free_gaps
+from CalendarService.occupancy import MAX_SEARCH_PERIOD
+from CalendarService.email_dispatcher import email_dispatcher, EmailQueueFullError
+from CalendarService.pagination import paginate, NEXT_CURSOR_HEADER
+from CalendarService.streaming import wants_ndjson, ndjson_response, NDJSON_MEDIA_TYPE
+from sqlalchemy.ext.asyncio import AsyncSession
 from CalendarService import models
 from CalendarService.dependencies import InitializeEventWithOwnerEmail
 from pydantic import EmailStr
 
+from pydantic_core import ValidationError
+from fastapi.exceptions import RequestValidationError
+
 from ProjectUtils.MessagingService.schemas import MessageFactory
 
+MAX_BULK_EVENTS = 500
+# attempts of a bulk creation when events are created concurrently on the same properties
+BULK_EVENTS_ATTEMPTS = 3
+
+event_schema_by_model = {
+    models.Reservation: ReservationWithId,
+    models.Cleaning: CleaningWithId,
+    models.Maintenance: MaintenanceWithId,
+}
+
+streaming_responses = {
+    status.HTTP_200_OK: {
+        "description": f"With Accept: {NDJSON_MEDIA_TYPE}, events are streamed one JSON object per line "
+                       f"as they are read from the database, ignoring limit.",
+        "content": {NDJSON_MEDIA_TYPE: {}}
+    }
+}
+
 # deny by default with dependency get_user
-api_router = APIRouter(prefix="/events", tags=["events"], dependencies=[Depends(get_user)])
+api_router = APIRouter(prefix="/events", tags=["events"], dependencies=[Depends(get_user)], route_class=TimedRoute)
 
 
 @api_router.get("/management/types", response_model=list[str], status_code=status.HTTP_200_OK,
@@ -33,33 +66,199 @@ async def read_management_event_types():
     return models.management_event_types
 
 
-@api_router.get("", response_model=list[UniformEventWithId], status_code=status.HTTP_200_OK, 
-                summary="List all events of a specific user, including reservations and cleaning/maintenance events.")
-async def read_events_by_owner_email(reservation_status: models.ReservationStatus,
-    owner_email: str = Depends(get_user_email), db: Session = Depends(get_db)):
-    return crud.get_all_events_by_owner_email_and_filter_reservations_by_status(
-        db, owner_email, reservation_status
+@api_router.get("/availability", response_model=list[PropertyAvailability], status_code=status.HTTP_200_OK,
+                summary="Busy and free intervals of properties of a user.",
+                description="Returns, for each property, the merged busy intervals of its events that are not "
+                            "canceled and the free gaps between them, within [from, to).",
+                responses={
+                    status.HTTP_200_OK: {
+                        "description": "Busy and free intervals of each property, in the order they were requested.",
+                        "content": {"application/json": {"example": [{
+                            "property_id": 1,
+                            "busy": [{"begin_datetime": "2024-05-02T10:00:00", "end_datetime": "2024-05-04T12:00:00"}],
+                            "free": [{"begin_datetime": "2024-05-01T00:00:00", "end_datetime": "2024-05-02T10:00:00"},
+                                     {"begin_datetime": "2024-05-04T12:00:00", "end_datetime": "2024-06-01T00:00:00"}]
+                        }]}}
+                    },
+                    status.HTTP_404_NOT_FOUND: {
+                        "description": "Property with the given id for the email does not exist.",
+                        "content": {"application/json": {"example": {"detail": "Property with id 0 for the email user@example.com not found."}}}
+                    }
+                })
+async def read_availability_by_owner_email(
+        property_ids: list[int] = Query(..., alias="property_id", description="Can be repeated."),
+        period: tuple[datetime, datetime] = Depends(get_period),
+        owner_email: str = Depends(get_user_email), db: AsyncSession = Depends(get_db)):
+    from_datetime, to_datetime = period
+    property_ids = list(dict.fromkeys(property_ids))
+    for property_id in property_ids:
+        if not await crud.is_property_owned_by_email(db, owner_email, property_id):
+            raise HTTPException(status_code=404, detail=f"Property with id {property_id} for the email {owner_email} not found.")
+
+    periods_by_property_id = {property_id: [] for property_id in property_ids}
+    async for event in crud.stream_busy_periods_by_owner_email_and_property_ids(
+            db, owner_email, property_ids, from_datetime, to_datetime):
+        periods_by_property_id[event.property_id].append((event.begin_datetime, event.end_datetime))
+    recurring_periods_by_property_id = defaultdict(list)
+    for occurrence in await crud.get_occurrences_by_owner_email_and_property_ids_in_period(
+            db, {(owner_email, property_id) for property_id in property_ids}, from_datetime, to_datetime):
+        recurring_periods_by_property_id[occurrence.property_id].append(
+            (occurrence.begin_datetime, occurrence.end_datetime))
+
+    availabilities = []
+    for property_id, periods in periods_by_property_id.items():
+        if property_id in recurring_periods_by_property_id:
+            # the occurrences of recurring events don't come sorted with the other events
+            periods = sorted(periods + recurring_periods_by_property_id[property_id])
+        busy = merge_busy_periods(periods, from_datetime, to_datetime)
+        availabilities.append(PropertyAvailability(
+            property_id=property_id,
+            busy=[Interval(begin_datetime=begin, end_datetime=end) for begin, end in busy],
+            free=[Interval(begin_datetime=begin, end_datetime=end)
+                  for begin, end in free_gaps(busy, from_datetime, to_datetime)]
+        ))
+    return availabilities
+
+
+@api_router.get("/availability/search", response_model=list[int], status_code=status.HTTP_200_OK,
+                summary="Properties of a user that are free in a period.",
+                description="Returns the ids of the properties, all of the user's or the given ones, without any event "
+                            "that isn't canceled in [from, to). Occupancy is kept per hour, so a property with an "
+                            "event in part of the first or last hour of the period is not free.",
+                responses={
+                    status.HTTP_200_OK: {
+                        "description": "Ids of the free properties.",
+                        "content": {"application/json": {"example": [1, 4, 7]}}
+                    },
+                    status.HTTP_404_NOT_FOUND: {
+                        "description": "Property with the given id for the email does not exist.",
+                        "content": {"application/json": {"example": {"detail": "Property with id 0 for the email user@example.com not found."}}}
+                    }
+                })
+async def search_free_properties_by_owner_email(
+        property_ids: Optional[list[int]] = Query(None, alias="property_id", description="Can be repeated."),
+        period: tuple[datetime, datetime] = Depends(get_period),
+        owner_email: str = Depends(get_user_email), db: AsyncSession = Depends(get_db)):
+    from_datetime, to_datetime = period
+    if to_datetime - from_datetime > MAX_SEARCH_PERIOD:
+        raise HTTPException(status_code=422, detail=f"The period can't be longer than {MAX_SEARCH_PERIOD.days} days")
+    if property_ids is None:
+        property_ids = await crud.get_property_ids_by_email(db, owner_email)
+    else:
+        property_ids = list(dict.fromkeys(property_ids))
+        for property_id in property_ids:
+            if not await crud.is_property_owned_by_email(db, owner_email, property_id):
+                raise HTTPException(status_code=404, detail=f"Property with id {property_id} for the email {owner_email} not found.")
+    return await crud.get_free_property_ids(db, owner_email, property_ids, from_datetime, to_datetime)
+
+
+@api_router.get("/statistics", response_model=list[PropertyRollup], status_code=status.HTTP_200_OK,
+                summary="Occupancy, revenue and management events of the properties of a user.",
+                description="Sums, per property and per day, month or year, the nights occupied by confirmed "
+                            "reservations, their revenue spread over those nights, and the cleanings and "
+                            "maintenances that begin in [from, to).",
+                responses={
+                    status.HTTP_200_OK: {
+                        "description": "One entry per property and period with any data.",
+                        "content": {"application/json": {"example": [{
+                            "property_id": 1, "period": "2024-05-01", "occupied_nights": 12,
+                            "revenue": 1440.0, "cleanings": 4, "maintenances": 1
+                        }]}}
+                    }
+                })
+async def read_statistics_by_owner_email(
+        from_date: date = Query(..., alias="from"), to_date: date = Query(..., alias="to"),
+        granularity: RollupGranularity = RollupGranularity.MONTH, property_id: Optional[int] = None,
+        owner_email: str = Depends(get_user_email), db: AsyncSession = Depends(get_db)):
+    if from_date >= to_date:
+        raise HTTPException(status_code=422, detail="from cannot be greater or equal to to")
+    return await crud.get_rollups(db, owner_email, from_date, to_date, granularity.value, property_id)
+
+
+@api_router.get("/feeds", response_model=CalendarFeeds, status_code=status.HTTP_200_OK,
+                summary="iCalendar subscription links of a user.",
+                description="Links of the iCalendar feeds of all the properties of the user, and of each of them. "
+                            "Anyone with a link can read its feed.",
+                responses={
+                    status.HTTP_503_SERVICE_UNAVAILABLE: {
+                        "description": "Calendar feeds are not configured.",
+                        "content": {"application/json": {"example": {"detail": "Calendar feeds are not configured"}}}
+                    }
+                })
+async def read_calendar_feeds(request: Request, owner_email: str = Depends(get_user_email),
+                              db: AsyncSession = Depends(get_db)):
+    if FEED_TOKEN_SECRET is None:
+        raise HTTPException(status_code=503, detail="Calendar feeds are not configured")
+    feed_token = create_feed_token(owner_email)
+    return CalendarFeeds(
+        calendar=str(request.url_for("read_owner_feed", feed_token=feed_token)),
+        properties={
+            property_id: str(request.url_for("read_property_feed", feed_token=feed_token, property_id=property_id))
+            for property_id in await crud.get_property_ids_by_email(db, owner_email)
+        }
     )
 
 
-@api_router.get("/reservation", response_model=list[ReservationWithId], status_code=status.HTTP_200_OK, 
+@api_router.get("", response_model=list[UniformEventWithId], status_code=status.HTTP_200_OK,
+                responses=streaming_responses,
+                summary="List all events of a specific user, including reservations and cleaning/maintenance events.",
+                description="Events can be limited to a time window with from/to. With limit, events are paginated "
+                            "by (begin_datetime, id) and the X-Next-Cursor header holds the cursor of the next page.")
+async def read_events_by_owner_email(reservation_status: models.ReservationStatus, request: Request,
+    response: Response, events_window: EventsWindow = Depends(get_events_window),
+    owner_email: str = Depends(get_user_email), db: AsyncSession = Depends(get_db)):
+    if wants_ndjson(request):
+        events_window = events_window.model_copy(update={"limit": None})
+        return ndjson_response(
+            lambda stream_db: crud.stream_all_events_by_owner_email_and_filter_reservations_by_status(
+                stream_db, owner_email, reservation_status, events_window),
+            UniformEventWithId
+        )
+    events, next_cursor = paginate(await crud.get_all_events_by_owner_email_and_filter_reservations_by_status(
+        db, owner_email, reservation_status, events_window
+    ), events_window)
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return events
+
+
+@api_router.get("/reservation", response_model=list[ReservationWithId], status_code=status.HTTP_200_OK,
+                responses=streaming_responses,
                 summary="List of reservations related to a user and his properties.", 
                 description="Returns list of reservations related to all, or a specific property, of a specific user based on his authorization bearer token.")
-@api_router.get("/management/cleaning", response_model=list[CleaningWithId], status_code=status.HTTP_200_OK, 
+@api_router.get("/management/cleaning", response_model=list[CleaningWithId], status_code=status.HTTP_200_OK,
+                responses=streaming_responses,
                 summary="List of cleaning events related to a user and his properties", 
                 description="Returns list of cleaning events related to all, or a specific property, of a specific user based on his authorization bearer token.")
-@api_router.get("/management/maintenance", response_model=list[MaintenanceWithId], status_code=status.HTTP_200_OK, 
+@api_router.get("/management/maintenance", response_model=list[MaintenanceWithId], status_code=status.HTTP_200_OK,
+                responses=streaming_responses,
                 summary="List of maintenance events related to a user and his properties", 
                 description="Returns list of maintenance events related to all, or a specific property, of a specific user based on his authorization bearer token.")
 async def read_specific_events_by_owner_email(
+        request: Request,
+        response: Response,
         owner_email: str = Depends(get_user_email),
         property_id: int = None,
         event_model: models.Reservation | models.Cleaning | models.Maintenance = Depends(get_event_model),
-        db: Session = Depends(get_db)
+        events_window: EventsWindow = Depends(get_events_window),
+        db: AsyncSession = Depends(get_db)
 ):
+    if wants_ndjson(request):
+        events_window = events_window.model_copy(update={"limit": None})
+        return ndjson_response(
+            lambda stream_db: crud.stream_specific_events_by_owner_email(
+                stream_db, owner_email, event_model, property_id, events_window),
+            event_schema_by_model[event_model]
+        )
     if property_id is None:
-        return crud.get_specific_events_by_owner_email(db, owner_email, event_model)
-    return crud.get_specific_events_by_owner_email_and_property_id(db, owner_email, property_id, event_model)
+        events = await crud.get_specific_events_by_owner_email(db, owner_email, event_model, events_window)
+    else:
+        events = await crud.get_specific_events_by_owner_email_and_property_id(
+            db, owner_email, property_id, event_model, events_window)
+    events, next_cursor = paginate(events, events_window)
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return events
 
 
 @api_router.post("/management/cleaning", response_model=CleaningWithId, status_code=status.HTTP_201_CREATED, 
@@ -125,24 +324,114 @@ async def create_management_event(
         event_data: Cleaning | Maintenance = Depends(InitializeEventWithOwnerEmail()),
         event_model: models.Cleaning | models.Maintenance = Depends(get_management_event_model),
         owner_email: str = Depends(get_user_email),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    if event_data.property_id not in crud.get_property_ids_by_email(db, owner_email):
+    if not await crud.is_property_owned_by_email(db, owner_email, event_data.property_id):
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"There are no registered properties for email {owner_email} which you can create events for."
         )
 
-    if crud.there_are_overlapping_events(db, event_data):
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=f"There are overlapping events with the event with begin_datetime {event_data.begin_datetime} "
-                   f"and end_datetime {event_data.end_datetime}.")
-    db_event = crud.create_management_event(db, event_data, event_model)
-    await propagate_event_creation_to_wrappers(db_event)
+    overlapping_events_exception = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"There are overlapping events with the event with begin_datetime {event_data.begin_datetime} "
+               f"and end_datetime {event_data.end_datetime}.")
+    if await crud.there_are_overlapping_events(db, event_data):
+        raise overlapping_events_exception
+    try:
+        db_event = await crud.create_management_event(db, event_data, event_model)
+    except crud.OverlappingEventsError:
+        # created concurrently, caught by the database constraint
+        raise overlapping_events_exception
     return db_event
 
 
+@api_router.post("/management/cleaning/bulk", response_model=list[BulkEventResult], status_code=status.HTTP_200_OK,
+                 summary="Create many cleaning events",
+                 description=f"Creates up to {MAX_BULK_EVENTS} cleaning events in a single transaction. Events of "
+                             "properties the user doesn't own, or overlapping an existing event or an earlier event "
+                             "of the request, are not created; the others are. Returns the result of each event.",
+                 responses={
+                    status.HTTP_200_OK: {
+                        "description": "Result of each event, in the order of the request.",
+                        "content": {"application/json": {"example": [
+                            {"index": 0, "status": "created", "event": {
+                                "id": 1, "property_id": 1, "owner_email": "user@example.com", "type": "cleaning",
+                                "begin_datetime": "2024-05-30T10:37:34", "end_datetime": "2024-05-30T12:37:34",
+                                "worker_name": "Joaquim Silva"}},
+                            {"index": 1, "status": "overlapping",
+                             "detail": "There are overlapping events with the event with begin_datetime "
+                                       "2024-05-30T11:00:00 and end_datetime 2024-05-30T13:00:00."}
+                        ]}}
+                    },
+                    status.HTTP_409_CONFLICT: {
+                        "description": "Events were created concurrently on the same properties, nothing was created.",
+                        "content": {"application/json": {"example": {"detail": "Overlapping events were created concurrently, try again."}}}
+                    }
+                 })
+@api_router.post("/management/maintenance/bulk", response_model=list[BulkEventResult],
+                 status_code=status.HTTP_200_OK,
+                 summary="Create many maintenance events",
+                 description=f"Creates up to {MAX_BULK_EVENTS} maintenance events in a single transaction. Events of "
+                             "properties the user doesn't own, or overlapping an existing event or an earlier event "
+                             "of the request, are not created; the others are. Returns the result of each event.",
+                 responses={
+                    status.HTTP_409_CONFLICT: {
+                        "description": "Events were created concurrently on the same properties, nothing was created.",
+                        "content": {"application/json": {"example": {"detail": "Overlapping events were created concurrently, try again."}}}
+                    }
+                 })
+async def create_management_events(
+        events_data: list[Base] = Body(..., max_length=MAX_BULK_EVENTS),
+        EventSchema=Depends(get_management_event_schema),
+        event_model: models.Cleaning | models.Maintenance = Depends(get_management_event_model),
+        owner_email: str = Depends(get_user_email),
+        db: AsyncSession = Depends(get_db)
+):
+    results = [BulkEventResult(index=index, status=BulkEventStatus.CREATED) for index in range(len(events_data))]
+    events = {}
+    for index, event_data in enumerate(events_data):
+        try:
+            events[index] = EventSchema(owner_email=owner_email, **event_data.model_dump(exclude={"owner_email"}))
+        except ValidationError as e:
+            results[index].status, results[index].detail = BulkEventStatus.INVALID, e.errors(
+                include_url=False, include_context=False)
+        except RequestValidationError as e:
+            results[index].status, results[index].detail = BulkEventStatus.INVALID, e.errors()
+
+    owned_property_ids = await crud.get_owned_property_ids(db, owner_email, {
+        event.property_id for event in events.values()
+    })
+    for index, event in list(events.items()):
+        if event.property_id not in owned_property_ids:
+            results[index].status = BulkEventStatus.NOT_FOUND
+            results[index].detail = f"There are no registered properties for email {owner_email} with id {event.property_id}."
+            del events[index]
+
+    for attempt in range(BULK_EVENTS_ATTEMPTS):
+        created = []
+        for (index, event), overlapping in zip(list(events.items()),
+                                               await crud.find_overlapping_events(db, list(events.values()))):
+            if overlapping:
+                results[index].status = BulkEventStatus.OVERLAPPING
+                results[index].detail = f"There are overlapping events with the event with begin_datetime " \
+                                        f"{event.begin_datetime} and end_datetime {event.end_datetime}."
+            else:
+                results[index].status, results[index].detail = BulkEventStatus.CREATED, None
+                created.append(index)
+        try:
+            db_events = await crud.create_management_events(db, [events[index] for index in created], event_model)
+            break
+        except crud.OverlappingEventsError:
+            # created concurrently, caught by the database constraint, check the batch again
+            if attempt == BULK_EVENTS_ATTEMPTS - 1:
+                raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                    detail="Overlapping events were created concurrently, try again.")
+    for index, db_event in zip(created, db_events):
+        results[index].event = event_schema_by_model[event_model].model_validate(db_event, from_attributes=True)
+    return results
+
+
 @api_router.put("/management/cleaning/{event_id}", response_model=CleaningWithId, status_code=status.HTTP_200_OK,
                 summary="Update cleaning event",
                 description="Updates the cleaning event with the given id and the specified parameters. "
@@ -203,9 +492,9 @@ async def update_event(
         event_id: int,
         update_event_data: UpdateCleaning | UpdateMaintenance = Depends(InitializeUpdateEventAccordingToEndpoint()),
         event_model: models.Cleaning | models.Maintenance = Depends(get_management_event_model),
-        owner_email: EmailStr = Depends(get_user_email), db: Session = Depends(get_db)
+        owner_email: EmailStr = Depends(get_user_email), db: AsyncSession = Depends(get_db)
 ):
-    event_to_update = crud.get_management_event_by_id(db, event_model, event_id)
+    event_to_update = await crud.get_management_event_by_id(db, event_model, event_id)
     if event_to_update is None or owner_email != event_to_update.owner_email:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -222,28 +511,133 @@ async def update_event(
     begin_end_datetime_update_parameters = {key: value for key in ["begin_datetime", "end_datetime"]
                                             if (value := update_parameters.get(key)) is not None}
 
+    begin_datetime = begin_end_datetime_update_parameters.get("begin_datetime", event_to_update.begin_datetime)
+    end_datetime = begin_end_datetime_update_parameters.get("end_datetime", event_to_update.end_datetime)
+    # also raised when only other fields change, the commit checks the overlaps of the event again
+    overlapping_events_exception = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"There are overlapping events with the event "
+               f"with begin_datetime {begin_datetime} "
+               f"and end_datetime {end_datetime}.")
     if len(begin_end_datetime_update_parameters) > 0:
         updating_event = BaseEventWithId(
             id=event_to_update.id,
             property_id=event_to_update.property_id,
             owner_email=event_to_update.owner_email,
-            begin_datetime=begin_end_datetime_update_parameters.get("begin_datetime", event_to_update.begin_datetime),
-            end_datetime=begin_end_datetime_update_parameters.get("end_datetime", event_to_update.end_datetime),
+            begin_datetime=begin_datetime,
+            end_datetime=end_datetime,
             type=event_model.__tablename__
         )
-        if crud.there_are_overlapping_events_excluding_updating_event(db, updating_event):
-            raise HTTPException(
-                status_code=status.HTTP_409_CONFLICT,
-                detail=f"There are overlapping events with the event "
-                       f"with begin_datetime {updating_event.begin_datetime} "
-                       f"and end_datetime {updating_event.end_datetime}.")
-
-    db_event = crud.update_event(db, event_to_update, update_parameters)
-    if len(begin_end_datetime_update_parameters) > 0:
-        await propagate_event_update_to_wrappers(db_event)
+        if event_to_update.recurring:
+            try:
+                recurrence.validate_series(updating_event.begin_datetime, updating_event.end_datetime,
+                                           event_to_update.recurrence_rule)
+            except ValueError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+            # the overridden occurrences move with the series
+            overrides = crud.shifted_overrides(event_to_update, updating_event.begin_datetime)
+            if any(not recurrence.is_occurrence(updating_event.begin_datetime, event_to_update.recurrence_rule,
+                                                override.occurrence_begin_datetime) for override in overrides):
+                raise HTTPException(status_code=422,
+                                    detail="The overridden occurrences aren't occurrences of the moved series")
+            there_are_overlapping_events = await crud.there_are_overlapping_occurrences(
+                db, event_to_update, updating_event.begin_datetime, updating_event.end_datetime, overrides)
+        else:
+            there_are_overlapping_events = await crud.there_are_overlapping_events_excluding_updating_event(
+                db, updating_event)
+        if there_are_overlapping_events:
+            raise overlapping_events_exception
+
+    try:
+        db_event = await crud.update_event(db, event_to_update, update_parameters)
+    except crud.OverlappingEventsError:
+        # changed concurrently, caught by the database constraint
+        raise overlapping_events_exception
     return db_event
 
 
+@api_router.put("/management/cleaning/{event_id}/occurrences", response_model=CleaningWithId,
+                status_code=status.HTTP_200_OK,
+                summary="Override an occurrence of a recurring cleaning event",
+                description="Cancels, or moves to another period, the occurrence of the recurring cleaning event "
+                            "that begins at occurrence_begin_datetime according to its recurrence rule.",
+                responses={
+                    status.HTTP_404_NOT_FOUND: {
+                        "description": "Recurring cleaning event with the given id, or its occurrence, does not exist.",
+                        "content": {"application/json": {"example": {"detail": "Recurring event of type cleaning with id 0 not found for email user@example.com."}}}
+                    },
+                    status.HTTP_409_CONFLICT: {
+                        "description": "There are overlapping events with the moved occurrence.",
+                        "content": {"application/json": {"example": {"detail": "There are overlapping events with the occurrence with begin_datetime 2024-05-30T10:37:34 "
+                                                                               "and end_datetime 2024-05-31T10:37:34."}}}
+                    }
+                })
+@api_router.put("/management/maintenance/{event_id}/occurrences", response_model=MaintenanceWithId,
+                status_code=status.HTTP_200_OK,
+                summary="Override an occurrence of a recurring maintenance event",
+                description="Cancels, or moves to another period, the occurrence of the recurring maintenance event "
+                            "that begins at occurrence_begin_datetime according to its recurrence rule.",
+                responses={
+                    status.HTTP_404_NOT_FOUND: {
+                        "description": "Recurring maintenance event with the given id, or its occurrence, does not exist.",
+                        "content": {"application/json": {"example": {"detail": "Recurring event of type maintenance with id 0 not found for email user@example.com."}}}
+                    },
+                    status.HTTP_409_CONFLICT: {
+                        "description": "There are overlapping events with the moved occurrence.",
+                        "content": {"application/json": {"example": {"detail": "There are overlapping events with the occurrence with begin_datetime 2024-05-30T10:37:34 "
+                                                                               "and end_datetime 2024-05-31T10:37:34."}}}
+                    }
+                })
+async def override_occurrence(
+        event_id: int,
+        occurrence_override: OccurrenceOverride,
+        event_model: models.Cleaning | models.Maintenance = Depends(get_management_event_model),
+        owner_email: EmailStr = Depends(get_user_email), db: AsyncSession = Depends(get_db)
+):
+    db_event = await crud.get_management_event_by_id(db, event_model, event_id)
+    if db_event is None or owner_email != db_event.owner_email or not db_event.recurring:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Recurring event of type {event_model.__tablename__} with id {event_id} not found for email {owner_email}."
+        )
+    if not recurrence.is_occurrence(db_event.begin_datetime, db_event.recurrence_rule,
+                                    occurrence_override.occurrence_begin_datetime):
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Event with id {event_id} has no occurrence beginning at {occurrence_override.occurrence_begin_datetime}."
+        )
+    if not occurrence_override.canceled and occurrence_override.begin_datetime < db_event.begin_datetime:
+        raise HTTPException(status_code=422, detail="An occurrence can't be moved before the first one")
+
+    overlapping_events_exception = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"There are overlapping events with the occurrence with begin_datetime "
+               f"{occurrence_override.begin_datetime} and end_datetime {occurrence_override.end_datetime}.")
+    overrides = [override for override in db_event.overrides
+                 if override.occurrence_begin_datetime != occurrence_override.occurrence_begin_datetime]
+    if not occurrence_override.canceled and await crud.there_are_overlapping_occurrences(
+            db, db_event, db_event.begin_datetime, db_event.end_datetime, overrides + [occurrence_override]):
+        raise overlapping_events_exception
+    try:
+        return await crud.set_occurrence_override(db, db_event, occurrence_override)
+    except crud.OverlappingEventsError:
+        # changed concurrently, caught by the overlap check of the transaction
+        raise overlapping_events_exception
+
+
+@api_router.get("/management/occurrences", response_model=list[ManagementOccurrence], status_code=status.HTTP_200_OK,
+                summary="Cleaning and maintenance events of a user in a period, with recurring ones expanded.",
+                description="Returns every occurrence in [from, to) of the management events of the user, or of "
+                            "one of its properties, sorted by begin_datetime. Recurring events are expanded only "
+                            "inside the period, with their overridden occurrences.")
+async def read_management_occurrences_by_owner_email(
+        period: tuple[datetime, datetime] = Depends(get_period), property_id: Optional[int] = None,
+        owner_email: str = Depends(get_user_email), db: AsyncSession = Depends(get_db)):
+    from_datetime, to_datetime = period
+    return await crud.get_management_occurrences_by_owner_email(
+        db, owner_email, from_datetime, to_datetime, property_id)
+
+
 @api_router.delete("/management/cleaning/{event_id}", status_code=status.HTTP_204_NO_CONTENT,
                    summary="Delete cleaning event",
                    description="Deletes the cleaning event with the given id.",
@@ -274,36 +668,63 @@ async def delete_management_event_by_id(
         event_id: int,
         event_model: models.Cleaning | models.Maintenance = Depends(get_management_event_model),
         owner_email: EmailStr = Depends(get_user_email),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_db)
 ):
-    management_event = crud.get_management_event_by_owner_email_and_event_id(db, event_model, owner_email, event_id)
+    management_event = await crud.get_management_event_by_owner_email_and_event_id(db, event_model, owner_email, event_id)
     if management_event is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail=f"Event of type {event_model.__tablename__} with id {event_id} for email {owner_email} not found")
-    db_event = crud.delete_management_event(db, management_event)
-    await propagate_event_deletion_to_wrappers(db_event)
+    await crud.delete_management_event(db, management_event)
 
 
-@api_router.post("/reservation/{reservation_id}/email_key", status_code=204,
+@api_router.post("/reservation/{reservation_id}/email_key", response_model=EmailJobStatus,
+                 status_code=status.HTTP_202_ACCEPTED,
                  summary="Send email with key to reservation client",
-                 description="Sends an email to the client of the reservation with the given id. \
-                    The email contains the key to the property.",
+                 description="Queues an email to the client of the reservation with the given id. \
+                    The email contains the key to the property. Its delivery can be followed with the returned id.",
                  responses={
-                     status.HTTP_204_NO_CONTENT: {
-                         "description": "Successful Response.",
-                         "content": {"application/json": {"example": {}}}
+                     status.HTTP_202_ACCEPTED: {
+                         "description": "The email was queued.",
+                         "content": {"application/json": {"example": {"id": "0f6c2a4b9d5e4f1e8a7b3c2d1e0f9a8b",
+                                                                      "status": "queued", "attempts": 0}}}
                      },
                      status.HTTP_404_NOT_FOUND: {
                         "description": "Reservation with the given id for the email does not exist.",
                         "content": {"application/json": {"example": {"detail": "Reservation with id 0 for the email user@example.com not found."}}}
+                     },
+                     status.HTTP_503_SERVICE_UNAVAILABLE: {
+                        "description": "Too many emails are waiting to be sent.",
+                        "content": {"application/json": {"example": {"detail": "Too many emails waiting to be sent, try again later."}}}
                      }
                  })
 async def send_email_with_key(reservation_id: int, key_input: KeyInput, owner_email: EmailStr = Depends(get_user_email),
-                              db: Session = Depends(get_db)):
+                              db: AsyncSession = Depends(get_db)):
 
-    reservation: models.Reservation = crud.get_reservation_by_internal_id(db, reservation_id)
+    reservation: models.Reservation = await crud.get_reservation_by_internal_id(db, reservation_id)
 
     if reservation is None or reservation.owner_email != owner_email:
         raise HTTPException(status_code=404, detail=f"Reservation with id {reservation_id} for email {owner_email} not found.")
 
-    await crud.send_email_to_reservation_client(db, key_input.key, reservation)
+    try:
+        return crud.send_email_to_reservation_client(key_input.key, reservation).to_status()
+    except EmailQueueFullError:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Too many emails waiting to be sent, try again later.")
+
+
+@api_router.get("/reservation/email_key/{email_id}", response_model=EmailJobStatus, status_code=status.HTTP_200_OK,
+                summary="Status of an email with key",
+                description="Returns the delivery status of an email queued by the email_key endpoint. The status is "
+                            "only known by the API process that queued the email.",
+                responses={
+                    status.HTTP_404_NOT_FOUND: {
+                        "description": "Email with the given id for the email does not exist, or was queued by "
+                                       "another API process.",
+                        "content": {"application/json": {"example": {"detail": "Email with id 0 for email user@example.com not found."}}}
+                    }
+                })
+async def read_email_with_key_status(email_id: str, owner_email: EmailStr = Depends(get_user_email)):
+    email_job = email_dispatcher.get_job(email_id)
+    if email_job is None or email_job.owner_email != owner_email:
+        raise HTTPException(status_code=404, detail=f"Email with id {email_id} for email {owner_email} not found.")
+    return email_job.to_status()
@@ -0,0 +1,49 @@
+from fastapi import APIRouter, Depends, status, HTTPException
+
+from pydantic import EmailStr
+
+from CalendarService.dependencies import get_user, get_user_email
+from CalendarService.profiler import PROFILING_ENABLED, PROFILING_HEADER, PROFILING_ALLOWED_EMAILS, profile_store
+from CalendarService.schemas import ProfileSummary, ProfileReport
+
+debug_router = APIRouter(prefix="/debug", tags=["debug"], dependencies=[Depends(get_user)])
+
+profiling_disabled_response = {
+    status.HTTP_404_NOT_FOUND: {
+        "description": "Profiling is disabled, or the profile is no longer kept.",
+        "content": {"application/json": {"example": {"detail": "Profile 0f6c2a4b9d5e4f1e8a7b3c2d1e0f9a8b not found"}}}
+    },
+    status.HTTP_403_FORBIDDEN: {
+        "description": "The user isn't in PROFILING_ALLOWED_EMAILS.",
+        "content": {"application/json": {"example": {"detail": "user@example.com is not allowed to read profiles"}}}
+    }
+}
+
+
+def ensure_profiling_enabled(email: EmailStr = Depends(get_user_email)):
+    if not PROFILING_ENABLED:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail="Profiling is disabled")
+    # the profiles hold the statements of the requests of every user
+    if email.lower() not in PROFILING_ALLOWED_EMAILS:
+        raise HTTPException(status.HTTP_403_FORBIDDEN, detail=f"{email} is not allowed to read profiles")
+
+
+@debug_router.get("/profiles", response_model=list[ProfileSummary], status_code=status.HTTP_200_OK,
+                  dependencies=[Depends(ensure_profiling_enabled)], responses=profiling_disabled_response,
+                  summary="Recent profiles of requests and consumed messages, newest first.",
+                  description=f"Requests are profiled when they send the {PROFILING_HEADER} header, with queries "
+                              f"or cpu as value, consumed messages when PROFILING_CONSUMER_MESSAGES is set.")
+async def read_profiles():
+    return [profile.to_summary() for profile in profile_store.recent()]
+
+
+@debug_router.get("/profiles/{profile_id}", response_model=ProfileReport, status_code=status.HTTP_200_OK,
+                  dependencies=[Depends(ensure_profiling_enabled)], responses=profiling_disabled_response,
+                  summary="Statements, repeated statement shapes and sampled stacks of a profile.",
+                  description="Statement shapes executed many times usually come from one query per item of a "
+                              "loop or from lazy loads, and are listed in repeated_statements.")
+async def read_profile(profile_id: str):
+    profile = profile_store.get(profile_id)
+    if profile is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, detail=f"Profile {profile_id} not found")
+    return profile.to_report()
@@ -0,0 +1,63 @@
+from datetime import datetime, timezone, timedelta, time
+
+from fastapi import APIRouter, Depends, status, HTTPException, Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from CalendarService import crud
+from CalendarService.dependencies import get_db, get_feed_owner_email
+from CalendarService.ics import FEED_PAST_DAYS, ICS_MEDIA_TYPE, feed_cache, feed_etag, etag_matches, render_feed
+
+# calendar apps can't send the bearer token, the feed token in the path authorizes these instead
+feed_router = APIRouter(prefix="/feeds", tags=["feeds"])
+
+feed_responses = {
+    status.HTTP_200_OK: {
+        "description": "iCalendar feed, with an ETag header.",
+        "content": {ICS_MEDIA_TYPE: {}}
+    },
+    status.HTTP_304_NOT_MODIFIED: {
+        "description": "The feed didn't change since the ETag sent in If-None-Match."
+    },
+    status.HTTP_404_NOT_FOUND: {
+        "description": "Invalid feed token, or property not owned by its owner.",
+        "content": {"application/json": {"example": {"detail": "Calendar feed not found"}}}
+    }
+}
+
+
+@feed_router.get("/{feed_token}/calendar.ics", response_class=Response, responses=feed_responses,
+                 summary="iCalendar feed of all the properties of an owner.",
+                 description=f"Events that aren't canceled and ended less than {FEED_PAST_DAYS} days ago.")
+async def read_owner_feed(request: Request, owner_email: str = Depends(get_feed_owner_email),
+                          db: AsyncSession = Depends(get_db)):
+    return await feed_response(request, db, owner_email)
+
+
+@feed_router.get("/{feed_token}/properties/{property_id}.ics", response_class=Response, responses=feed_responses,
+                 summary="iCalendar feed of a property.",
+                 description=f"Events that aren't canceled and ended less than {FEED_PAST_DAYS} days ago.")
+async def read_property_feed(property_id: int, request: Request, owner_email: str = Depends(get_feed_owner_email),
+                             db: AsyncSession = Depends(get_db)):
+    if not await crud.is_property_owned_by_email(db, owner_email, property_id):
+        raise HTTPException(status_code=404, detail="Calendar feed not found")
+    return await feed_response(request, db, owner_email, property_id)
+
+
+async def feed_response(request: Request, db: AsyncSession, owner_email: str, property_id: int = None):
+    # whole days, so the feed only changes once a day as old events leave it
+    since = datetime.combine(datetime.now(timezone.utc).date() - timedelta(days=FEED_PAST_DAYS), time())
+    # a single small query answers the polls of a feed that didn't change
+    etag = feed_etag(await crud.get_calendar_revisions(db, owner_email, property_id), since)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    body = feed_cache.get(owner_email, property_id, etag)
+    if body is None:
+        body = render_feed(
+            f"PropertEase property {property_id}" if property_id is not None else "PropertEase",
+            [event async for event in crud.stream_feed_events(db, owner_email, since, property_id)],
+            since
+        )
+        feed_cache.put(owner_email, property_id, etag, body)
+    return Response(content=body, media_type=ICS_MEDIA_TYPE, headers=headers)
@@ -1,14 +1,22 @@
-from datetime import datetime
+from datetime import datetime, date, timezone
 from enum import Enum
 from typing import Optional
 from fastapi import HTTPException
 from fastapi.exceptions import RequestValidationError
-from pydantic import BaseModel, EmailStr, model_validator, Field
+from pydantic import BaseModel, EmailStr, model_validator, field_validator, Field
 from pydantic_core import ValidationError
 from pydantic_extra_types.phone_numbers import PhoneNumber
+from CalendarService.recurrence import validate_series
 
 PhoneNumber.phone_format = 'E164'  # 'INTERNATIONAL'
 
+
+def to_naive_utc(value: datetime | None) -> datetime | None:
+    # event datetimes are stored without timezone, in UTC, and asyncpg refuses aware ones for them
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
 """
 Receiving Schemas - in API endpoints or messaging
 """
@@ -35,6 +43,8 @@ class BaseEvent(BaseModel):
     begin_datetime: datetime
     end_datetime: datetime
 
+    _naive_utc_datetimes = field_validator("begin_datetime", "end_datetime")(to_naive_utc)
+
     @model_validator(mode="after")
     def validate(self):
         if self.begin_datetime >= self.end_datetime:
@@ -50,7 +60,21 @@ class ExternalEvent(BaseEvent):
     external_id: int  # generated with a certain id the on website wrappers
 
 
-class Cleaning(InternalEvent):
+class ManagementEvent(InternalEvent):
+    # makes it a series of occurrences, e.g. FREQ=WEEKLY;COUNT=10, see recurrence.py
+    recurrence_rule: Optional[str] = None
+
+    @model_validator(mode="after")
+    def validate_recurrence_rule(self):
+        if self.recurrence_rule is not None:
+            try:
+                validate_series(self.begin_datetime, self.end_datetime, self.recurrence_rule)
+            except ValueError as e:
+                raise RequestValidationError(str(e))
+        return self
+
+
+class Cleaning(ManagementEvent):
     worker_name: str
 
 
@@ -59,6 +83,8 @@ class UpdateCleaning(BaseModel):
     begin_datetime: Optional[datetime] = None
     end_datetime: Optional[datetime] = None
 
+    _naive_utc_datetimes = field_validator("begin_datetime", "end_datetime")(to_naive_utc)
+
     @model_validator(mode="after")
     def validate(self):
         begin_end_datetime_none_size = [mydatetime for mydatetime in [self.begin_datetime, self.end_datetime] if mydatetime is None]
@@ -73,7 +99,7 @@ class UpdateCleaning(BaseModel):
         return self
 
 
-class Maintenance(InternalEvent):
+class Maintenance(ManagementEvent):
     company_name: str
 
 
@@ -82,6 +108,8 @@ class UpdateMaintenance(BaseModel):
     begin_datetime: Optional[datetime] = None
     end_datetime: Optional[datetime] = None
 
+    _naive_utc_datetimes = field_validator("begin_datetime", "end_datetime")(to_naive_utc)
+
     @model_validator(mode="after")
     def validate(self):
         begin_end_datetime_none_size = [mydatetime for mydatetime in [self.begin_datetime, self.end_datetime] if mydatetime is None]
@@ -96,6 +124,27 @@ class UpdateMaintenance(BaseModel):
         return self
 
 
+class OccurrenceOverride(BaseModel):
+    # begin_datetime of the occurrence, as generated by the recurrence rule
+    occurrence_begin_datetime: datetime
+    canceled: bool = False
+    begin_datetime: Optional[datetime] = None
+    end_datetime: Optional[datetime] = None
+
+    # compared with the stored datetimes
+    _naive_utc_datetimes = field_validator(
+        "occurrence_begin_datetime", "begin_datetime", "end_datetime")(to_naive_utc)
+
+    @model_validator(mode="after")
+    def validate(self):
+        if not self.canceled:
+            if self.begin_datetime is None or self.end_datetime is None:
+                raise RequestValidationError("begin_datetime and end_datetime are required unless canceled")
+            if self.begin_datetime >= self.end_datetime:
+                raise RequestValidationError("begin_datetime cannot be greater or equal to end_datetime")
+        return self
+
+
 class ReservationStatus(str, Enum):
     CONFIRMED = "confirmed"
     PENDING = "pending"
@@ -139,7 +188,19 @@ class BaseEventWithId(BaseModel):
 
 
 class ManagementEventWithId(BaseEventWithId):
-    pass
+    recurrence_rule: Optional[str] = None
+
+
+class ManagementOccurrence(BaseModel):
+    # an occurrence of a management event, recurring or not
+    id: int
+    property_id: int
+    owner_email: EmailStr
+    begin_datetime: datetime
+    end_datetime: datetime
+    type: str = Field(examples=["cleaning", "maintenance"])
+    # begin_datetime generated by the recurrence rule, for overriding the occurrence
+    occurrence_begin_datetime: Optional[datetime] = None
 
 
 class CleaningWithId(ManagementEventWithId):
@@ -162,5 +223,111 @@ class ReservationWithId(BaseEventWithId):
     cost: float
 
 
+class BulkEventStatus(str, Enum):
+    CREATED = "created"
+    INVALID = "invalid"
+    NOT_FOUND = "not_found"
+    OVERLAPPING = "overlapping"
+
+
+class BulkEventResult(BaseModel):
+    # index of the event in the request
+    index: int
+    status: BulkEventStatus
+    event: Optional[CleaningWithId | MaintenanceWithId] = None
+    detail: Optional[str | list] = None
+
+
 class KeyInput(BaseModel):
-    key: str
\ No newline at end of file
+    key: str
+
+
+class EventsWindow(BaseModel):
+    # events overlapping [from_datetime, to_datetime), ordered by (begin_datetime, id)
+    from_datetime: Optional[datetime] = None
+    to_datetime: Optional[datetime] = None
+    # keyset cursor: (begin_datetime, id) of the last event of the previous page
+    after: Optional[tuple[datetime, int]] = None
+    limit: Optional[int] = None
+
+
+class Interval(BaseModel):
+    begin_datetime: datetime
+    end_datetime: datetime
+
+
+class PropertyAvailability(BaseModel):
+    property_id: int
+    busy: list[Interval]
+    free: list[Interval]
+
+
+class RollupGranularity(str, Enum):
+    DAY = "day"
+    MONTH = "month"
+    YEAR = "year"
+
+
+class PropertyRollup(BaseModel):
+    property_id: int
+    # first day of the day/month/year
+    period: date
+    occupied_nights: int
+    revenue: float
+    cleanings: int
+    maintenances: int
+
+
+class CalendarFeeds(BaseModel):
+    # iCalendar subscription links, without the bearer token
+    calendar: str
+    properties: dict[int, str]
+
+
+class EmailStatus(str, Enum):
+    QUEUED = "queued"
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+
+
+class EmailJobStatus(BaseModel):
+    id: str
+    status: EmailStatus
+    attempts: int
+    error: Optional[str] = None
+
+
+class ProfiledStatement(BaseModel):
+    statement: str
+    seconds: float
+
+
+class RepeatedStatement(BaseModel):
+    # the same statement shape executed many times by one request or message, usually one query per item
+    shape: str
+    count: int
+    seconds: float
+
+
+class ProfiledStack(BaseModel):
+    # frames from the outermost to the innermost, separated by ";"
+    stack: str
+    samples: int
+
+
+class ProfileSummary(BaseModel):
+    id: str
+    name: str
+    started_at: datetime
+    seconds: float
+    statement_count: int
+    statement_seconds: float
+    repeated_statement_count: int
+
+
+class ProfileReport(ProfileSummary):
+    statements: list[ProfiledStatement]
+    repeated_statements: list[RepeatedStatement]
+    cpu_samples: Optional[int] = None
+    cpu_stacks: list[ProfiledStack] = []
@@ -0,0 +1,27 @@
+from typing import AsyncIterator, Callable
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from CalendarService.database import SessionLocal
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def wants_ndjson(request: Request) -> bool:
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+
+def ndjson_response(stream_events: Callable[[AsyncSession], AsyncIterator], EventSchema: type[BaseModel]):
+    """
+    Writes one EventSchema JSON per line, as the events are fetched.
+    Uses its own session because the one from get_db is closed before the response body is sent.
+    """
+    async def lines():
+        async with SessionLocal() as db:
+            async for event in stream_events(db):
+                yield EventSchema.model_validate(event, from_attributes=True).model_dump_json() + "\n"
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE)
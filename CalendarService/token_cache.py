@@ -0,0 +1,71 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+from CalendarService.metrics import TOKEN_CACHE_HITS, TOKEN_CACHE_MISSES
+
+load_dotenv()
+
+TOKEN_CACHE_MAX_SIZE = int(os.getenv("TOKEN_CACHE_MAX_SIZE", "10000"))
+TOKEN_CACHE_TTL_SECONDS = float(os.getenv("TOKEN_CACHE_TTL_SECONDS", "300"))
+
+
+class TokenVerificationCache:
+    """
+    Bounded LRU of verified (decoded) Firebase ID tokens, keyed by the SHA-256 of the token.
+    An entry lives at most ttl_seconds and never past the "exp" claim of its token. Thread-safe, the
+    synchronous dependencies using it run in the threadpool.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # token hash -> (expires_at, decoded_token)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    def get(self, token: str) -> dict | None:
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self._entries[key]
+                TOKEN_CACHE_MISSES.inc()
+                return None
+            self._entries.move_to_end(key)
+        TOKEN_CACHE_HITS.inc()
+        return entry[1]
+
+    def put(self, token: str, decoded_token: dict):
+        expires_at = time.time() + self.ttl_seconds
+        if "exp" in decoded_token:
+            expires_at = min(expires_at, decoded_token["exp"])
+        if expires_at <= time.time():
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (expires_at, decoded_token)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token: str = None):
+        # a single token, or every token when none is given
+        with self._lock:
+            if token is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._key(token), None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+token_verification_cache = TokenVerificationCache(TOKEN_CACHE_MAX_SIZE, TOKEN_CACHE_TTL_SECONDS)
@@ -0,0 +1,70 @@
+import argparse
+import asyncio
+import logging
+import os
+import signal
+
+from dotenv import load_dotenv
+from prometheus_client import start_http_server
+
+from CalendarService import models
+from CalendarService.logging_config import configure_logging
+from CalendarService.database import engine, SessionLocal
+from CalendarService.crud import initialize_rollups
+from CalendarService.migrations import migrate
+from CalendarService.messaging_operations import consume, stop_messaging, message_dispatcher, \
+    CONSUMER_WORKERS, CONSUMER_PREFETCH_COUNT, CONSUMER_DRAIN_TIMEOUT_SECONDS
+
+load_dotenv()
+
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+
+logger = logging.getLogger(__name__)
+
+
+async def run(prefetch_count: int, drain_timeout_seconds: float):
+    async with engine.begin() as connection:
+        await connection.run_sync(models.Base.metadata.create_all)
+        await migrate(connection)
+    async with SessionLocal() as db:
+        await initialize_rollups(db)
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    connection = await consume(loop, prefetch_count)
+    logger.info("Consuming with %d workers and prefetch count %d", message_dispatcher.worker_count, prefetch_count)
+
+    await stopping.wait()
+    logger.info("Stopping, draining the messages being processed")
+    await stop_messaging(connection, drain_timeout_seconds)
+    await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m CalendarService.worker",
+        description="Consumes the CalendarService messages, apart from the API processes."
+    )
+    parser.add_argument("--workers", type=int, default=CONSUMER_WORKERS,
+                        help="messages processed concurrently, sharded by owner")
+    parser.add_argument("--prefetch", type=int, default=CONSUMER_PREFETCH_COUNT,
+                        help="unacked messages the broker hands out at once")
+    parser.add_argument("--drain-timeout", type=float, default=CONSUMER_DRAIN_TIMEOUT_SECONDS,
+                        help="seconds to wait for the messages being processed when stopping")
+    parser.add_argument("--metrics-port", type=int, default=WORKER_METRICS_PORT,
+                        help="port of the Prometheus metrics endpoint, 0 to disable it")
+    args = parser.parse_args()
+
+    configure_logging()
+    if args.metrics_port:
+        start_http_server(args.metrics_port)
+
+    message_dispatcher.worker_count = args.workers
+    asyncio.run(run(args.prefetch, args.drain_timeout))
+
+
+if __name__ == "__main__":
+    main()
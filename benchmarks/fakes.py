@@ -0,0 +1,93 @@
+import asyncio
+import sys
+import time
+
+import pika
+
+
+class FakeBlockingChannel:
+    # ProjectUtils declares its queues on a blocking channel when imported, none of it is needed here
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class FakeBlockingConnection:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def channel(self):
+        return FakeBlockingChannel()
+
+    def close(self):
+        pass
+
+
+class FakeExchange:
+    """
+    Stands in for an aio_pika exchange, publish waits confirm_delay_seconds like a publisher confirm would.
+    Only the number of messages is kept, by routing key.
+    """
+
+    def __init__(self, confirm_delay_seconds: float = 0):
+        self.confirm_delay_seconds = confirm_delay_seconds
+        self.published = 0
+        self.published_by_routing_key = {}
+
+    async def publish(self, message, routing_key: str):
+        if self.confirm_delay_seconds > 0:
+            await asyncio.sleep(self.confirm_delay_seconds)
+        self.published += 1
+        self.published_by_routing_key[routing_key] = self.published_by_routing_key.get(routing_key, 0) + 1
+
+
+class FakeSMTP:
+    # stands in for aiosmtplib.SMTP, every message is accepted after send_delay_seconds
+    send_delay_seconds = 0
+    sent = 0
+    sent_at = None
+
+    def __init__(self, *args, **kwargs):
+        self.is_connected = False
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def login(self, username, password):
+        pass
+
+    async def send_message(self, message):
+        if FakeSMTP.send_delay_seconds > 0:
+            await asyncio.sleep(FakeSMTP.send_delay_seconds)
+        FakeSMTP.sent += 1
+        FakeSMTP.sent_at = time.perf_counter()
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.is_connected = False
+
+
+def fake_decode_token(res, cred):
+    # the bearer token is the email of the user
+    if cred is None:
+        raise ValueError("Missing bearer token")
+    return {"email": cred.credentials}
+
+
+def install_blocking_connection():
+    # before anything imports ProjectUtils.MessagingService.queue_definitions
+    if "ProjectUtils.MessagingService.queue_definitions" in sys.modules:
+        raise RuntimeError("install_blocking_connection must be called before CalendarService is imported")
+    pika.BlockingConnection = FakeBlockingConnection
+
+
+def install_service_fakes():
+    # after CalendarService is imported, replaces what it would reach over the network
+    import aiosmtplib
+    from CalendarService import dependencies
+
+    dependencies.decode_token = fake_decode_token
+    aiosmtplib.SMTP = FakeSMTP
@@ -0,0 +1,359 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+from benchmarks import fakes
+
+# before CalendarService is imported, it reads them when imported
+os.environ.setdefault("MAIL_USERNAME", "benchmark@example.com")
+os.environ.setdefault("MAIL_PASSWORD", "benchmark")
+os.environ.setdefault("POSTGRES_HOST", "localhost")
+fakes.install_blocking_connection()
+
+import httpx  # noqa: E402
+from fastapi import FastAPI  # noqa: E402
+from sqlalchemy import event, select, func, text  # noqa: E402
+
+from CalendarService import models, messaging_operations  # noqa: E402
+from CalendarService.database import engine, SessionLocal  # noqa: E402
+from CalendarService.email_dispatcher import email_dispatcher  # noqa: E402
+from CalendarService.outbox import outbox_relay  # noqa: E402
+from CalendarService.routers.apirouter import api_router  # noqa: E402
+from benchmarks.seed import seed, owner_email, property_owner, free_period, FIRST_SLOT, SLOT, EVENT_DURATION  # noqa: E402
+
+fakes.install_service_fakes()
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+# how long the fake broker and SMTP server may take to receive everything that was sent to them
+DELIVERY_TIMEOUT_SECONDS = 120
+
+
+class QueryCounter:
+    # every statement sent to Postgres by the engine, by this process
+
+    def __init__(self):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class Measurement:
+
+    def __init__(self, scenario: str, events: int):
+        self.scenario = scenario
+        self.events = events
+        self.latencies = []
+        self.queries = []
+        self.items = 0  # reservations imported, messages published, ... when an operation handles many
+        self.elapsed = 0
+        self.messages_per_second = None
+
+    async def measure(self, operation, items: int = 1):
+        # operation is a coroutine, it only starts running when awaited
+        queries = query_counter.count
+        started = time.perf_counter()
+        result = await operation
+        latency = time.perf_counter() - started
+        self.latencies.append(latency)
+        self.queries.append(query_counter.count - queries)
+        self.items += items
+        self.elapsed += latency
+        return result
+
+    def result(self) -> dict:
+        result = {
+            "scenario": self.scenario,
+            "events": self.events,
+            "operations": len(self.latencies),
+            "p50_ms": round(percentile(self.latencies, 0.5) * 1000, 3),
+            "p99_ms": round(percentile(self.latencies, 0.99) * 1000, 3),
+            "queries_per_operation": round(sum(self.queries) / len(self.queries), 2),
+            "items_per_second": round(self.items / self.elapsed, 1) if self.elapsed > 0 else None,
+        }
+        if self.messages_per_second is not None:
+            result["messages_per_second"] = round(self.messages_per_second, 1)
+        return result
+
+
+query_counter = QueryCounter()
+
+
+def percentile(values, fraction: float) -> float:
+    # nearest rank, so p99 of few operations is their slowest one
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def authorization(owner: int) -> dict:
+    # the fake decode_token takes the bearer token as the email of the user
+    return {"Authorization": f"Bearer {owner_email(owner)}"}
+
+
+async def expect(request, status_code: int) -> httpx.Response:
+    response = await request
+    if response.status_code != status_code:
+        raise RuntimeError(f"{response.request.method} {response.request.url} returned {response.status_code}, "
+                           f"expected {status_code}: {response.text}")
+    return response
+
+
+async def wait_for(condition, what: str):
+    deadline = time.perf_counter() + DELIVERY_TIMEOUT_SECONDS
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"Timed out waiting for {what}")
+        await asyncio.sleep(0.001)
+
+
+async def drain_outbox(exchange: fakes.FakeExchange, scenario: str, events: int) -> list[Measurement]:
+    # the outbox relay publishing everything the previous scenario committed, as a single operation
+    async with SessionLocal() as db:
+        pending = await db.scalar(select(func.count()).select_from(models.OutboxMessage))
+    if pending == 0:
+        return []
+    measurement = Measurement(f"outbox relay after {scenario}", events)
+
+    async def relay():
+        published = exchange.published
+        outbox_relay.start(exchange)
+        await wait_for(lambda: exchange.published - published >= pending, "the outbox relay")
+
+    await measurement.measure(relay(), pending)
+    await outbox_relay.stop()
+    measurement.messages_per_second = measurement.items / measurement.elapsed
+    return [measurement]
+
+
+async def list_events(client: httpx.AsyncClient, args, size) -> list[Measurement]:
+    measurement = Measurement("GET /events", size.events)
+    for i in range(args.requests):
+        await measurement.measure(expect(client.get(
+            "/events", params={"reservation_status": "confirmed", "limit": 100}, headers=authorization(i % size.owners)
+        ), 200))
+    return [measurement]
+
+
+async def manage_cleanings(client: httpx.AsyncClient, args, size, exchange: fakes.FakeExchange) -> list[Measurement]:
+    # each cleaning is created in a free period, moved within it and deleted
+    creation = Measurement("POST /events/management/cleaning", size.events)
+    update = Measurement("PUT /events/management/cleaning/{event_id}", size.events)
+    deletion = Measurement("DELETE /events/management/cleaning/{event_id}", size.events)
+    for i in range(args.requests):
+        property_id = i % size.properties + 1
+        begin_datetime, end_datetime = free_period(i // size.properties)
+        headers = authorization(property_owner(property_id, size.owners))
+        response = await creation.measure(expect(client.post("/events/management/cleaning", headers=headers, json={
+            "worker_name": "Benchmark",
+            "property_id": property_id,
+            "begin_datetime": begin_datetime.strftime(DATETIME_FORMAT),
+            "end_datetime": end_datetime.strftime(DATETIME_FORMAT),
+        }), 201))
+        event_id = response.json()["id"]
+        await update.measure(expect(client.put(f"/events/management/cleaning/{event_id}", headers=headers, json={
+            "worker_name": "Another benchmark",
+            "end_datetime": (end_datetime + timedelta(hours=1)).strftime(DATETIME_FORMAT),
+        }), 200))
+        await deletion.measure(expect(client.delete(f"/events/management/cleaning/{event_id}", headers=headers), 204))
+    return [creation, update, deletion] + await drain_outbox(exchange, "the cleaning requests", size.events)
+
+
+async def send_email_keys(client: httpx.AsyncClient, args, size) -> list[Measurement]:
+    # messages_per_second is how fast the email dispatcher sends them to the fake SMTP server
+    measurement = Measurement("POST /events/reservation/{reservation_id}/email_key", size.events)
+    async with SessionLocal() as db:
+        reservations = (await db.execute(
+            select(models.Reservation.id, models.Reservation.owner_email)
+            .order_by(models.Reservation.id).limit(args.requests)
+        )).all()
+    sent = fakes.FakeSMTP.sent
+    email_dispatcher.start()
+    started = time.perf_counter()
+    for reservation_id, reservation_owner_email in reservations:
+        await measurement.measure(expect(client.post(
+            f"/events/reservation/{reservation_id}/email_key", json={"key": "1234"},
+            headers={"Authorization": f"Bearer {reservation_owner_email}"}
+        ), 202))
+    await wait_for(lambda: fakes.FakeSMTP.sent - sent >= len(reservations), "the email dispatcher")
+    measurement.messages_per_second = len(reservations) / (fakes.FakeSMTP.sent_at - started)
+    await email_dispatcher.stop()
+    return [measurement]
+
+
+def reservations_to_import(args, size, batch: int) -> list[dict]:
+    # pending reservations after the seeded events, every OVERLAPPING_EVERY-th one overlaps a seeded event instead
+    reservations = []
+    slots = math.ceil(size.events / size.properties)
+    for i in range(batch * args.import_batch_size, (batch + 1) * args.import_batch_size):
+        property_id = i % size.properties + 1
+        if i % args.overlapping_every == 0:
+            begin_datetime = FIRST_SLOT + (i // size.properties % slots) * SLOT
+        else:
+            begin_datetime = FIRST_SLOT + (slots + i // size.properties) * SLOT
+        reservations.append({
+            "_id": 10 ** 9 + i,
+            "property_id": property_id,
+            "owner_email": owner_email(property_owner(property_id, size.owners)),
+            "begin_datetime": begin_datetime.strftime(DATETIME_FORMAT),
+            "end_datetime": (begin_datetime + EVENT_DURATION).strftime(DATETIME_FORMAT),
+            "client_email": f"client{i}@example.com",
+            "client_name": f"Client {i}",
+            "client_phone": "+351912345678",
+            "cost": 100,
+            "reservation_status": "pending",
+        })
+    return reservations
+
+
+async def import_reservations(args, size, exchange: fakes.FakeExchange) -> list[Measurement]:
+    # items_per_second is reservations imported per second
+    measurement = Measurement("import_reservations", size.events)
+    for batch in range(args.import_batches):
+        reservations = reservations_to_import(args, size, batch)
+        async with SessionLocal() as db:
+            await measurement.measure(
+                messaging_operations.import_reservations(db, "zooking", reservations), len(reservations))
+    return [measurement] + await drain_outbox(exchange, "import_reservations", size.events)
+
+
+async def publish_confirmed_reservations(args, size, exchange: fakes.FakeExchange) -> list[Measurement]:
+    # the confirmed reservations of the first properties, published straight to the exchange
+    measurement = Measurement("publish_confirmed_reservations", size.events)
+    messaging_operations.async_exchange = exchange
+    property_ids = list(range(1, min(size.properties, args.broadcast_properties) + 1))
+    for _ in range(args.broadcast_runs):
+        published = exchange.published
+        async with SessionLocal() as db:
+            await measurement.measure(
+                messaging_operations.publish_confirmed_reservations(db, "zooking", property_ids), items=0)
+        measurement.items += exchange.published - published
+    measurement.messages_per_second = measurement.items / measurement.elapsed
+    return [measurement]
+
+
+class Size:
+
+    def __init__(self, events: int, events_per_property: int, properties_per_owner: int):
+        self.events = events
+        self.properties = max(1, events // events_per_property)
+        self.owners = max(1, self.properties // properties_per_owner)
+
+
+async def run_size(args, size: Size) -> list[dict]:
+    print(f"Seeding {size.events} events, {size.properties} properties, {size.owners} owners")
+    await seed(size.events, size.owners, size.properties)
+    exchange = fakes.FakeExchange(args.confirm_delay_ms / 1000)
+    app = FastAPI()
+    app.include_router(api_router)
+    measurements = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://calendar-service") as client:
+        measurements += await list_events(client, args, size)
+        measurements += await manage_cleanings(client, args, size, exchange)
+        measurements += await send_email_keys(client, args, size)
+    measurements += await import_reservations(args, size, exchange)
+    measurements += await publish_confirmed_reservations(args, size, exchange)
+    return [measurement.result() for measurement in measurements]
+
+
+async def environment() -> dict:
+    async with engine.connect() as connection:
+        postgres = await connection.scalar(text("SELECT version()"))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "postgres": postgres,
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    # slower p99, fewer messages per second or any extra query per operation is a regression
+    baseline_results = {(result["scenario"], result["events"]): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get((result["scenario"], result["events"]))
+        if previous is None:
+            continue
+        name = f"{result['scenario']} with {result['events']} events"
+        if result["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p99 {previous['p99_ms']}ms -> {result['p99_ms']}ms")
+        if result["queries_per_operation"] > previous["queries_per_operation"]:
+            regressions.append(f"{name}: queries per operation "
+                               f"{previous['queries_per_operation']} -> {result['queries_per_operation']}")
+        if previous.get("messages_per_second") and \
+                result.get("messages_per_second", 0) < previous["messages_per_second"] * (1 - tolerance):
+            regressions.append(f"{name}: messages per second "
+                               f"{previous['messages_per_second']} -> {result.get('messages_per_second')}")
+    return regressions
+
+
+def print_results(results: list[dict]):
+    print(f"{'scenario':<50} {'events':>8} {'ops':>5} {'p50 ms':>9} {'p99 ms':>9} {'queries':>8} {'msgs/s':>9}")
+    for result in results:
+        print(f"{result['scenario']:<50} {result['events']:>8} {result['operations']:>5} {result['p50_ms']:>9} "
+              f"{result['p99_ms']:>9} {result['queries_per_operation']:>8} {result.get('messages_per_second', ''):>9}")
+
+
+async def run(args) -> int:
+    results = []
+    for events in args.sizes:
+        results += await run_size(args, Size(events, args.events_per_property, args.properties_per_owner))
+    print_results(results)
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "environment": await environment(),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        "results": results,
+    }
+    await engine.dispose()
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare is not None:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.run",
+        description="Benchmarks the CalendarService against a local Postgres, with in-process fakes for the broker, "
+                    "the token verification and SMTP. Every table of POSTGRES_DB is dropped and seeded again."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="numbers of seeded events, each size is benchmarked on its own database")
+    parser.add_argument("--events-per-property", type=int, default=100)
+    parser.add_argument("--properties-per-owner", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=200, help="requests per HTTP scenario")
+    parser.add_argument("--import-batches", type=int, default=20)
+    parser.add_argument("--import-batch-size", type=int, default=100, help="reservations per import message")
+    parser.add_argument("--overlapping-every", type=int, default=10,
+                        help="every n-th imported reservation overlaps a seeded event")
+    parser.add_argument("--broadcast-properties", type=int, default=100,
+                        help="properties whose confirmed reservations are published per run")
+    parser.add_argument("--broadcast-runs", type=int, default=5)
+    parser.add_argument("--confirm-delay-ms", type=float, default=0,
+                        help="simulated publisher confirm round trip of the fake broker")
+    parser.add_argument("--output", help="JSON file to write the results to, e.g. a new baseline")
+    parser.add_argument("--compare", help="baseline JSON file, exits with 1 when a result regressed")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="relative p99 and messages per second change tolerated by --compare")
+    sys.exit(asyncio.run(run(parser.parse_args())))
+
+
+if __name__ == "__main__":
+    main()
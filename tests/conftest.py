@@ -0,0 +1,5 @@
+import os
+
+# the email configuration is read when CalendarService.email_config is imported
+os.environ.setdefault("MAIL_USERNAME", "calendar@example.com")
+os.environ.setdefault("MAIL_PASSWORD", "password")
@@ -0,0 +1,27 @@
+import asyncio
+
+
+class FakeSMTP:
+    # stands in for aiosmtplib.SMTP, every message is accepted after send_delay_seconds
+    send_delay_seconds = 0
+    sent = []
+
+    def __init__(self, *args, **kwargs):
+        self.is_connected = False
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def login(self, username, password):
+        pass
+
+    async def send_message(self, message):
+        if FakeSMTP.send_delay_seconds > 0:
+            await asyncio.sleep(FakeSMTP.send_delay_seconds)
+        FakeSMTP.sent.append(message)
+
+    async def quit(self):
+        self.is_connected = False
+
+    def close(self):
+        self.is_connected = False
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from CalendarService import availability
+
+FROM = datetime(2030, 1, 1)
+TO = datetime(2030, 1, 10)
+
+
+def day(number: int) -> datetime:
+    return datetime(2030, 1, number)
+
+
+def test_overlapping_and_touching_periods_are_merged():
+    periods = [(day(2), day(4)), (day(3), day(5)), (day(5), day(6)), (day(7), day(8))]
+
+    assert availability.merge_busy_periods(periods, FROM, TO) == [(day(2), day(6)), (day(7), day(8))]
+
+
+def test_period_inside_the_swept_one_does_not_shorten_it():
+    periods = [(day(2), day(8)), (day(3), day(4)), (day(5), day(6))]
+
+    assert availability.merge_busy_periods(periods, FROM, TO) == [(day(2), day(8))]
+
+
+def test_periods_are_clipped_to_the_window():
+    periods = [(datetime(2029, 12, 30), day(2)), (day(9), day(12)), (day(10), day(11)), (datetime(2029, 12, 1), FROM)]
+
+    assert availability.merge_busy_periods(periods, FROM, TO) == [(FROM, day(2)), (day(9), TO)]
+
+
+def test_free_gaps_between_busy_periods():
+    busy = [(day(2), day(4)), (day(6), day(7))]
+
+    assert availability.free_gaps(busy, FROM, TO) == [(FROM, day(2)), (day(4), day(6)), (day(7), TO)]
+
+
+def test_no_free_gap_at_the_bounds_when_busy():
+    assert availability.free_gaps([(FROM, day(3)), (day(5), TO)], FROM, TO) == [(day(3), day(5))]
+    assert availability.free_gaps([(FROM, TO)], FROM, TO) == []
+    assert availability.free_gaps([], FROM, TO) == [(FROM, TO)]
@@ -0,0 +1,190 @@
+import asyncio
+import time
+
+import aiosmtplib
+import pytest
+
+from CalendarService import email_config, email_dispatcher as email_dispatcher_module
+from CalendarService.email_dispatcher import EmailDispatcher
+from CalendarService.schemas import EmailStatus
+from tests.fakes import FakeSMTP
+
+RETRY_BACKOFF_SECONDS = 0.01
+
+
+class FailingSMTP(FakeSMTP):
+    # the first failures messages are refused as if the server disconnected
+    failures = 0
+    attempted_at = []
+
+    async def send_message(self, message):
+        FailingSMTP.attempted_at.append(time.perf_counter())
+        if FailingSMTP.failures > 0:
+            FailingSMTP.failures -= 1
+            raise aiosmtplib.SMTPServerDisconnected("Connection lost")
+        await super().send_message(message)
+
+
+@pytest.fixture(autouse=True)
+def smtp(monkeypatch):
+    FakeSMTP.send_delay_seconds = 0
+    FakeSMTP.sent = []
+    FailingSMTP.failures = 0
+    FailingSMTP.attempted_at = []
+    monkeypatch.setattr(email_dispatcher_module.aiosmtplib, "SMTP", FailingSMTP)
+
+
+def create_dispatcher(max_attempts: int = 3, drain_timeout_seconds: float = 1) -> EmailDispatcher:
+    return EmailDispatcher(email_config.conf, max_queue_size=10, batch_size=5, max_attempts=max_attempts,
+                           retry_backoff_seconds=RETRY_BACKOFF_SECONDS, idle_timeout_seconds=60, jobs_kept=10,
+                           drain_timeout_seconds=drain_timeout_seconds)
+
+
+def enqueue(dispatcher: EmailDispatcher):
+    return dispatcher.enqueue("owner@example.com", "client@example.com", "Key", "<p>1234</p>")
+
+
+async def wait_until_done(job, timeout_seconds: float = 2):
+    deadline = time.perf_counter() + timeout_seconds
+    while job.status not in (EmailStatus.SENT, EmailStatus.FAILED):
+        assert time.perf_counter() < deadline, f"the email is still {job.status}"
+        await asyncio.sleep(0.001)
+
+
+def send(dispatcher: EmailDispatcher):
+    async def run():
+        dispatcher.start()
+        try:
+            job = enqueue(dispatcher)
+            await wait_until_done(job)
+            return job
+        finally:
+            await dispatcher.stop()
+
+    return asyncio.run(run())
+
+
+def test_email_is_sent():
+    job = send(create_dispatcher())
+
+    assert job.status == EmailStatus.SENT
+    assert job.attempts == 1
+    assert job.error is None
+    assert len(FakeSMTP.sent) == 1
+
+
+def test_failed_email_is_retried_with_backoff():
+    FailingSMTP.failures = 2
+
+    job = send(create_dispatcher())
+
+    assert job.status == EmailStatus.SENT
+    assert job.attempts == 3
+    assert job.error is None
+    assert len(FakeSMTP.sent) == 1
+    first_delay, second_delay = (later - earlier for earlier, later in
+                                 zip(FailingSMTP.attempted_at, FailingSMTP.attempted_at[1:]))
+    assert first_delay >= RETRY_BACKOFF_SECONDS
+    assert second_delay >= 2 * RETRY_BACKOFF_SECONDS
+
+
+def test_email_fails_after_the_last_attempt():
+    FailingSMTP.failures = 3
+
+    job = send(create_dispatcher(max_attempts=3))
+
+    assert job.status == EmailStatus.FAILED
+    assert job.attempts == 3
+    assert job.error == "Connection lost"
+    assert len(FakeSMTP.sent) == 0
+
+
+def test_unexpected_error_fails_the_email_and_the_dispatcher_keeps_sending(monkeypatch):
+    dispatcher = create_dispatcher()
+    connect = dispatcher._connect
+
+    async def broken_connect():
+        raise RuntimeError("Broken")
+
+    monkeypatch.setattr(dispatcher, "_connect", broken_connect)
+    failed_job = send(dispatcher)
+    monkeypatch.setattr(dispatcher, "_connect", connect)
+
+    assert failed_job.status == EmailStatus.FAILED
+    assert failed_job.error == "Broken"
+    assert send(dispatcher).status == EmailStatus.SENT
+
+
+def test_dispatcher_is_restarted_when_it_dies():
+    dispatcher = create_dispatcher()
+
+    async def run():
+        dispatcher.start()
+        crashed_task = dispatcher._task
+        queue_empty = dispatcher._queue.empty
+
+        def crash():
+            dispatcher._queue.empty = queue_empty
+            raise RuntimeError("Broken")
+
+        dispatcher._queue.empty = crash
+        try:
+            enqueue(dispatcher)
+            await asyncio.gather(crashed_task, return_exceptions=True)
+            await asyncio.sleep(0)
+            assert dispatcher._task is not None and dispatcher._task is not crashed_task
+            job = enqueue(dispatcher)
+            await wait_until_done(job)
+            return job
+        finally:
+            await dispatcher.stop()
+
+    assert asyncio.run(run()).status == EmailStatus.SENT
+
+
+def test_stop_sends_the_queued_emails():
+    FakeSMTP.send_delay_seconds = 0.01
+    dispatcher = create_dispatcher()
+
+    async def run():
+        dispatcher.start()
+        jobs = [enqueue(dispatcher) for _ in range(3)]
+        await dispatcher.stop()
+        return jobs
+
+    assert [job.status for job in asyncio.run(run())] == [EmailStatus.SENT] * 3
+    assert len(FakeSMTP.sent) == 3
+
+
+def test_stop_sends_the_retries_without_their_backoff():
+    FailingSMTP.failures = 1
+    dispatcher = create_dispatcher()
+    dispatcher.retry_backoff_seconds = 60
+
+    async def run():
+        dispatcher.start()
+        job = enqueue(dispatcher)
+        while job.attempts == 0 or job.status != EmailStatus.QUEUED:
+            await asyncio.sleep(0.001)
+        await asyncio.wait_for(dispatcher.stop(), timeout=1)
+        return job
+
+    job = asyncio.run(run())
+    assert job.status == EmailStatus.SENT
+    assert job.attempts == 2
+
+
+def test_stop_fails_the_emails_left_after_the_drain_timeout():
+    FakeSMTP.send_delay_seconds = 0.1
+    dispatcher = create_dispatcher(drain_timeout_seconds=0.05)
+
+    async def run():
+        dispatcher.start()
+        jobs = [enqueue(dispatcher) for _ in range(3)]
+        await dispatcher.stop()
+        return jobs
+
+    jobs = asyncio.run(run())
+    assert [job.status for job in jobs] == [EmailStatus.FAILED] * 3
+    assert all(job.error == "The service stopped before the email was sent" for job in jobs)
+    assert dispatcher.queue_size() == 0
@@ -0,0 +1,63 @@
+from datetime import datetime
+
+from CalendarService import occupancy
+
+
+def hours(mask: int) -> list[int]:
+    return [hour for hour in range(occupancy.HOURS_PER_YEAR) if mask >> hour & 1]
+
+
+def test_whole_hours():
+    assert hours(occupancy.period_mask(2030, datetime(2030, 1, 1, 2), datetime(2030, 1, 1, 5))) == [2, 3, 4]
+
+
+def test_partial_hours_occupy_the_whole_hour():
+    assert hours(occupancy.period_mask(2030, datetime(2030, 1, 1, 2, 30), datetime(2030, 1, 1, 4, 1))) == [2, 3, 4]
+    assert hours(occupancy.period_mask(2030, datetime(2030, 1, 2, 0, 59), datetime(2030, 1, 2, 1))) == [24]
+
+
+def test_empty_period_has_no_hours():
+    assert occupancy.period_mask(2030, datetime(2030, 1, 1, 2), datetime(2030, 1, 1, 2)) == 0
+
+
+def test_period_out_of_the_year_has_no_hours():
+    assert occupancy.period_mask(2031, datetime(2030, 6, 1), datetime(2030, 6, 2)) == 0
+
+
+def test_last_hours_of_a_common_and_a_leap_year():
+    assert hours(occupancy.period_mask(2030, datetime(2030, 12, 31, 23), datetime(2031, 1, 1))) == [365 * 24 - 1]
+    assert hours(occupancy.period_mask(2032, datetime(2032, 12, 31, 23), datetime(2033, 1, 1))) == [366 * 24 - 1]
+
+
+def test_period_over_new_year_is_split_between_the_bitmaps():
+    begin_datetime, end_datetime = datetime(2030, 12, 31, 22, 30), datetime(2031, 1, 1, 1, 15)
+
+    assert list(occupancy.years_of_period(begin_datetime, end_datetime)) == [2030, 2031]
+    assert hours(occupancy.period_mask(2030, begin_datetime, end_datetime)) == [365 * 24 - 2, 365 * 24 - 1]
+    assert hours(occupancy.period_mask(2031, begin_datetime, end_datetime)) == [0, 1]
+
+
+def test_period_ending_at_new_year_does_not_touch_the_next_year():
+    assert list(occupancy.years_of_period(datetime(2030, 12, 31), datetime(2031, 1, 1))) == [2030]
+
+
+def test_bitmap_bytes_round_trip():
+    mask = occupancy.period_mask(2032, datetime(2032, 12, 31, 20), datetime(2033, 1, 1))
+    bits = occupancy.bitmap_to_bytes(mask)
+
+    assert len(bits) == occupancy.BITMAP_SIZE
+    assert occupancy.bitmap_from_bytes(bits) == mask
+
+
+def test_is_free():
+    bitmaps_by_year = {
+        2030: occupancy.period_mask(2030, datetime(2030, 12, 31, 23), datetime(2031, 1, 1, 2)),
+        2031: occupancy.period_mask(2031, datetime(2030, 12, 31, 23), datetime(2031, 1, 1, 2)),
+    }
+
+    assert occupancy.is_free(bitmaps_by_year, datetime(2030, 12, 31, 20), datetime(2030, 12, 31, 23))
+    assert not occupancy.is_free(bitmaps_by_year, datetime(2030, 12, 31, 20), datetime(2030, 12, 31, 23, 1))
+    # only the hours are known, a period that begins in an occupied hour isn't free
+    assert not occupancy.is_free(bitmaps_by_year, datetime(2031, 1, 1, 1, 59), datetime(2031, 1, 1, 3))
+    assert occupancy.is_free(bitmaps_by_year, datetime(2031, 1, 1, 2), datetime(2031, 1, 2))
+    assert occupancy.is_free(bitmaps_by_year, datetime(2032, 1, 1), datetime(2032, 2, 1))
@@ -0,0 +1,23 @@
+import base64
+from datetime import datetime
+
+import pytest
+
+from CalendarService.pagination import encode_cursor, decode_cursor
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(datetime(2030, 5, 30, 10, 37, 34), 42)) == (datetime(2030, 5, 30, 10, 37, 34), 42)
+
+
+def test_cursor_with_an_offset_is_naive_utc():
+    cursor = base64.urlsafe_b64encode(b"2030-05-30T12:37:34+02:00,42").decode()
+
+    assert decode_cursor(cursor) == (datetime(2030, 5, 30, 10, 37, 34), 42)
+
+
+@pytest.mark.parametrize("cursor", ["not a cursor", base64.urlsafe_b64encode(b"2030-05-30,1,2").decode(),
+                                    base64.urlsafe_b64encode(b"yesterday,1").decode()])
+def test_invalid_cursors_raise_value_error(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
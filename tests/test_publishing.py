@@ -0,0 +1,48 @@
+import asyncio
+
+import pytest
+
+from CalendarService.publishing import publish_in_order, PublishError
+
+
+class FakeExchange:
+    # confirms the messages after their delay, in any order, and refuses the ones in refused
+
+    def __init__(self, delays, refused=()):
+        self.delays = delays
+        self.refused = set(refused)
+        self.written = []
+
+    async def publish(self, message, routing_key: str):
+        self.written.append(message)
+        await asyncio.sleep(self.delays[message])
+        if message in self.refused:
+            raise RuntimeError(f"{message} was refused")
+
+
+def test_messages_are_written_in_order_whatever_the_order_of_the_confirms():
+    exchange = FakeExchange({"first": 0.03, "second": 0.01, "third": 0.02})
+
+    asyncio.run(publish_in_order(exchange, [("key", "first"), ("key", "second"), ("key", "third")]))
+
+    assert exchange.written == ["first", "second", "third"]
+
+
+def test_confirms_are_awaited_together():
+    exchange = FakeExchange({message: 0.05 for message in range(20)})
+
+    async def timed():
+        started = asyncio.get_running_loop().time()
+        await publish_in_order(exchange, [("key", message) for message in range(20)])
+        return asyncio.get_running_loop().time() - started
+
+    assert asyncio.run(timed()) < 0.5
+
+
+def test_error_tells_how_many_of_the_first_messages_were_confirmed():
+    exchange = FakeExchange({"first": 0, "second": 0, "third": 0}, refused={"second"})
+
+    with pytest.raises(PublishError) as error:
+        asyncio.run(publish_in_order(exchange, [("key", "first"), ("key", "second"), ("key", "third")]))
+
+    assert error.value.confirmed == 1
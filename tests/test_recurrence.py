@@ -0,0 +1,142 @@
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple
+
+import pytest
+
+from CalendarService import recurrence
+from CalendarService.recurrence import RecurrenceRule
+
+BEGIN = datetime(2030, 1, 31, 10)
+END = datetime(2030, 1, 31, 12)
+
+
+class OverrideState(NamedTuple):
+    # as stored by crud
+    occurrence_begin_datetime: datetime
+    canceled: bool
+    begin_datetime: datetime | None
+    end_datetime: datetime | None
+
+
+def begins(occurrences):
+    return [begin_datetime for _, begin_datetime, _ in occurrences]
+
+
+def test_parse_rule():
+    assert recurrence.parse_rule("RRULE:FREQ=WEEKLY;INTERVAL=2;COUNT=10") == RecurrenceRule("WEEKLY", 2, 10, None)
+    assert recurrence.parse_rule("freq=MONTHLY;until=20301231T000000Z") == \
+        RecurrenceRule("MONTHLY", 1, None, datetime(2030, 12, 31))
+
+
+@pytest.mark.parametrize("rule", [
+    "FREQ=DAILY;freq=WEEKLY;COUNT=2",
+    "FREQ=DAILY;COUNT=2;COUNT=3",
+    "FREQ=DAILY;COUNT",
+    "FREQ=YEARLY;COUNT=2",
+    "FREQ=DAILY;BYDAY=MO;COUNT=2",
+    "FREQ=DAILY",
+    "FREQ=DAILY;COUNT=2;UNTIL=20301231T000000",
+    "FREQ=DAILY;COUNT=0",
+    "FREQ=DAILY;INTERVAL=0;COUNT=2",
+    "FREQ=DAILY;COUNT=two",
+    "FREQ=DAILY;UNTIL=2030-12-31",
+])
+def test_invalid_rules_are_refused(rule):
+    with pytest.raises(ValueError):
+        recurrence.parse_rule(rule)
+
+
+def test_expand_with_count():
+    assert recurrence.expand(BEGIN, END, "FREQ=DAILY;INTERVAL=2;COUNT=3") == [
+        (BEGIN, BEGIN, END),
+        (BEGIN + timedelta(days=2), BEGIN + timedelta(days=2), END + timedelta(days=2)),
+        (BEGIN + timedelta(days=4), BEGIN + timedelta(days=4), END + timedelta(days=4)),
+    ]
+
+
+def test_expand_with_until_includes_an_occurrence_beginning_at_until():
+    assert begins(recurrence.expand(BEGIN, END, "FREQ=WEEKLY;UNTIL=20300214T100000")) == [
+        BEGIN, BEGIN + timedelta(weeks=1), BEGIN + timedelta(weeks=2)
+    ]
+
+
+def test_monthly_skips_the_months_without_the_day_and_does_not_count_them():
+    assert begins(recurrence.expand(BEGIN, END, "FREQ=MONTHLY;COUNT=3")) == [
+        datetime(2030, 1, 31, 10), datetime(2030, 3, 31, 10), datetime(2030, 5, 31, 10)
+    ]
+
+
+def test_monthly_crosses_the_year():
+    assert begins(recurrence.expand(datetime(2030, 11, 15), datetime(2030, 11, 16), "FREQ=MONTHLY;COUNT=3")) == [
+        datetime(2030, 11, 15), datetime(2030, 12, 15), datetime(2031, 1, 15)
+    ]
+
+
+def test_expand_only_returns_the_occurrences_overlapping_the_window():
+    occurrences = recurrence.expand(BEGIN, END, "FREQ=DAILY;COUNT=10",
+                                    from_datetime=BEGIN + timedelta(days=3, hours=1),
+                                    to_datetime=BEGIN + timedelta(days=5))
+
+    assert begins(occurrences) == [BEGIN + timedelta(days=3), BEGIN + timedelta(days=4)]
+
+
+def test_overrides_cancel_and_move_occurrences():
+    moved_begin = BEGIN + timedelta(days=1, hours=3)
+    overrides = [
+        OverrideState(BEGIN + timedelta(days=1), False, moved_begin, moved_begin + timedelta(hours=1)),
+        OverrideState(BEGIN + timedelta(days=2), True, None, None),
+    ]
+
+    assert recurrence.expand(BEGIN, END, "FREQ=DAILY;COUNT=3", overrides) == [
+        (BEGIN, BEGIN, END),
+        (BEGIN + timedelta(days=1), moved_begin, moved_begin + timedelta(hours=1)),
+    ]
+
+
+def test_overrides_of_occurrences_the_series_does_not_have_are_ignored():
+    overrides = [OverrideState(BEGIN + timedelta(hours=1), False, BEGIN + timedelta(hours=5),
+                               BEGIN + timedelta(hours=6))]
+
+    assert begins(recurrence.expand(BEGIN, END, "FREQ=DAILY;COUNT=2", overrides)) == [
+        BEGIN, BEGIN + timedelta(days=1)
+    ]
+
+
+def test_is_occurrence():
+    assert recurrence.is_occurrence(BEGIN, "FREQ=WEEKLY;COUNT=3", BEGIN + timedelta(weeks=2))
+    assert not recurrence.is_occurrence(BEGIN, "FREQ=WEEKLY;COUNT=3", BEGIN + timedelta(weeks=3))
+    assert not recurrence.is_occurrence(BEGIN, "FREQ=WEEKLY;COUNT=3", BEGIN + timedelta(days=1))
+
+
+def test_validate_series_accepts_a_valid_series():
+    recurrence.validate_series(BEGIN, END, "FREQ=DAILY;COUNT=5")
+
+
+def test_validate_series_accepts_an_aware_begin_with_until():
+    recurrence.validate_series(BEGIN.replace(tzinfo=timezone.utc), END.replace(tzinfo=timezone.utc),
+                               "FREQ=DAILY;UNTIL=20300205T000000")
+
+
+@pytest.mark.parametrize("end_datetime, rule", [
+    # longer than the step between two occurrences
+    (BEGIN + timedelta(days=2), "FREQ=DAILY;COUNT=2"),
+    (BEGIN + timedelta(days=29), "FREQ=MONTHLY;COUNT=2"),
+    (END, f"FREQ=DAILY;COUNT={recurrence.RECURRENCE_MAX_OCCURRENCES + 1}"),
+    (END, "FREQ=DAILY;UNTIL=99991231T000000"),
+    (END, "FREQ=DAILY;COUNT=2;freq=WEEKLY"),
+])
+def test_validate_series_refuses_invalid_series(end_datetime, rule):
+    with pytest.raises(ValueError):
+        recurrence.validate_series(BEGIN, end_datetime, rule)
+
+
+def test_validate_series_refuses_occurrences_out_of_the_supported_dates():
+    with pytest.raises(ValueError):
+        recurrence.validate_series(datetime(9999, 12, 20), datetime(9999, 12, 21), "FREQ=WEEKLY;COUNT=3")
+
+
+def test_periods_overlap():
+    assert not recurrence.periods_overlap([(BEGIN, END), (END, END + timedelta(hours=1))])
+    assert recurrence.periods_overlap([(END, END + timedelta(hours=1)), (BEGIN, END + timedelta(minutes=1))])
+    assert recurrence.periods_overlap([(BEGIN, END + timedelta(days=1)), (END, END + timedelta(hours=1)),
+                                       (END + timedelta(hours=2), END + timedelta(hours=3))])
@@ -0,0 +1,41 @@
+import json
+from datetime import datetime
+
+from CalendarService import schemas
+
+
+def test_posted_utc_datetimes_are_stored_naive():
+    # as FastAPI validates the body of POST /events/management/cleaning
+    cleaning = schemas.Cleaning.model_validate_json(json.dumps({
+        "property_id": 1, "owner_email": "owner@example.com", "worker_name": "Worker",
+        "begin_datetime": "2030-05-30T10:37:34Z", "end_datetime": "2030-05-30T12:00:00+01:00"
+    }))
+
+    assert cleaning.begin_datetime == datetime(2030, 5, 30, 10, 37, 34)
+    assert cleaning.end_datetime == datetime(2030, 5, 30, 11, 0)
+
+
+def test_updated_utc_datetimes_are_stored_naive():
+    update = schemas.UpdateMaintenance.model_validate_json(json.dumps({
+        "begin_datetime": "2030-05-30T10:37:34Z", "end_datetime": "2030-05-30T12:00:00Z"
+    }))
+
+    assert update.begin_datetime == datetime(2030, 5, 30, 10, 37, 34)
+    assert update.end_datetime == datetime(2030, 5, 30, 12, 0)
+
+
+def test_naive_datetimes_are_kept():
+    cleaning = schemas.Cleaning(property_id=1, owner_email="owner@example.com", worker_name="Worker",
+                                begin_datetime=datetime(2030, 5, 30, 10), end_datetime=datetime(2030, 5, 30, 12))
+
+    assert cleaning.begin_datetime == datetime(2030, 5, 30, 10)
+
+
+def test_override_datetimes_are_stored_naive():
+    override = schemas.OccurrenceOverride.model_validate_json(json.dumps({
+        "occurrence_begin_datetime": "2030-05-30T10:00:00+02:00",
+        "begin_datetime": "2030-05-30T11:00:00Z", "end_datetime": "2030-05-30T12:00:00Z"
+    }))
+
+    assert override.occurrence_begin_datetime == datetime(2030, 5, 30, 8, 0)
+    assert override.begin_datetime == datetime(2030, 5, 30, 11, 0)